@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+
+
+class MessageStats:
+    """/statsで表示する集計値を記録のたびに更新して保持する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total_messages = 0
+        self.needs_reply = 0
+        self.high_opportunities = 0
+        self._user_ids = set()
+
+    def rebuild(self, storage):
+        """ストレージから集計値を作り直す（起動時に1回）"""
+        total_messages = storage.count()
+        needs_reply = storage.count(reply_status='要返信')
+        high_opportunities = storage.count(monetization='高')
+        user_ids = storage.distinct_user_ids()
+
+        with self._lock:
+            self.total_messages = total_messages
+            self.needs_reply = needs_reply
+            self.high_opportunities = high_opportunities
+            self._user_ids = user_ids
+
+    def record(self, data):
+        """保存したレコード（リスト）を集計に反映"""
+        with self._lock:
+            self.total_messages += 1
+            if data[5] == '要返信':
+                self.needs_reply += 1
+            if data[6] == '高':
+                self.high_opportunities += 1
+            self._user_ids.add(data[1])
+
+    def snapshot(self):
+        """現在の集計値を返す"""
+        with self._lock:
+            return {
+                'total_messages': self.total_messages,
+                'needs_reply': self.needs_reply,
+                'high_opportunities': self.high_opportunities,
+                'customers': len(self._user_ids),
+            }
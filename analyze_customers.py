@@ -2,195 +2,377 @@
 # -*- coding: utf-8 -*-
 
 import os
-import csv
+import json
+import time
+import argparse
 from datetime import datetime, timedelta
 from collections import defaultdict
+from contextlib import contextmanager
 
-def analyze_reply_status():
+from storage import open_storage, STORAGE_BACKEND
+from customers import read_customers
+
+# 増分分析のチェックポイント
+CHECKPOINT_PATH = os.environ.get('ANALYSIS_CHECKPOINT_PATH', os.path.join(os.path.dirname(__file__), 'analysis_checkpoint.json'))
+CHECKPOINT_VERSION = 1
+
+
+class CustomerAnalysis:
+    """分析レポートに必要な集計をデータの1回の走査でまとめて計算する"""
+
+    def __init__(self):
+        self.total_rows = 0
+        self.needs_reply_count = 0
+        self.high_count = 0
+        self.medium_count = 0
+        # 今回の走査で読んだ行のうち詳細を表示するもの（増分モードでは新着分のみ）
+        self.needs_reply = []
+        self.high_opportunities = []
+        self.medium_opportunities = []
+        self.monetization_stats = defaultdict(int)
+        self.reply_stats = defaultdict(int)
+        # ユーザー名 -> 最新のタイムスタンプ（'%Y-%m-%d %H:%M:%S'は文字列のまま大小比較できる）
+        self.user_last_message = {}
+        self.new_followers_count = 0
+
+        # 増分モードで前回までの集計を引き継いだか
+        self.incremental = False
+        self.new_rows = 0
+
+        # 処理時間（秒）
+        self.timings = {}
+
+    def add(self, row):
+        """1行を集計に反映"""
+        self.total_rows += 1
+        self.new_rows += 1
+
+        reply_status = row['返信ステータス']
+        monetization = row['マネタイズ機会']
+        user_name = row['ユーザー名']
+        timestamp = row['タイムスタンプ']
+
+        if reply_status == '要返信':
+            self.needs_reply_count += 1
+            self.needs_reply.append(row)
+        if monetization == '高':
+            self.high_count += 1
+            self.high_opportunities.append(row)
+        elif monetization == '中':
+            self.medium_count += 1
+            self.medium_opportunities.append(row)
+
+        self.monetization_stats[monetization] += 1
+        self.reply_stats[reply_status] += 1
+
+        last_message = self.user_last_message.get(user_name)
+        if last_message is None or timestamp > last_message:
+            self.user_last_message[user_name] = timestamp
+
+        if row['メッセージタイプ'] == 'follow':
+            self.new_followers_count += 1
+
+    def scan(self, rows):
+        """行をすべて読み込んで集計"""
+        started = time.perf_counter()
+        for row in rows:
+            self.add(row)
+        self.timings['scan'] = time.perf_counter() - started
+        return self
+
+    def to_dict(self):
+        """チェックポイントに保存する集計値"""
+        return {
+            'total_rows': self.total_rows,
+            'needs_reply_count': self.needs_reply_count,
+            'high_count': self.high_count,
+            'medium_count': self.medium_count,
+            'monetization_stats': dict(self.monetization_stats),
+            'reply_stats': dict(self.reply_stats),
+            'user_last_message': self.user_last_message,
+            'new_followers_count': self.new_followers_count,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """チェックポイントの集計値から復元（以前のバージョンが保存したuser_statsは使わない）"""
+        analysis = cls()
+        analysis.total_rows = data['total_rows']
+        analysis.needs_reply_count = data['needs_reply_count']
+        analysis.high_count = data['high_count']
+        analysis.medium_count = data['medium_count']
+        analysis.monetization_stats.update(data['monetization_stats'])
+        analysis.reply_stats.update(data['reply_stats'])
+        analysis.user_last_message = dict(data['user_last_message'])
+        analysis.new_followers_count = data['new_followers_count']
+        analysis.incremental = True
+        return analysis
+
+    def inactive_users(self, days=30, now=None):
+        """指定日数以上連絡のないユーザー数"""
+        now = now or datetime.now()
+        cutoff = (now - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        return sum(1 for last_message in self.user_last_message.values() if last_message < cutoff)
+
+
+def run_analysis(storage=None):
+    """ストレージを1回走査して分析結果を返す（データが無い場合はNone）"""
+    storage = storage or open_storage()
+    analysis = CustomerAnalysis().scan(storage.iter_rows())
+    if analysis.total_rows == 0:
+        return None
+    return analysis
+
+
+def load_checkpoint(path=CHECKPOINT_PATH):
+    """チェックポイントを読み込む（無い・壊れている場合はNone）"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except Exception as e:
+        print(f"⚠️ チェックポイント読み込み失敗: {e}")
+        return None
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        return None
+    return checkpoint
+
+
+def save_checkpoint(analysis, position, backend, path=CHECKPOINT_PATH):
+    """走査位置と集計値をチェックポイントに保存"""
+    checkpoint = {
+        'version': CHECKPOINT_VERSION,
+        'backend': backend,
+        'position': position,
+        'aggregates': analysis.to_dict(),
+        'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def run_incremental_analysis(storage=None, path=CHECKPOINT_PATH, rebuild=False, backend=None):
+    """前回のチェックポイント以降に追記された行だけを読んで分析結果を返す
+
+    ファイルのローテーション・切り詰めなどでチェックポイントが使えない場合は全件を読み直す。
+    """
+    backend = backend or STORAGE_BACKEND
+    storage = storage or open_storage(backend)
+
+    checkpoint = None if rebuild else load_checkpoint(path)
+    if (checkpoint is not None and checkpoint.get('backend') == backend
+            and storage.position_valid(checkpoint.get('position'))):
+        analysis = CustomerAnalysis.from_dict(checkpoint['aggregates'])
+        position = checkpoint['position']
+    else:
+        if checkpoint is not None:
+            print("⚠️ データが作り直されたため、全件を再集計します")
+        analysis = CustomerAnalysis()
+        position = None
+
+    rows, next_position = storage.scan_since(position)
+    analysis.scan(rows)
+
+    if next_position is not None:
+        save_checkpoint(analysis, next_position, backend, path)
+
+    if analysis.total_rows == 0:
+        return None
+    return analysis
+
+
+@contextmanager
+def _timed(analysis, name):
+    """レポート出力の処理時間を記録"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        analysis.timings[name] = time.perf_counter() - started
+
+
+def analyze_reply_status(analysis=None):
     """返信漏れを分析"""
-    csv_file = os.path.join(os.path.dirname(__file__), 'customer_data.csv')
-    
-    if not os.path.exists(csv_file):
-        print("CSVファイルが見つかりません")
+    analysis = analysis or run_analysis()
+
+    if analysis is None:
+        print("顧客データが見つかりません")
         return None
-    
+
     try:
-        needs_reply = []
-        
-        with open(csv_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row['返信ステータス'] == '要返信':
-                    needs_reply.append(row)
-        
-        if len(needs_reply) > 0:
-            print("\n=== 返信漏れ検知 ===")
-            print(f"返信が必要なメッセージ数: {len(needs_reply)}")
-            print("\n詳細:")
-            for row in needs_reply:
-                content = row['メッセージ内容'][:50]
-                print(f"- {row['タイムスタンプ']} | {row['ユーザー名']} | {content}")
-            
-            return needs_reply
-        else:
-            print("\n返信漏れはありません！")
-            return None
-    
+        with _timed(analysis, 'reply_status'):
+            needs_reply = analysis.needs_reply
+
+            if analysis.needs_reply_count > 0:
+                print("\n=== 返信漏れ検知 ===")
+                print(f"返信が必要なメッセージ数: {analysis.needs_reply_count}")
+                print("\n詳細（新着のみ）:" if analysis.incremental else "\n詳細:")
+                for row in needs_reply:
+                    content = row['メッセージ内容'][:50]
+                    print(f"- {row['タイムスタンプ']} | {row['ユーザー名']} | {content}")
+
+                return needs_reply
+            else:
+                print("\n返信漏れはありません！")
+                return None
+
     except Exception as e:
         print(f"分析エラー: {e}")
         return None
 
-def analyze_monetization_opportunities():
+def analyze_monetization_opportunities(analysis=None):
     """マネタイズ機会を分析"""
-    csv_file = os.path.join(os.path.dirname(__file__), 'customer_data.csv')
-    
-    if not os.path.exists(csv_file):
-        print("CSVファイルが見つかりません")
+    analysis = analysis or run_analysis()
+
+    if analysis is None:
+        print("顧客データが見つかりません")
         return None, None
-    
+
     try:
-        high_opportunities = []
-        medium_opportunities = []
-        
-        with open(csv_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row['マネタイズ機会'] == '高':
-                    high_opportunities.append(row)
-                elif row['マネタイズ機会'] == '中':
-                    medium_opportunities.append(row)
-        
-        print("\n=== マネタイズ機会分析 ===")
-        print(f"高優先度: {len(high_opportunities)}件")
-        print(f"中優先度: {len(medium_opportunities)}件")
-        
-        if len(high_opportunities) > 0:
-            print("\n【高優先度】:")
-            for row in high_opportunities:
-                content = row['メッセージ内容'][:50]
-                print(f"- {row['タイムスタンプ']} | {row['ユーザー名']} | {content}")
-        
-        if len(medium_opportunities) > 0:
-            print("\n【中優先度】:")
-            for i, row in enumerate(medium_opportunities[:5]):
-                content = row['メッセージ内容'][:50]
-                print(f"- {row['タイムスタンプ']} | {row['ユーザー名']} | {content}")
-        
-        return high_opportunities, medium_opportunities
-    
+        with _timed(analysis, 'monetization'):
+            high_opportunities = analysis.high_opportunities
+            medium_opportunities = analysis.medium_opportunities
+
+            print("\n=== マネタイズ機会分析 ===")
+            print(f"高優先度: {analysis.high_count}件")
+            print(f"中優先度: {analysis.medium_count}件")
+
+            if len(high_opportunities) > 0:
+                print("\n【高優先度（新着）】:" if analysis.incremental else "\n【高優先度】:")
+                for row in high_opportunities:
+                    content = row['メッセージ内容'][:50]
+                    print(f"- {row['タイムスタンプ']} | {row['ユーザー名']} | {content}")
+
+            if len(medium_opportunities) > 0:
+                print("\n【中優先度（新着）】:" if analysis.incremental else "\n【中優先度】:")
+                for i, row in enumerate(medium_opportunities[:5]):
+                    content = row['メッセージ内容'][:50]
+                    print(f"- {row['タイムスタンプ']} | {row['ユーザー名']} | {content}")
+
+            return high_opportunities, medium_opportunities
+
     except Exception as e:
         print(f"分析エラー: {e}")
         return None, None
 
-def generate_customer_summary():
-    """顧客サマリーを生成"""
-    csv_file = os.path.join(os.path.dirname(__file__), 'customer_data.csv')
-    
-    if not os.path.exists(csv_file):
-        print("CSVファイルが見つかりません")
+def generate_customer_summary(analysis=None, customers=None):
+    """顧客サマリーを生成
+
+    顧客別の集計はサーバーが更新している顧客テーブルを読み取り専用で読む
+    （まだ作成されていなければ顧客別の表示を省く。customersに顧客テーブルを渡すとそれを読む）。
+    """
+    analysis = analysis or run_analysis()
+
+    if analysis is None:
+        print("顧客データが見つかりません")
         return None
-    
+
     try:
-        user_stats = defaultdict(lambda: {'count': 0, 'last_message': ''})
-        monetization_stats = defaultdict(int)
-        reply_stats = defaultdict(int)
-        
-        with open(csv_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                user_name = row['ユーザー名']
-                user_stats[user_name]['count'] += 1
-                user_stats[user_name]['last_message'] = row['タイムスタンプ']
-                
-                monetization_stats[row['マネタイズ機会']] += 1
-                reply_stats[row['返信ステータス']] += 1
-        
-        print("\n=== 顧客別サマリー ===")
-        sorted_users = sorted(user_stats.items(), key=lambda x: x[1]['count'], reverse=True)
-        for user, stats in sorted_users:
-            print(f"{user}: {stats['count']}件 (最終: {stats['last_message']})")
-        
-        print("\n=== マネタイズ機会別統計 ===")
-        for level, count in monetization_stats.items():
-            print(f"{level}: {count}件")
-        
-        print("\n=== 返信ステータス別統計 ===")
-        for status, count in reply_stats.items():
-            print(f"{status}: {count}件")
-        
-        return user_stats
-    
+        with _timed(analysis, 'customer_summary'):
+            rows = customers.customers() if customers is not None else read_customers()
+
+            print("\n=== 顧客別サマリー ===")
+            if rows is None:
+                print("顧客テーブルがまだ作成されていないため省略します（python customers.py rebuild で作成できます）")
+                rows = []
+            for customer in rows:
+                state = '' if customer['followed'] else '（ブロック/削除）'
+                print(f"{customer['user_name']}{state}: {customer['message_count']}件 (最終: {customer['last_seen']})")
+
+            print("\n=== マネタイズ機会別統計 ===")
+            for level, count in analysis.monetization_stats.items():
+                print(f"{level}: {count}件")
+
+            print("\n=== 返信ステータス別統計 ===")
+            for status, count in analysis.reply_stats.items():
+                print(f"{status}: {count}件")
+
+            return rows
+
     except Exception as e:
         print(f"サマリー生成エラー: {e}")
         return None
 
-def generate_recommendations():
+def generate_recommendations(analysis=None):
     """おすすめアクションを生成"""
-    csv_file = os.path.join(os.path.dirname(__file__), 'customer_data.csv')
-    
-    if not os.path.exists(csv_file):
+    analysis = analysis or run_analysis()
+
+    if analysis is None:
         return
-    
+
     try:
-        needs_reply_count = 0
-        high_opportunities_count = 0
-        user_last_message = {}
-        new_followers_count = 0
-        
-        with open(csv_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row['返信ステータス'] == '要返信':
-                    needs_reply_count += 1
-                
-                if row['マネタイズ機会'] == '高':
-                    high_opportunities_count += 1
-                
-                user_name = row['ユーザー名']
-                timestamp = datetime.strptime(row['タイムスタンプ'], '%Y-%m-%d %H:%M:%S')
-                if user_name not in user_last_message or timestamp > user_last_message[user_name]:
-                    user_last_message[user_name] = timestamp
-                
-                if row['メッセージタイプ'] == 'follow':
-                    new_followers_count += 1
-        
-        print("\n=== おすすめアクション ===")
-        
-        if needs_reply_count > 0:
-            print(f"\n1. 【緊急】{needs_reply_count}件の返信漏れがあります")
-            print("   → 優先的に返信してください")
-        
-        if high_opportunities_count > 0:
-            print(f"\n2. 【重要】{high_opportunities_count}件の高優先度マネタイズ機会があります")
-            print("   → 見積もりや提案を送ることをおすすめします")
-        
-        inactive_users = 0
-        now = datetime.now()
-        for user, last_msg in user_last_message.items():
-            if now - last_msg > timedelta(days=30):
-                inactive_users += 1
-        
-        if inactive_users > 0:
-            print(f"\n3. 【フォローアップ】{inactive_users}名の顧客が30日以上連絡なし")
-            print("   → フォローアップメッセージを送ることをおすすめします")
-        
-        if new_followers_count > 0:
-            print(f"\n4. 【ウェルカム】{new_followers_count}名の新規フォロワー")
-            print("   → ウェルカムメッセージを送ることをおすすめします")
-    
+        with _timed(analysis, 'recommendations'):
+            needs_reply_count = analysis.needs_reply_count
+            high_opportunities_count = analysis.high_count
+            new_followers_count = analysis.new_followers_count
+
+            print("\n=== おすすめアクション ===")
+
+            if needs_reply_count > 0:
+                print(f"\n1. 【緊急】{needs_reply_count}件の返信漏れがあります")
+                print("   → 優先的に返信してください")
+
+            if high_opportunities_count > 0:
+                print(f"\n2. 【重要】{high_opportunities_count}件の高優先度マネタイズ機会があります")
+                print("   → 見積もりや提案を送ることをおすすめします")
+
+            inactive_users = analysis.inactive_users(days=30)
+
+            if inactive_users > 0:
+                print(f"\n3. 【フォローアップ】{inactive_users}名の顧客が30日以上連絡なし")
+                print("   → フォローアップメッセージを送ることをおすすめします")
+
+            if new_followers_count > 0:
+                print(f"\n4. 【ウェルカム】{new_followers_count}名の新規フォロワー")
+                print("   → ウェルカムメッセージを送ることをおすすめします")
+
     except Exception as e:
         print(f"推奨アクション生成エラー: {e}")
 
+def print_timings(analysis):
+    """処理時間のサマリーを表示"""
+    print("\n=== 処理時間 ===")
+    print(f"走査した行数: {analysis.new_rows}件（集計対象: {analysis.total_rows}件）")
+    total = 0.0
+    for name, seconds in analysis.timings.items():
+        total += seconds
+        print(f"{name}: {seconds * 1000:.1f}ms")
+    print(f"合計: {total * 1000:.1f}ms")
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LINE顧客管理システム - 分析レポート')
+    parser.add_argument('--timing', action='store_true', help='処理時間のサマリーを表示')
+    parser.add_argument('--incremental', action='store_true', help='前回のチェックポイント以降の行だけを読む')
+    parser.add_argument('--rebuild', action='store_true', help='チェックポイントを使わず全件から集計し直す（--incrementalと併用）')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH, help='チェックポイントファイルのパス')
+    args = parser.parse_args()
+
     print("=" * 60)
     print("LINE顧客管理システム - 分析レポート")
     print("=" * 60)
-    
-    analyze_reply_status()
-    analyze_monetization_opportunities()
-    generate_customer_summary()
-    generate_recommendations()
-    
+
+    # データを1回だけ走査し、すべてのレポートで共有する
+    if args.incremental:
+        analysis = run_incremental_analysis(path=args.checkpoint, rebuild=args.rebuild)
+        if analysis is not None:
+            print(f"新着: {analysis.new_rows}件")
+    else:
+        analysis = run_analysis()
+
+    if analysis is None:
+        print("顧客データが見つかりません")
+    else:
+        analyze_reply_status(analysis)
+        analyze_monetization_opportunities(analysis)
+        generate_customer_summary(analysis)
+        generate_recommendations(analysis)
+
+        if args.timing:
+            print_timings(analysis)
+
     print("\n" + "=" * 60)
     print("分析完了")
     print("=" * 60)
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""asyncio版のWebhook受信サーバー（WEBHOOK_MODE=async）
+
+/webhookはイベントループ上で受け付け、プロフィール取得も非同期に行う（返信は送信キューに保存）。
+それ以外のルートはwebhook_serverのFlaskアプリをスレッドで実行して返す。
+aiohttpが必要（pip install -r requirements-async.txt）。
+"""
+
+import io
+import os
+import json
+import sys
+import asyncio
+import threading
+import time
+from datetime import datetime
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:  # pragma: no cover
+    aiohttp = None
+    web = None
+
+import metrics
+from rate_limit import retry_after_seconds
+import webhook_server as ws
+from line_api import (
+    LINE_API_BASE_URL, LINE_API_POOL_SIZE, LINE_API_CONNECT_TIMEOUT,
+    LINE_API_READ_TIMEOUT, LINE_API_RETRIES, LINE_API_BACKOFF,
+)
+
+
+# 同時に処理するイベント数と、受け付けて処理待ちにできるイベント数の上限
+ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', '64'))
+ASYNC_MAX_PENDING = int(os.environ.get('ASYNC_MAX_PENDING', str(ws.WEBHOOK_QUEUE_SIZE)))
+
+# リトライ対象のステータスコード
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# Flaskアプリに渡さないホップバイホップヘッダー
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade',
+])
+
+
+class AsyncLineApiClient:
+    """aiohttpの接続プールを共有する非同期LINE Messaging APIクライアント"""
+
+    def __init__(self, access_token, base_url=LINE_API_BASE_URL, pool_size=LINE_API_POOL_SIZE,
+                 connect_timeout=LINE_API_CONNECT_TIMEOUT, read_timeout=LINE_API_READ_TIMEOUT,
+                 retries=LINE_API_RETRIES, backoff_factor=LINE_API_BACKOFF, rate_limiter=None):
+        self.access_token = access_token
+        self.rate_limiter = rate_limiter
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._session = None
+
+    def _get_session(self):
+        """セッションを作成（イベントループ上で遅延作成）"""
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=self.timeout,
+                headers={'Authorization': f'Bearer {self.access_token}'},
+            )
+        return self._session
+
+    async def request(self, method, path, json=None, headers=None):
+        """リクエストを送信して(ステータスコード, 本文)を返す
+
+        429/5xx・接続エラーはバックオフ付きでリトライする。GET以外はリトライキー付きのときだけ
+        リトライする（同じキーの再送は409になり重複しない）。
+        """
+        session = self._get_session()
+        retryable = method == 'GET' or bool(headers and 'X-Line-Retry-Key' in headers)
+        endpoint = metrics.line_api_endpoint(path)
+        started = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            last = attempt >= self.retries or not retryable
+            await self._acquire(endpoint)
+            try:
+                async with session.request(method, f'{self.base_url}{path}', json=json, headers=headers) as response:
+                    body = await response.read()
+                    delay = retry_after_seconds(response.headers)
+                    if response.status == 429 and self.rate_limiter is not None:
+                        await self._call_limiter(self.rate_limiter.penalize, endpoint, delay)
+                    if response.status not in RETRY_STATUSES or last:
+                        metrics.record_line_api(path, response.status, time.perf_counter() - started)
+                        return response.status, body
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if last:
+                    metrics.record_line_api(path, 'error', time.perf_counter() - started)
+                    raise
+                delay = None
+            if delay is None:
+                delay = self.backoff_factor * (2 ** attempt)
+            await asyncio.sleep(delay)
+
+    async def _acquire(self, endpoint, priority='interactive'):
+        """共有のレート制限の送信枠をイベントループを止めずに待つ"""
+        if self.rate_limiter is None:
+            return
+        started = time.monotonic()
+        wait = await self._call_limiter(self.rate_limiter.try_acquire, endpoint, priority)
+        while wait > 0:
+            await asyncio.sleep(min(wait, 0.5))
+            wait = await self._call_limiter(self.rate_limiter.try_acquire, endpoint, priority)
+        self.rate_limiter.record_wait(endpoint, priority, time.monotonic() - started)
+
+    async def _call_limiter(self, func, *args):
+        """レート制限の状態を更新する（SQLiteで共有している場合はBEGIN IMMEDIATEで待つためスレッドで実行）"""
+        if self.rate_limiter.path:
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+        return func(*args)
+
+    async def get_profile(self, user_id):
+        """ユーザープロフィールを取得"""
+        return await self.request('GET', f'/v2/bot/profile/{user_id}')
+
+    async def push_message(self, to, messages, retry_key=None):
+        """プッシュメッセージを送信"""
+        headers = {'X-Line-Retry-Key': retry_key} if retry_key else None
+        return await self.request('POST', '/v2/bot/message/push', json={
+            'to': to,
+            'messages': messages
+        }, headers=headers)
+
+    async def close(self):
+        """接続プールを閉じる"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncIngest:
+    """Webhookイベントをイベントループ上で並行処理する（同時実行数と処理待ち数に上限あり）"""
+
+    def __init__(self, client, concurrency=ASYNC_CONCURRENCY, max_pending=ASYNC_MAX_PENDING):
+        self.client = client
+        self.concurrency = max(1, int(concurrency))
+        self.max_pending = max(1, int(max_pending))
+
+        self.loop = None
+        self._semaphore = None
+        self._tasks = set()
+        self._profile_flights = {}
+        self._lock = threading.Lock()
+
+        self._pending = 0
+        self._active = 0
+        self._processed = 0
+        self._rejected = 0
+
+    def bind(self, loop):
+        """イベントループに関連付ける（起動時に呼ぶ）"""
+        self.loop = loop
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    def submit(self, event):
+        """イベントを処理待ちに投入（どのスレッドからでも呼べる。満杯ならFalse）"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._rejected += 1
+                return False
+            self._pending += 1
+        self.loop.call_soon_threadsafe(self._spawn, event)
+        return True
+
+    def _spawn(self, event):
+        task = self.loop.create_task(self._run(event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, event):
+        try:
+            async with self._semaphore:
+                with self._lock:
+                    self._active += 1
+                try:
+                    await self.process_event(event)
+                finally:
+                    with self._lock:
+                        self._active -= 1
+                        self._processed += 1
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    async def process_event(self, event):
+        """Webhookイベントを処理（webhook_server.process_webhook_eventと同じ処理順・記録内容）"""
+        started = time.perf_counter()
+        result = 'processed'
+        try:
+            if event['type'] == 'message':
+                # メッセージイベント
+                user_id = event['source']['userId']
+                print(f"📨 メッセージ受信: user_id={user_id}, type={event['message']['type']}")
+
+                # ユーザープロフィール取得
+                user_name = await self.get_user_profile(user_id)
+                data, auto_reply = ws.build_message_record(event, user_name)
+
+                # キーワードベースの自動返信
+                if auto_reply:
+                    await self.send_reply_message(user_id, auto_reply)
+                    print(f"🤖 自動返信送信: {user_name}")
+
+                await self.save_record(data)
+
+                print(f"✅ メッセージ記録完了: {user_name} - {data[4]}")
+
+            elif event['type'] == 'follow':
+                # フォローイベント
+                user_id = event['source']['userId']
+                print(f"👤 新規フォロー: user_id={user_id}")
+
+                user_name = await self.get_user_profile(user_id)
+                await self.save_record(ws.build_follow_record(event, user_name))
+
+                # 自動挨拶メッセージを送信
+                await self.send_reply_message(user_id, ws.welcome_message(user_name), kind='welcome')
+
+                print(f"✅ 新規フォロー記録: {user_name}")
+
+            elif event['type'] == 'unfollow':
+                # アンフォローイベント
+                user_id = event['source']['userId']
+                print(f"👋 アンフォロー: user_id={user_id}")
+
+                await self.save_record(ws.build_unfollow_record(event))
+
+                print(f"✅ アンフォロー記録: {user_id}")
+
+        except Exception as e:
+            result = 'failed'
+            print(f"❌ イベント処理エラー: {e}")
+            import traceback
+            traceback.print_exc()
+
+        metrics.record_event(event.get('type'), result, time.perf_counter() - started)
+
+    async def get_user_profile(self, user_id):
+        """ユーザー名を取得（プロフィールキャッシュを共有し、同時取得は1回にまとめる）"""
+        started = time.perf_counter()
+        found, name = ws.profile_cache.lookup(user_id)
+        if not found:
+            flight = self._profile_flights.get(user_id)
+            if flight is not None:
+                ws.profile_cache.record_miss(coalesced=True)
+                name = await asyncio.shield(flight)
+            else:
+                ws.profile_cache.record_miss()
+                flight = self.loop.create_future()
+                self._profile_flights[user_id] = flight
+                name = None
+                try:
+                    name = await self._fetch_user_profile(user_id)
+                finally:
+                    ws.profile_cache.put(user_id, name)
+                    del self._profile_flights[user_id]
+                    flight.set_result(name)
+        metrics.STAGE_PROFILE.observe(time.perf_counter() - started)
+        return name if name is not None else 'Unknown'
+
+    async def _fetch_user_profile(self, user_id):
+        """LINE APIからユーザー名を取得（失敗時はNone）"""
+        try:
+            status, body = await self.client.get_profile(user_id)
+            if status == 200:
+                return json.loads(body).get('displayName', 'Unknown')
+            print(f"⚠️ プロフィール取得失敗: {status}")
+        except Exception as e:
+            print(f"❌ プロフィール取得エラー: {e}")
+        return None
+
+    async def save_record(self, data):
+        """記録を書き込みキューに投入（キューが満杯なら空くまで待つためスレッドで行う）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, ws.save_record, data)
+
+    async def send_reply_message(self, user_id, text, kind='reply'):
+        """送信キューに保存（SQLiteへの書き込みはスレッドで行い、送信は送信スレッドに任せる）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, ws.send_reply_message, user_id, text, kind)
+
+    async def drain(self, timeout):
+        """処理中・処理待ちのイベントが終わるまで待つ"""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    def stats(self):
+        """処理状況を返す"""
+        with self._lock:
+            return {
+                'concurrency': self.concurrency,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'active': self._active,
+                'processed': self._processed,
+                'rejected': self._rejected,
+            }
+
+
+async def webhook(request):
+    """LINEからのWebhookを受信（イベントループ上で受け付けて即座に200を返す）"""
+    ingest = request.app['ingest']
+    started = time.perf_counter()
+
+    print(f"🔔 Webhook受信: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    signature = request.headers.get('X-Line-Signature', '')
+    body = (await request.read()).decode('utf-8')
+
+    print(f"📝 Body length: {len(body)}")
+
+    with metrics.STAGE_SIGNATURE.time():
+        valid = ws.verify_signature(body, signature)
+    if not valid:
+        print(f"❌ 署名検証失敗")
+        _record_webhook_request(started, 400)
+        raise web.HTTPBadRequest()
+    elif ws.CHANNEL_SECRET:
+        print(f"✅ 署名検証成功")
+
+    # 重複除外はSQLiteに書き込むためスレッドで実行する
+    with metrics.STAGE_DISPATCH.time():
+        await asyncio.get_running_loop().run_in_executor(None, ws.dispatch_events, body, ingest.submit)
+
+    print(f"✅ 200 OK返信")
+    _record_webhook_request(started, 200)
+    return web.Response(text='OK')
+
+
+def _record_webhook_request(started, status):
+    """/webhookの処理時間と件数を記録（Flaskを通らないためここで記録する）"""
+    metrics.HTTP_REQUEST_SECONDS.labels('/webhook', 'POST').observe(time.perf_counter() - started)
+    metrics.HTTP_REQUESTS.labels('/webhook', 'POST', status).inc()
+
+
+def _wsgi_environ(request, body):
+    """aiohttpのリクエストからWSGI環境変数を作る"""
+    host = request.url.host or 'localhost'
+    port = request.url.port or (443 if request.scheme == 'https' else 80)
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': request.rel_url.raw_query_string,
+        'SERVER_NAME': host,
+        'SERVER_PORT': str(port),
+        'SERVER_PROTOCOL': f'HTTP/{request.version.major}.{request.version.minor}',
+        'REMOTE_ADDR': request.remote or '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        key = name.upper().replace('-', '_')
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[key] = value
+            continue
+        key = f'HTTP_{key}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def flask_bridge(request):
+    """/webhook以外のルートはFlaskアプリをスレッドで実行し、レスポンスを順に流す"""
+    loop = asyncio.get_running_loop()
+    body = await request.read()
+    environ = _wsgi_environ(request, body)
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = status
+        started['headers'] = headers
+
+    def call_app():
+        iterable = ws.app.wsgi_app(environ, start_response)
+        return iterable, iter(iterable)
+
+    iterable, chunks = await loop.run_in_executor(None, call_app)
+    try:
+        # ストリーミングレスポンスでは最初のチャンクを取り出すまでヘッダーが確定しない
+        first = await loop.run_in_executor(None, next, chunks, None)
+        status_code, _, reason = started['status'].partition(' ')
+        response = web.StreamResponse(status=int(status_code), reason=reason or None)
+        for name, value in started['headers']:
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+                response.headers.add(name, value)
+        await response.prepare(request)
+
+        chunk = first
+        while chunk is not None:
+            if chunk:
+                await response.write(chunk)
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+        await response.write_eof()
+        return response
+    finally:
+        if hasattr(iterable, 'close'):
+            await loop.run_in_executor(None, iterable.close)
+
+
+def create_app(client=None, concurrency=ASYNC_CONCURRENCY, max_pending=ASYNC_MAX_PENDING):
+    """asyncio版のアプリケーションを作成"""
+    if web is None:
+        raise RuntimeError('WEBHOOK_MODE=asyncにはaiohttpが必要です（pip install -r requirements-async.txt）')
+
+    client = client or AsyncLineApiClient(ws.CHANNEL_ACCESS_TOKEN, rate_limiter=ws.rate_limiter)
+    ingest = AsyncIngest(client, concurrency=concurrency, max_pending=max_pending)
+    ws.extra_status['async_ingest'] = ingest.stats
+    def queue_depth():
+        stats = ingest.stats()
+        return stats['pending'] - stats['active']
+
+    metrics.registry.gauge(
+        'line_webhook_queue_depth', '処理待ちのWebhookイベント数',
+        queue_depth
+    )
+    metrics.registry.gauge(
+        'line_webhook_in_flight', '処理中のWebhookイベント数',
+        lambda: ingest.stats()['active']
+    )
+
+    app = web.Application(client_max_size=32 * 1024 * 1024)
+    app['ingest'] = ingest
+    app.router.add_post('/webhook', webhook)
+    app.router.add_route('*', '/{tail:.*}', flask_bridge)
+
+    async def on_startup(app):
+        ingest.bind(asyncio.get_running_loop())
+
+    async def on_shutdown(app):
+        # 受け付け済みのイベントを処理し終えてから停止する
+        await ingest.drain(ws.WEBHOOK_SHUTDOWN_TIMEOUT)
+        await client.close()
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def run(port):
+    """asyncio版のサーバーを起動"""
+    app = create_app()
+    print(f"🚀 サーバー起動（asyncio）: ポート {port}, 同時処理数 {ASYNC_CONCURRENCY}")
+    web.run_app(app, host='0.0.0.0', port=port, print=None)
+
+
+if __name__ == '__main__':
+    run(int(os.environ.get('PORT', 5000)))
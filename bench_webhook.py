@@ -0,0 +1,814 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""webhook_serverの負荷試験・ベンチマーク
+
+署名付きのWebhook（message / follow / unfollow）を生成してwebhook_server.appに送り、
+LINE APIはスタブ（stub_line_api.py、遅延・エラー注入あり）に向けて計測する。
+データは一時ディレクトリに作るため、本番のデータには触れない。
+
+    # 毎秒200リクエストを10秒間
+    python bench_webhook.py steady --rate 200 --duration 10
+    # 2000リクエスト（1リクエスト5イベント）を64並列で一気に送る
+    python bench_webhook.py burst --requests 2000 --concurrency 64 --events-per-request 5
+    # 20万行の履歴がある状態で/stats・/search.json・/api/messagesと/broadcastを計測
+    python bench_webhook.py stats --history 200000
+    python bench_webhook.py broadcast --history 200000 --users 20000
+    # asyncモード・LINE API 100ms遅延・5%で500エラー
+    python bench_webhook.py burst --server async --latency 0.1 --error-rate 0.05
+    # 4プロセス（prefork.py）に同時に送り、記録の欠落・重複・破損が無いかを確認
+    python bench_webhook.py multiprocess --processes 4 --storage csv --requests 2000
+"""
+
+import os
+import sys
+import json
+import hmac
+import base64
+import time
+import random
+import shutil
+import signal
+import socket
+import asyncio
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+import contextlib
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+
+import requests
+
+from stub_line_api import StubLineApi
+
+
+# ベンチマーク用のチャネルシークレット
+BENCH_CHANNEL_SECRET = 'bench-channel-secret'
+
+# 生成するテキストメッセージ（自動返信・要返信・マネタイズ判定のキーワードを含む）
+TEXT_TEMPLATES = [
+    'こんにちは',
+    '料金を教えてください',
+    '見積もりをお願いできますか？',
+    '撮影の相談をしたいです',
+    'ありがとうございました',
+    '納期はどれくらいですか？',
+    'YouTube動画の編集もできますか',
+    '了解です',
+    '結婚式の映像をお願いしたいです',
+    '予算は10万円くらいです',
+]
+
+# テキスト以外のメッセージタイプ
+OTHER_MESSAGE_TYPES = ['image', 'sticker', 'video', 'location']
+
+
+def percentile(values, p):
+    """最近傍順位法によるパーセンタイル（valuesはソート済み）"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize_latencies(values):
+    """レイテンシ（秒）の分布をミリ秒で要約"""
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 2),
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p90_ms': round(percentile(values, 90) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+        'max_ms': round(values[-1] * 1000, 2),
+    }
+
+
+def peak_rss_mb():
+    """プロセスの最大常駐メモリ（MB）"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return round(usage / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
+
+
+class PayloadFactory:
+    """署名付きのWebhookリクエストを生成する"""
+
+    def __init__(self, secret, users=1000, follow_ratio=0.05, unfollow_ratio=0.02, seed=1):
+        self.secret = secret.encode('utf-8')
+        self.users = [f'Ubench{i:08d}' for i in range(users)]
+        self.follow_ratio = follow_ratio
+        self.unfollow_ratio = unfollow_ratio
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._seq = 0
+
+    def _next_seq(self):
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def event(self):
+        """イベントを1件生成し、(イベント, 記録の照合キー)を返す"""
+        seq = self._next_seq()
+        with self._lock:
+            roll = self._random.random()
+            user_id = self._random.choice(self.users)
+            text = self._random.choice(TEXT_TEMPLATES)
+            other_type = self._random.choice(OTHER_MESSAGE_TYPES)
+            is_text = self._random.random() < 0.85
+
+        event = {
+            'webhookEventId': f'BENCH{seq:012d}{os.getpid()}',
+            'timestamp': int(time.time() * 1000),
+            'mode': 'active',
+            'deliveryContext': {'isRedelivery': False},
+        }
+        if roll < self.follow_ratio:
+            # 新しいユーザーのフォロー
+            user_id = f'Ufollow{seq:010d}'
+            event.update(type='follow', source={'type': 'user', 'userId': user_id})
+            key = (user_id, 'follow', '[新規フォロー]')
+        elif roll < self.follow_ratio + self.unfollow_ratio:
+            user_id = f'Uunfollow{seq:010d}'
+            event.update(type='unfollow', source={'type': 'user', 'userId': user_id})
+            key = (user_id, 'unfollow', '[ブロック/削除]')
+        elif is_text:
+            text = f'{text}（{seq}）'
+            event.update(type='message', source={'type': 'user', 'userId': user_id},
+                         message={'id': str(seq), 'type': 'text', 'text': text})
+            key = (user_id, 'text', text)
+        else:
+            event.update(type='message', source={'type': 'user', 'userId': user_id},
+                         message={'id': str(seq), 'type': other_type})
+            key = (user_id, other_type, None)
+        return event, key
+
+    def request(self, events_per_request=1):
+        """(本文, 署名, 照合キーのリスト)を返す"""
+        pairs = [self.event() for _ in range(events_per_request)]
+        body = json.dumps({
+            'destination': 'Ubenchbot',
+            'events': [event for event, _ in pairs],
+        }, ensure_ascii=False)
+        signature = base64.b64encode(
+            hmac.new(self.secret, body.encode('utf-8'), hashlib.sha256).digest()
+        ).decode('utf-8')
+        return body, signature, [key for _, key in pairs]
+
+
+class CompletionTracker:
+    """送信したイベントが記録として書き込まれるまでの時間を計測する"""
+
+    def __init__(self):
+        self._sent = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.latencies = []
+
+    def sent(self, keys, at):
+        with self._lock:
+            for key in keys:
+                self._sent[key].append(at)
+            self._pending += len(keys)
+
+    def written(self, records, at):
+        with self._lock:
+            for record in records:
+                user_id, message_type, content = record[1], record[3], record[4]
+                key = (user_id, message_type, content if message_type in ('text', 'follow', 'unfollow') else None)
+                times = self._sent.get(key)
+                if not times:
+                    continue
+                self.latencies.append(at - times.popleft())
+                if not times:
+                    del self._sent[key]
+                self._pending -= 1
+
+    @property
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def wait(self, idle_timeout):
+        """すべて書き込まれるか、idle_timeout秒進捗が無くなるまで待つ"""
+        last_pending = self.pending
+        last_progress = time.monotonic()
+        while last_pending > 0:
+            time.sleep(0.05)
+            pending = self.pending
+            if pending != last_pending:
+                last_pending = pending
+                last_progress = time.monotonic()
+            elif time.monotonic() - last_progress > idle_timeout:
+                break
+        return last_pending
+
+    def reset(self):
+        with self._lock:
+            self._sent.clear()
+            self._pending = 0
+            self.latencies = []
+
+
+class BenchServer:
+    """webhook_server.appを一時ディレクトリのデータでローカルポートに起動する"""
+
+    def __init__(self, mode, stub, workdir):
+        self.mode = mode
+        self.stub = stub
+        self.workdir = workdir
+        self.tracker = CompletionTracker()
+        self._stop = None
+
+        # webhook_serverの読み込み前に接続先・保存先を差し替える
+        os.environ.update({
+            'LINE_CHANNEL_SECRET': BENCH_CHANNEL_SECRET,
+            'LINE_CHANNEL_ACCESS_TOKEN': 'bench-access-token',
+            'LINE_API_BASE_URL': stub.base_url,
+            'WEBHOOK_MODE': mode,
+            'DB_PATH': os.path.join(workdir, 'customer_data.db'),
+            'CSV_PATH': os.path.join(workdir, 'customer_data.csv'),
+            'PARTITION_DIR': os.path.join(workdir, 'partitions'),
+            'EXPORT_CACHE_DIR': os.path.join(workdir, 'export_cache'),
+            'EVENT_DEDUP_PATH': os.path.join(workdir, 'webhook_events.db'),
+            'OUTBOX_PATH': os.path.join(workdir, 'outbox.db'),
+            'CUSTOMERS_PATH': os.path.join(workdir, 'customers.db'),
+            'SEARCH_INDEX_PATH': os.path.join(workdir, 'search_index.db'),
+            'PROFILE_CACHE_PATH': '',
+        })
+        import webhook_server
+        self.ws = webhook_server
+
+        # 書き込み完了を計測するためにストレージの書き込みを包む
+        storage = webhook_server.storage
+        append_many = storage.append_many
+        tracker = self.tracker
+
+        def tracked_append_many(records, fsync=None):
+            append_many(records, fsync=fsync)
+            tracker.written(records, time.monotonic())
+
+        self._append_many = append_many
+        storage.append_many = tracked_append_many
+
+    def preload(self, rows, users, days=365, seed=2):
+        """履歴データをストレージに直接書き込み、書き込みスレッドと同じ後処理を行う
+
+        書き込みのたびにapply_written_records（集計値・顧客テーブル・検索インデックスへの反映と
+        データの版の更新）を呼ぶので、キャッシュされたページや索引にも履歴が反映される。
+        """
+        rnd = random.Random(seed)
+        now = datetime.now()
+        user_ids = [f'Uhist{i:08d}' for i in range(users)]
+        statuses = ['要返信', '確認済み', '返信不要']
+        levels = ['高', '中', '低', '要確認', '-']
+        load_seconds = apply_seconds = 0.0
+        batch = []
+        for i in range(rows):
+            timestamp = now - timedelta(seconds=rnd.randint(0, days * 86400))
+            user_id = user_ids[i % users] if i < users else rnd.choice(user_ids)
+            batch.append([
+                timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                user_id,
+                f'履歴{user_id[-4:]}',
+                'text',
+                rnd.choice(TEXT_TEMPLATES),
+                rnd.choice(statuses),
+                rnd.choice(levels),
+                '',
+            ])
+            if len(batch) >= 10000 or i == rows - 1:
+                started = time.perf_counter()
+                self._append_many(batch, fsync='none')
+                load_seconds += time.perf_counter() - started
+
+                started = time.perf_counter()
+                self.ws.apply_written_records(batch)
+                apply_seconds += time.perf_counter() - started
+                batch = []
+        return {'rows': rows, 'users': users, 'load_seconds': round(load_seconds, 2),
+                'apply_seconds': round(apply_seconds, 3),
+                'data_version': self.ws.data_version.current()[0]}
+
+    def start(self):
+        """バックグラウンドスレッドでサーバーを起動してURLを返す"""
+        if self.mode == 'async':
+            import async_server
+            from aiohttp import web
+
+            loop = asyncio.new_event_loop()
+            runner = web.AppRunner(async_server.create_app())
+            loop.run_until_complete(runner.setup())
+            site = web.TCPSite(runner, '127.0.0.1', 0, backlog=1024)
+            loop.run_until_complete(site.start())
+            port = runner.addresses[0][1]
+            thread = threading.Thread(target=loop.run_forever, name='bench-async-server', daemon=True)
+            thread.start()
+
+            def stop():
+                asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result(60)
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join(5)
+        else:
+            import logging
+            from werkzeug.serving import make_server
+
+            # アクセスログは計測のノイズになるので出さない
+            logging.getLogger('werkzeug').setLevel(logging.ERROR)
+            server = make_server('127.0.0.1', 0, self.ws.app, threaded=True)
+            port = server.server_port
+            thread = threading.Thread(target=server.serve_forever, name='bench-server', daemon=True)
+            thread.start()
+
+            def stop():
+                server.shutdown()
+
+        self._stop = stop
+        return f'http://127.0.0.1:{port}'
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop()
+            self._stop = None
+
+
+def run_clients(total, concurrency, send, rate=None):
+    """total回のsend(index)をconcurrencyスレッドで実行（rate指定時は毎秒rate回に揃える）"""
+    counter = iter(range(total))
+    lock = threading.Lock()
+    started = time.monotonic()
+    max_lag = [0.0]
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                break
+            if rate:
+                scheduled = started + index / rate
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    with lock:
+                        max_lag[0] = max(max_lag[0], -delay)
+            send(session, index)
+        session.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - started, max_lag[0]
+
+
+def bench_ingest(server, url, factory, requests_total, concurrency, events_per_request,
+                 rate=None, idle_timeout=10.0):
+    """Webhookを送信して受信応答と記録完了までの時間を計測"""
+    server.tracker.reset()
+    ack_latencies = []
+    statuses = defaultdict(int)
+    lock = threading.Lock()
+
+    # 送信データは事前に生成しておき、計測に含めない
+    payloads = [factory.request(events_per_request) for _ in range(requests_total)]
+
+    def send(session, index):
+        body, signature, keys = payloads[index]
+        started = time.monotonic()
+        server.tracker.sent(keys, started)
+        try:
+            response = session.post(f'{url}/webhook', data=body.encode('utf-8'), headers={
+                'Content-Type': 'application/json',
+                'X-Line-Signature': signature,
+            }, timeout=30)
+            status = response.status_code
+        except requests.RequestException:
+            status = 'error'
+        elapsed = time.monotonic() - started
+        with lock:
+            ack_latencies.append(elapsed)
+            statuses[status] += 1
+
+    elapsed, max_lag = run_clients(requests_total, concurrency, send, rate)
+    send_finished = time.monotonic()
+    lost = server.tracker.wait(idle_timeout)
+    drained = time.monotonic() - send_finished
+    events_total = requests_total * events_per_request
+
+    return {
+        'requests': requests_total,
+        'events': events_total,
+        'concurrency': concurrency,
+        'target_rate': rate,
+        'send_seconds': round(elapsed, 3),
+        'drain_seconds': round(drained, 3),
+        'ack_throughput_rps': round(requests_total / elapsed, 1) if elapsed else None,
+        'processed_events_per_second': round((events_total - lost) / (elapsed + drained), 1),
+        'max_schedule_lag_ms': round(max_lag * 1000, 1) if rate else None,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'ack_latency': summarize_latencies(ack_latencies),
+        'end_to_end_latency': summarize_latencies(server.tracker.latencies),
+        'unprocessed_events': lost,
+    }
+
+
+def bench_get(url, path, requests_total, concurrency):
+    """GETリクエストのレイテンシを計測"""
+    latencies = []
+    statuses = defaultdict(int)
+    lock = threading.Lock()
+
+    def send(session, index):
+        started = time.monotonic()
+        response = session.get(f'{url}{path}', timeout=120)
+        response.content
+        elapsed = time.monotonic() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[response.status_code] += 1
+
+    elapsed, _ = run_clients(requests_total, concurrency, send)
+    return {
+        'path': path,
+        'requests': requests_total,
+        'throughput_rps': round(requests_total / elapsed, 1) if elapsed else None,
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'latency': summarize_latencies(latencies),
+    }
+
+
+def bench_broadcast(server, url, stub, target_type='all', timeout=600):
+    """配信ジョブを登録し、完了までの時間を計測"""
+    before = stub.stats()
+    session = requests.Session()
+    started = time.monotonic()
+    response = session.post(f'{url}/broadcast', data={
+        'message': 'ベンチマーク配信です',
+        'target_type': target_type,
+    }, allow_redirects=False, timeout=120)
+    submit_seconds = time.monotonic() - started
+
+    location = response.headers.get('Location', '')
+    if response.status_code != 303 or '/broadcast/jobs/' not in location:
+        return {'error': f'配信ジョブを登録できませんでした: {response.status_code}'}
+    job_id = location.rstrip('/').rsplit('/', 1)[-1]
+
+    progress = {}
+    while time.monotonic() - started < timeout:
+        progress = session.get(f'{url}/broadcast/jobs/{job_id}/status', timeout=30).json()
+        if progress.get('status') in ('completed', 'failed'):
+            break
+        time.sleep(0.05)
+    total_seconds = time.monotonic() - started
+    session.close()
+
+    after = stub.stats()
+    multicasts = {key: count - before.get(key, 0) for key, count in after.items()
+                  if 'multicast' in key and count - before.get(key, 0)}
+    return {
+        'job_id': job_id,
+        'status': progress.get('status'),
+        'recipients': progress.get('total'),
+        'sent': progress.get('sent'),
+        'failed': progress.get('failed'),
+        'submit_ms': round(submit_seconds * 1000, 1),
+        'total_seconds': round(total_seconds, 3),
+        'recipients_per_second': round(progress.get('total', 0) / total_seconds, 1) if total_seconds else None,
+        'multicast_requests': multicasts,
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _multiprocess_env(stub, statedir, processes, storage_backend):
+    """prefork.pyに渡す環境変数（共有状態はすべて一時ディレクトリに置く）"""
+    return dict(
+        os.environ,
+        LINE_CHANNEL_SECRET=BENCH_CHANNEL_SECRET,
+        LINE_CHANNEL_ACCESS_TOKEN='bench-access-token',
+        LINE_API_BASE_URL=stub.base_url,
+        WEBHOOK_MODE='threaded',
+        WEBHOOK_PROCESSES=str(processes),
+        STORAGE_BACKEND=storage_backend,
+        DB_PATH=os.path.join(statedir, 'customer_data.db'),
+        CSV_PATH=os.path.join(statedir, 'customer_data.csv'),
+        PARTITION_DIR=os.path.join(statedir, 'partitions'),
+        EXPORT_CACHE_DIR=os.path.join(statedir, 'export_cache'),
+        EVENT_DEDUP_PATH=os.path.join(statedir, 'webhook_events.db'),
+        OUTBOX_PATH=os.path.join(statedir, 'outbox.db'),
+        CUSTOMERS_PATH=os.path.join(statedir, 'customers.db'),
+        SEARCH_INDEX_PATH=os.path.join(statedir, 'search_index.db'),
+        LINE_RATE_LIMIT_PATH=os.path.join(statedir, 'rate_limit.db'),
+        BROADCAST_JOBS_PATH=os.path.join(statedir, 'broadcast_jobs.db'),
+        PROFILE_CACHE_SHARED_PATH=os.path.join(statedir, 'profile_cache.db'),
+        DATA_VERSION_PATH=os.path.join(statedir, 'data_version.json'),
+        PROFILE_CACHE_PATH='',
+        PYTHONUNBUFFERED='1',
+    )
+
+
+def check_unsafe_config_refused(stub, workdir, log):
+    """共有できない設定（重複除外がメモリのみ）で起動が中止されることを確認"""
+    statedir = os.path.join(workdir, 'refused')
+    os.makedirs(statedir, exist_ok=True)
+    env = _multiprocess_env(stub, statedir, 2, 'sqlite')
+    env['EVENT_DEDUP_PATH'] = ''
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prefork.py'),
+         '--host', '127.0.0.1', '--port', str(_free_port())],
+        env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    try:
+        code = process.wait(60)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        code = None
+    return {'exit_code': code, 'refused': code not in (0, None), 'seconds': round(time.monotonic() - started, 2)}
+
+
+def bench_multiprocess(stub, workdir, factory, processes, storage_backend, requests_total, concurrency,
+                       events_per_request, duplicate_ratio=0.1, idle_timeout=10.0, log=None):
+    """prefork.pyで複数プロセスを起動して同時にWebhookを送り、記録の欠落・重複・破損が無いかを確認
+
+    一部のリクエストは同じwebhookEventIdのまま別の接続から再送し、別のプロセスに届いても
+    1回しか記録されないことを確かめる。
+    """
+    from storage import SQLiteStorage, CsvStorage, PartitionedStorage, PARTITION_GRANULARITY, CSV_HEADER
+    from customers import CustomerTable
+
+    statedir = os.path.join(workdir, f'multiprocess_{storage_backend}')
+    os.makedirs(statedir, exist_ok=True)
+    env = _multiprocess_env(stub, statedir, processes, storage_backend)
+    port = _free_port()
+    url = f'http://127.0.0.1:{port}'
+    launcher = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prefork.py'),
+         '--processes', str(processes), '--host', '127.0.0.1', '--port', str(port)],
+        env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    try:
+        # すべてのワーカーが起動するまで待つ
+        deadline = time.monotonic() + 60
+        pids = set()
+        while time.monotonic() < deadline and len(pids) < processes:
+            if launcher.poll() is not None:
+                return {'error': f'起動に失敗しました（終了コード={launcher.returncode}）'}
+            try:
+                pids.add(requests.get(f'{url}/status', timeout=5).json()['process']['pid'])
+            except requests.RequestException:
+                time.sleep(0.1)
+
+        payloads = [factory.request(events_per_request) for _ in range(requests_total)]
+        rnd = random.Random(3)
+        duplicates = [rnd.randrange(requests_total) for _ in range(int(requests_total * duplicate_ratio))]
+        sends = list(range(requests_total)) + duplicates
+        rnd.shuffle(sends)
+        statuses = defaultdict(int)
+        lock = threading.Lock()
+
+        def send(session, index):
+            body, signature, _ = payloads[sends[index]]
+            # 接続を使い回さず、リクエストごとに別のプロセスが受け付けうるようにする
+            try:
+                status = requests.post(f'{url}/webhook', data=body.encode('utf-8'), headers={
+                    'Content-Type': 'application/json',
+                    'X-Line-Signature': signature,
+                }, timeout=30).status_code
+            except requests.RequestException:
+                status = 'error'
+            with lock:
+                statuses[status] += 1
+
+        elapsed, _ = run_clients(len(sends), concurrency, send)
+
+        # 全プロセスの記録が顧客テーブルに反映されるまで待つ
+        expected = requests_total * events_per_request
+        total, last_total, last_progress = 0, -1, time.monotonic()
+        while total < expected and time.monotonic() - last_progress < idle_timeout:
+            total = requests.get(f'{url}/stats.json', timeout=30).json()['total_messages']
+            if total != last_total:
+                last_total, last_progress = total, time.monotonic()
+            time.sleep(0.1)
+    finally:
+        launcher.send_signal(signal.SIGTERM)
+        try:
+            launcher.wait(120)
+        except subprocess.TimeoutExpired:
+            launcher.kill()
+
+    # 停止後にストレージを直接読んで照合する
+    if storage_backend == 'sqlite':
+        storage = SQLiteStorage(env['DB_PATH'])
+    elif storage_backend == 'csv':
+        storage = CsvStorage(env['CSV_PATH'])
+    else:
+        storage = PartitionedStorage(env['PARTITION_DIR'], PARTITION_GRANULARITY)
+    expected_keys = defaultdict(int)
+    for index in range(requests_total):
+        for key in payloads[index][2]:
+            expected_keys[key] += 1
+    found_keys = defaultdict(int)
+    malformed = 0
+    rows = 0
+    for row in storage.iter_rows():
+        rows += 1
+        if None in row or any(row.get(label) is None for label in CSV_HEADER):
+            malformed += 1
+            continue
+        message_type = row['メッセージタイプ']
+        content = row['メッセージ内容'] if message_type in ('text', 'follow', 'unfollow') else None
+        found_keys[(row['ユーザーID'], message_type, content)] += 1
+    missing = sum(max(0, count - found_keys.get(key, 0)) for key, count in expected_keys.items())
+    extra = sum(max(0, count - expected_keys.get(key, 0)) for key, count in found_keys.items())
+
+    table = CustomerTable(storage, env['CUSTOMERS_PATH'])
+    table.catch_up()
+    summary = table.summary()
+    table.close()
+
+    return {
+        'processes': processes,
+        'worker_pids_seen': len(pids),
+        'storage': storage_backend,
+        'requests': len(sends),
+        'duplicate_deliveries': len(duplicates),
+        'events': expected,
+        'send_seconds': round(elapsed, 3),
+        'throughput_rps': round(len(sends) / elapsed, 1) if elapsed else None,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'stored_rows': rows,
+        'missing_rows': missing,
+        'duplicated_rows': extra,
+        'malformed_rows': malformed,
+        'customer_table_rows': summary['total_messages'],
+        'ok': rows == expected and missing == 0 and extra == 0 and malformed == 0
+              and summary['total_messages'] == expected,
+    }
+
+
+def print_result(name, result, indent=0):
+    """結果を見やすく表示"""
+    pad = '  ' * indent
+    if indent == 0:
+        print(f"\n📊 {name}")
+        print('=' * 60)
+    for key, value in result.items():
+        if isinstance(value, dict):
+            print(f"{pad}{key}:")
+            print_result(key, value, indent + 1)
+        else:
+            print(f"{pad}{key}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='webhook_serverのベンチマーク')
+    parser.add_argument('scenario', choices=['steady', 'burst', 'stats', 'broadcast', 'multiprocess', 'all'])
+    parser.add_argument('--server', choices=['threaded', 'async'], default='threaded',
+                        help='受信処理の方式（WEBHOOK_MODE）')
+    parser.add_argument('--rate', type=float, default=100, help='steady: 毎秒のリクエスト数')
+    parser.add_argument('--duration', type=float, default=10, help='steady: 計測秒数')
+    parser.add_argument('--requests', type=int, default=1000, help='burst/stats: リクエスト数')
+    parser.add_argument('--concurrency', type=int, default=32, help='同時接続数')
+    parser.add_argument('--events-per-request', type=int, default=1, help='1リクエストあたりのイベント数')
+    parser.add_argument('--users', type=int, default=1000, help='ユーザー数')
+    parser.add_argument('--history', type=int, default=100000, help='stats/broadcast: 事前に書き込む履歴の行数')
+    parser.add_argument('--latency', type=float, default=0.05, help='スタブLINE APIの応答遅延（秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='応答遅延のゆらぎ（±秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='スタブがエラーを返す割合（0〜1）')
+    parser.add_argument('--error-status', type=int, default=500, help='注入するエラーのステータスコード')
+    parser.add_argument('--idle-timeout', type=float, default=10, help='記録完了を待つ最大の無進捗秒数')
+    parser.add_argument('--tracemalloc', action='store_true', help='Pythonのメモリ確保のピークも計測（遅くなる）')
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    parser.add_argument('--processes', type=int, default=4, help='multiprocess: ワーカープロセス数')
+    parser.add_argument('--storage', choices=['sqlite', 'csv', 'partitioned'], default='sqlite',
+                        help='multiprocess: ストレージ（STORAGE_BACKEND）')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1,
+                        help='multiprocess: 同じwebhookEventIdで再送するリクエストの割合')
+    parser.add_argument('--keep', action='store_true', help='一時ディレクトリを削除しない')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_webhook_')
+    stub = StubLineApi(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                       error_status=args.error_status, record=False).start()
+    if args.scenario == 'multiprocess':
+        return main_multiprocess(args, stub, workdir)
+    server = BenchServer(args.server, stub, workdir)
+    url = server.start()
+    factory = PayloadFactory(BENCH_CHANNEL_SECRET, users=args.users)
+
+    # サーバーのログは計測結果と混ざらないようファイルに書き出す
+    log_path = os.path.join(workdir, 'server.log')
+    print(f"🚀 ベンチマーク開始: server={args.server}, stub latency={args.latency}s, "
+          f"error_rate={args.error_rate}, サーバーログ={log_path}")
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    results = {'config': vars(args)}
+    rss_before = peak_rss_mb()
+    scenarios = ['steady', 'burst', 'stats', 'broadcast'] if args.scenario == 'all' else [args.scenario]
+    log = open(log_path, 'w', encoding='utf-8')
+    try:
+        for scenario in scenarios:
+            with contextlib.redirect_stdout(log):
+                result = run_scenario(scenario, args, server, url, stub, factory)
+            result['peak_rss_mb'] = peak_rss_mb()
+            if args.tracemalloc:
+                result['python_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+                tracemalloc.reset_peak()
+            results[scenario] = result
+            print_result(scenario, result)
+    finally:
+        with contextlib.redirect_stdout(log):
+            server.stop()
+        stub.stop()
+        log.close()
+
+    results['line_api_requests'] = stub.stats()
+    results['rss_at_start_mb'] = rss_before
+    print_result('LINE APIへのリクエスト', results['line_api_requests'])
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 結果を保存しました: {args.json}")
+
+    if not args.keep:
+        # 終了処理のログも捨てる
+        sys.stdout = open(os.devnull, 'w')
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main_multiprocess(args, stub, workdir):
+    """multiprocess: サーバーを別プロセスで起動するため、このプロセスでは読み込まない"""
+    log_path = os.path.join(workdir, 'server.log')
+    print(f"🚀 複数プロセスの試験開始: processes={args.processes}, storage={args.storage}, サーバーログ={log_path}")
+    factory = PayloadFactory(BENCH_CHANNEL_SECRET, users=args.users)
+    results = {'config': vars(args)}
+    with open(log_path, 'w', encoding='utf-8') as log:
+        try:
+            results['unsafe_config'] = check_unsafe_config_refused(stub, workdir, log)
+            print_result('安全でない設定での起動', results['unsafe_config'])
+            results['multiprocess'] = bench_multiprocess(
+                stub, workdir, factory, args.processes, args.storage, args.requests, args.concurrency,
+                args.events_per_request, duplicate_ratio=args.duplicate_ratio,
+                idle_timeout=args.idle_timeout, log=log
+            )
+            print_result('multiprocess', results['multiprocess'])
+        finally:
+            stub.stop()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 結果を保存しました: {args.json}")
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    ok = results['unsafe_config']['refused'] and results['multiprocess'].get('ok')
+    print(f"\n{'✅ 記録の欠落・重複・破損はありません' if ok else '❌ 問題が見つかりました'}")
+    sys.exit(0 if ok else 1)
+
+
+def run_scenario(scenario, args, server, url, stub, factory):
+    """シナリオを1つ実行して結果を返す"""
+    if scenario == 'steady':
+        total = max(1, int(args.rate * args.duration))
+        return bench_ingest(server, url, factory, total, args.concurrency,
+                            args.events_per_request, rate=args.rate, idle_timeout=args.idle_timeout)
+    if scenario == 'burst':
+        return bench_ingest(server, url, factory, args.requests, args.concurrency,
+                            args.events_per_request, idle_timeout=args.idle_timeout)
+    if scenario == 'stats':
+        result = {'history': server.preload(args.history, args.users)}
+        result['stats'] = bench_get(url, '/stats', args.requests, args.concurrency)
+        result['stats_json'] = bench_get(url, '/stats.json', args.requests, args.concurrency)
+        result['search'] = bench_get(url, '/search.json?q=料金', args.requests, args.concurrency)
+        result['api_messages'] = bench_get(
+            url, '/api/messages?reply_status=要返信&fields=timestamp,user_id,content', args.requests, args.concurrency
+        )
+        result['api_customers'] = bench_get(url, '/api/customers?monetization=高', args.requests, args.concurrency)
+        return result
+    result = {'history': server.preload(args.history, args.users)}
+    result['broadcast'] = bench_broadcast(server, url, stub)
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from line_api import text_message
+from prefork import shared_default
+
+
+# マルチキャスト1回あたりの最大送信先数（LINE APIの上限）
+MULTICAST_MAX_RECIPIENTS = 500
+
+# 配信ジョブの進捗の保存先（空でプロセス内のみ。WEBHOOK_PROCESSES>1では既定でファイル）
+BROADCAST_JOBS_PATH = os.environ.get('BROADCAST_JOBS_PATH', shared_default('broadcast_jobs.db'))
+
+
+class BroadcastJob:
+    """1回のプッシュ配信ジョブと送信先ごとの結果"""
+
+    def __init__(self, message_text, recipients, target_type='all'):
+        self.id = uuid.uuid4().hex[:12]
+        self.message_text = message_text
+        self.recipients = list(recipients)
+        self.target_type = target_type
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+
+        # ユーザーID -> 'sent' / 'failed'
+        self.results = {}
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def record_batch(self, user_ids, ok, error=None):
+        """バッチの送信結果を送信先ごとに記録"""
+        with self._lock:
+            for user_id in user_ids:
+                self.results[user_id] = 'sent' if ok else 'failed'
+            if error:
+                self.errors.append(error)
+
+    def progress(self, details=False):
+        """送信済み・失敗・残りの件数を返す"""
+        with self._lock:
+            sent = sum(1 for result in self.results.values() if result == 'sent')
+            failed = len(self.results) - sent
+            progress = {
+                'id': self.id,
+                'status': self.status,
+                'target_type': self.target_type,
+                'total': len(self.recipients),
+                'sent': sent,
+                'failed': failed,
+                'remaining': len(self.recipients) - len(self.results),
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                'error': self.error,
+            }
+            if details:
+                progress['results'] = dict(self.results)
+                progress['errors'] = list(self.errors)
+            return progress
+
+
+class StoredJob:
+    """他のプロセスが実行した配信ジョブ（保存された進捗）"""
+
+    def __init__(self, progress):
+        self._progress = progress
+        self.id = progress['id']
+        self.status = progress['status']
+
+    def progress(self, details=False):
+        progress = dict(self._progress)
+        if not details:
+            progress.pop('results', None)
+            progress.pop('errors', None)
+        return progress
+
+
+class BroadcastJobStore:
+    """配信ジョブの進捗をSQLiteに保存し、同じファイルを使う他のプロセスから参照できるようにする"""
+
+    def __init__(self, path, max_jobs=50):
+        self.max_jobs = max_jobs
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id TEXT PRIMARY KEY,
+                progress TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+
+    def save(self, job, details=False):
+        """ジョブの進捗を保存（details: 送信先ごとの結果も保存する。完了時のみ）"""
+        progress = job.progress(details=details)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO broadcast_jobs (id, progress, created_at) VALUES (?, ?, ?)',
+                (job.id, json.dumps(progress, ensure_ascii=False), job.created_at)
+            )
+            # 古いジョブから破棄
+            self._conn.execute(
+                'DELETE FROM broadcast_jobs WHERE id NOT IN '
+                '(SELECT id FROM broadcast_jobs ORDER BY created_at DESC LIMIT ?)', (self.max_jobs,)
+            )
+
+    def get(self, job_id):
+        """保存された進捗（無ければNone）"""
+        with self._lock:
+            row = self._conn.execute('SELECT progress FROM broadcast_jobs WHERE id = ?', (job_id,)).fetchone()
+        return StoredJob(json.loads(row[0])) if row else None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class BroadcastManager:
+    """配信ジョブをバックグラウンドで実行し、状態を保持する
+
+    送信ペースはLINE APIクライアントの共有レート制限（一括送信の優先度）に従う。
+    storeを指定すると進捗をバッチごとに保存し、他のプロセスに届いた進捗の問い合わせにも答えられる。
+    """
+
+    def __init__(self, client, pool, concurrency=4,
+                 batch_size=MULTICAST_MAX_RECIPIENTS, batch_retries=2, max_jobs=50, store=None):
+        self.client = client
+        self.pool = pool
+        self.concurrency = max(1, int(concurrency))
+        self.batch_size = max(1, min(int(batch_size), MULTICAST_MAX_RECIPIENTS))
+        self.batch_retries = batch_retries
+        self.max_jobs = max_jobs
+        self.store = store
+
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, message_text, recipients, target_type='all'):
+        """配信ジョブを登録してキューに投入（投入できなければNone）"""
+        job = BroadcastJob(message_text, sorted(recipients), target_type)
+        with self._lock:
+            self._jobs[job.id] = job
+            # 古い完了済みジョブから破棄
+            while len(self._jobs) > self.max_jobs:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if oldest.status in ('queued', 'running'):
+                    break
+                del self._jobs[oldest_id]
+
+        self._save(job)
+        if not self.pool.submit(self._run, job):
+            job.status = 'failed'
+            job.error = '配信キューが満杯です'
+            job.finished_at = time.time()
+            self._save(job, details=True)
+        return job
+
+    def _save(self, job, details=False):
+        """進捗を保存（保存に失敗しても配信は続ける）"""
+        if self.store is None:
+            return
+        try:
+            self.store.save(job, details=details)
+        except Exception as e:
+            print(f"⚠️ 配信ジョブの進捗保存失敗: job={job.id}, {e}")
+
+    def get(self, job_id):
+        """ジョブを取得（このプロセスに無ければ保存された進捗）"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = self.store.get(job_id)
+        return job
+
+    def jobs(self):
+        """登録済みジョブ（新しい順）"""
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def _run(self, job):
+        """送信先をバッチに分けて並行にマルチキャスト送信"""
+        job.status = 'running'
+        job.started_at = time.time()
+        self._save(job)
+        print(f"📢 配信開始: job={job.id}, 対象={len(job.recipients)}人")
+
+        batches = [
+            job.recipients[i:i + self.batch_size]
+            for i in range(0, len(job.recipients), self.batch_size)
+        ]
+        messages = [text_message(job.message_text)]
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                list(executor.map(lambda batch: self._send_batch(job, batch, messages), batches))
+            job.status = 'completed'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            print(f"❌ 配信エラー: job={job.id}, {e}")
+        finally:
+            job.finished_at = time.time()
+            self._save(job, details=True)
+
+        progress = job.progress()
+        print(f"✅ 配信完了: job={job.id}, 成功={progress['sent']}人, 失敗={progress['failed']}人")
+
+    def _send_batch(self, job, user_ids, messages):
+        """1バッチを送信（同じリトライキーで再送するため重複配信されない）"""
+        retry_key = str(uuid.uuid4())
+        error = None
+
+        for attempt in range(self.batch_retries + 1):
+            try:
+                response = self.client.multicast(user_ids, messages, retry_key=retry_key)
+            except Exception as e:
+                error = f'{type(e).__name__}: {e}'
+            else:
+                # 409は同じリトライキーのリクエストが受付済み
+                if response.status_code in (200, 409):
+                    job.record_batch(user_ids, True)
+                    self._save(job)
+                    return True
+                error = f'{response.status_code}: {response.text[:200]}'
+                if response.status_code != 429 and response.status_code < 500:
+                    break
+
+            if attempt < self.batch_retries:
+                time.sleep(min(2 ** attempt, 10))
+
+        print(f"⚠️ マルチキャスト送信失敗: job={job.id}, {len(user_ids)}人, {error}")
+        job.record_batch(user_ids, False, error)
+        self._save(job)
+        return False
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+
+
+# 自動返信ルール（上にあるものほど優先。長いキーワードを先に置く）
+AUTO_REPLY_RULES = [
+    ('詳しい実績', '非公開実績をご覧いただけます！\n\n🔒 非公開実績\nhttps://www.notion.so/moxmovie/a4b31ca6873c48d7bc3caea433e83ae2\n\nパスワードは個別にお伝えいたします。\n担当者からのメッセージをお待ちください！\n\nご不明な点があれば、お気軽にお問い合わせください！'),
+    ('ポートフォリオ', '制作実績はこちらからご覧いただけます！\n\n🎬 公開実績\nhttps://www.mox-motage.com/works\n\nより詳しい実績（非公開含む）をご希望の場合は、\n「詳しい実績を見たい」とメッセージをお送りください。\nパスワードをお伝えいたします！\n\nご不明な点があれば、お気軽にお問い合わせください！'),
+    ('実績', '制作実績はこちらからご覧いただけます！\n\n🎬 公開実績\nhttps://www.mox-motage.com/works\n\nより詳しい実績（非公開含む）をご希望の場合は、\n「詳しい実績を見たい」とメッセージをお送りください。\nパスワードをお伝えいたします！\n\nご不明な点があれば、お気軽にお問い合わせください！'),
+    ('営業時間', '営業時間は以下の通りです。\n\n平日: 9:00 - 21:00\n土日祝: 9:00 - 17:00\n不定休\n\nお気軽にお問い合わせください！'),
+    ('料金', '料金については、プロジェクトの内容や規模によって異なります。\n\n詳しいお見積もりをご希望の場合は、以下の情報をお知らせください。\n\n1. 映像の種類（企業紹介、イベント、商品PRなど）\n2. 映像の長さ\n3. 納期\n4. 使用目的\n\n担当者から詳しいお見積もりをお送りいたします！'),
+    ('価格', '料金については、プロジェクトの内容や規模によって異なります。\n\n詳しいお見積もりをご希望の場合は、以下の情報をお知らせください。\n\n1. 映像の種類（企業紹介、イベント、商品PRなど）\n2. 映像の長さ\n3. 納期\n4. 使用目的\n\n担当者から詳しいお見積もりをお送りいたします！'),
+    ('場所', '事務所の住所は以下の通りです。\n\n〔住所〕\n〒670-0012\n兵庫県姫路市本町127番地\n大手前ダイネンBLD.II 3F\n\n〔電話番号〕\n080-1755-4598\n\n〔メール〕\nfukusuke.mox@gmail.com\n\nお越しの際は、事前にご連絡いただけると助かります！'),
+    ('住所', '事務所の住所は以下の通りです。\n\n〔住所〕\n〒670-0012\n兵庫県姫路市本町127番地\n大手前ダイネンBLD.II 3F\n\n〔電話番号〕\n080-1755-4598\n\n〔メール〕\nfukusuke.mox@gmail.com\n\nお越しの際は、事前にご連絡いただけると助かります！'),
+    ('メニュー', '主なサービス内容は以下の通りです。\n\n■ 企業紹介映像\n■ 商品・SNS用動画\n■ イベント撮影\n■ ドローン空撮\n■ 動画編集\n\n詳しい内容やお見積もりは、お気軽にお問い合わせください！'),
+    ('サービス', '主なサービス内容は以下の通りです。\n\n■ 企業紹介映像\n■ 商品・SNS用動画\n■ イベント撮影\n■ ドローン空撮\n■ 動画編集\n\n詳しい内容やお見積もりは、お気軽にお問い合わせください！'),
+]
+
+# マネタイズ機会の判定キーワード（上のレベルほど優先）
+MONETIZATION_KEYWORDS = [
+    ('高', ['見積', '予算', '料金', '価格', '費用', '依頼', '発注', '契約', '購入']),
+    ('中', ['興味', '詳しく', '教えて', '知りたい', '相談', '検討']),
+    ('低', ['ありがとう', 'よろしく', 'わかりました', 'OK']),
+]
+
+# 返信が必要と判定するキーワード
+QUESTION_KEYWORDS = ['?', '？', 'どう', 'いつ', 'どこ', 'なに', '教えて', '知りたい', 'できます', 'お願い']
+
+# 判定結果
+Classification = namedtuple('Classification', ['auto_reply', 'monetization', 'reply_status'])
+
+
+class KeywordAutomaton:
+    """複数のルールセットのキーワードを1つにまとめたAho-Corasickオートマトン
+
+    patternsは (キーワード, ルールセット名, 優先度) の並び。
+    search() は本文を1回走査し、ルールセットごとに一致した最も小さい優先度を返す。
+    """
+
+    def __init__(self, patterns):
+        # ノードごとの遷移・失敗リンク・出力（ルールセット名 -> 最小優先度）
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [{}]
+
+        for keyword, ruleset, priority in patterns:
+            if not keyword:
+                continue
+            node = 0
+            for char in keyword:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append({})
+                node = next_node
+            out = self._out[node]
+            if priority < out.get(ruleset, priority + 1):
+                out[ruleset] = priority
+
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        """幅優先で失敗リンクを張り、接尾辞に一致するキーワードの出力を合成する"""
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail_target = self._goto[fail].get(char, 0)
+                self._fail[child] = fail_target if fail_target != child else 0
+
+                out = self._out[child]
+                for ruleset, priority in self._out[self._fail[child]].items():
+                    if priority < out.get(ruleset, priority + 1):
+                        out[ruleset] = priority
+                queue.append(child)
+
+    def search(self, text):
+        """本文を1回走査し、ルールセットごとの最小優先度を返す"""
+        goto = self._goto
+        fail = self._fail
+        outputs = self._out
+
+        best = {}
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            out = outputs[node]
+            if out:
+                for ruleset, priority in out.items():
+                    if priority < best.get(ruleset, priority + 1):
+                        best[ruleset] = priority
+        return best
+
+
+class MessageClassifier:
+    """自動返信・マネタイズ機会・返信要否を1回の走査で判定する"""
+
+    def __init__(self, auto_replies=AUTO_REPLY_RULES, monetization_keywords=MONETIZATION_KEYWORDS,
+                 question_keywords=QUESTION_KEYWORDS):
+        self._replies = [reply for _, reply in auto_replies]
+        self._levels = [level for level, _ in monetization_keywords]
+
+        patterns = []
+        for priority, (keyword, _) in enumerate(auto_replies):
+            patterns.append((keyword, 'auto_reply', priority))
+        for priority, (_, words) in enumerate(monetization_keywords):
+            for word in words:
+                patterns.append((word, 'monetization', priority))
+        for keyword in question_keywords:
+            patterns.append((keyword, 'question', 0))
+
+        self._automaton = KeywordAutomaton(patterns)
+
+    def classify(self, message_text):
+        """メッセージ本文を判定"""
+        best = self._automaton.search(message_text)
+
+        auto_reply = best.get('auto_reply')
+        monetization = best.get('monetization')
+        return Classification(
+            auto_reply=self._replies[auto_reply] if auto_reply is not None else None,
+            monetization=self._levels[monetization] if monetization is not None else '要確認',
+            reply_status='要返信' if 'question' in best else '確認済み',
+        )
+
+
+# 既定のルールでコンパイル済みの判定器
+default_classifier = MessageClassifier()
+
+
+def classify_message(message_text):
+    """既定のルールでメッセージ本文を判定"""
+    return default_classifier.classify(message_text)
@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import sqlite3
+import pathlib
+import argparse
+import threading
+from datetime import datetime
+
+from storage import open_storage
+from segments import SegmentIndex, SEGMENT_DEFINITIONS, SEGMENT_REFRESH_SECONDS
+
+
+# 顧客テーブルの保存先
+CUSTOMERS_PATH = os.environ.get('CUSTOMERS_PATH', os.path.join(os.path.dirname(__file__), 'customers.db'))
+
+# 顧客テーブルの列
+CUSTOMER_COLUMNS = (
+    'user_id', 'user_name', 'first_seen', 'last_seen', 'message_count',
+    'needs_reply_count', 'high_count', 'last_reply_status', 'last_monetization', 'status_at',
+    'followed', 'followed_at', 'unfollowed_at', 'follow_changed_at',
+)
+
+# メッセージ数に含めない記録
+FOLLOW_TYPES = ('follow', 'unfollow')
+
+# /statsの集計値の初期値
+EMPTY_TOTALS = {'total_messages': 0, 'needs_reply': 0, 'high_opportunities': 0}
+
+
+def _new_customer(user_id, timestamp):
+    return {
+        'user_id': user_id,
+        'user_name': 'Unknown',
+        'first_seen': timestamp,
+        'last_seen': timestamp,
+        'message_count': 0,
+        'needs_reply_count': 0,
+        'high_count': 0,
+        'last_reply_status': '',
+        'last_monetization': '',
+        'status_at': '',
+        'followed': 1,
+        'followed_at': None,
+        'unfollowed_at': None,
+        'follow_changed_at': '',
+    }
+
+
+def apply_row(customer, row):
+    """記録1行（CSVヘッダーをキーとする辞書）を顧客の集計に反映
+
+    記録の順序が前後しても結果が同じになるよう、最新の値はタイムスタンプで比べる。
+    """
+    timestamp = row.get('タイムスタンプ') or ''
+    message_type = row.get('メッセージタイプ') or ''
+    user_name = row.get('ユーザー名') or ''
+
+    customer['first_seen'] = min(customer['first_seen'], timestamp)
+    if timestamp >= customer['last_seen']:
+        customer['last_seen'] = timestamp
+        if user_name and user_name != 'Unknown':
+            customer['user_name'] = user_name
+    elif customer['user_name'] == 'Unknown' and user_name and user_name != 'Unknown':
+        customer['user_name'] = user_name
+
+    if message_type in FOLLOW_TYPES:
+        if timestamp >= customer['follow_changed_at']:
+            customer['follow_changed_at'] = timestamp
+            customer['followed'] = 1 if message_type == 'follow' else 0
+        key = 'followed_at' if message_type == 'follow' else 'unfollowed_at'
+        if customer[key] is None or timestamp > customer[key]:
+            customer[key] = timestamp
+        if message_type == 'unfollow':
+            return
+    else:
+        customer['message_count'] += 1
+
+    reply_status = row.get('返信ステータス') or ''
+    monetization = row.get('マネタイズ機会') or ''
+    if reply_status == '要返信':
+        customer['needs_reply_count'] += 1
+    if monetization == '高':
+        customer['high_count'] += 1
+    if timestamp >= customer['status_at']:
+        customer['status_at'] = timestamp
+        customer['last_reply_status'] = reply_status
+        customer['last_monetization'] = monetization
+
+
+class CustomerTable:
+    """ユーザーIDごとに1行の顧客テーブル（SQLite）
+
+    メッセージの記録（ストレージ）を前回の位置から追いかけて更新するため、
+    配信対象の抽出や顧客サマリーは記録の件数ではなく顧客数に比例する。
+    追いかけた位置は顧客テーブルと同じトランザクションで保存するので、
+    同じファイルを複数のプロセスで共有しても二重に数えることはない。
+    配信対象のセグメントも同じトランザクションで更新する（segments.pyを参照）。
+    """
+
+    def __init__(self, storage, path=None, segments=None):
+        self.storage = storage
+        self.path = path
+        self._lock = threading.Lock()
+        self._validated = False
+        self._version = None
+        self._applied = 0
+        self._last_catch_up_seconds = 0.0
+
+        self._conn = sqlite3.connect(path or ':memory:', timeout=30, isolation_level=None, check_same_thread=False)
+        if path:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS customers (
+                user_id TEXT PRIMARY KEY,
+                user_name TEXT NOT NULL,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                needs_reply_count INTEGER NOT NULL DEFAULT 0,
+                high_count INTEGER NOT NULL DEFAULT 0,
+                last_reply_status TEXT NOT NULL DEFAULT '',
+                last_monetization TEXT NOT NULL DEFAULT '',
+                status_at TEXT NOT NULL DEFAULT '',
+                followed INTEGER NOT NULL DEFAULT 1,
+                followed_at TEXT,
+                unfollowed_at TEXT,
+                follow_changed_at TEXT NOT NULL DEFAULT ''
+            )
+        ''')
+        # 最終メッセージ日時の順のページ送り用（返信ステータス・マネタイズ機会で絞り込む場合も索引だけで読む）
+        self._conn.execute('DROP INDEX IF EXISTS idx_customers_last_seen')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_customers_last_seen_user_id ON customers (last_seen, user_id)')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_customers_reply_status ON customers (last_reply_status, last_seen, user_id)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_customers_monetization ON customers (last_monetization, last_seen, user_id)'
+        )
+        # 追いかけたストレージの種類と位置、更新のたびに増える版、セグメント定義の版
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+        self.segments = SegmentIndex(self._conn, SEGMENT_DEFINITIONS if segments is None else segments)
+        self._prepare_segments()
+
+    def _meta(self, key):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, key, value):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value, ensure_ascii=False))
+        )
+
+    def _transaction(self, func):
+        """顧客テーブルとセグメントを1つのトランザクションで更新する（ロック取得済みで呼ぶ）
+
+        他のプロセスが先に更新していれば、セグメントを読み込み直してから更新する。
+        funcが変更した場合はTrueを返す。
+        """
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = self._meta('version') or 0
+            if version != self._version:
+                self.segments.load()
+            changed = func()
+            if changed:
+                version += 1
+                self._set_meta('version', version)
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            self.segments.rollback()
+            raise
+        self._conn.execute('COMMIT')
+        self.segments.commit()
+        self._version = version
+        return changed
+
+    def _iter_customers(self):
+        cursor = self._conn.execute(f'SELECT {", ".join(CUSTOMER_COLUMNS)} FROM customers')
+        for record in cursor.fetchall():
+            yield dict(zip(CUSTOMER_COLUMNS, record))
+
+    def _prepare_segments(self):
+        """定義が追加・変更されたセグメントだけ全件から判定し、保存済みの所属を読み込む"""
+        def prepare():
+            stored = self._meta('segments') or {}
+            current = self.segments.versions()
+            changed = [name for name, version in current.items() if stored.get(name) != version]
+            removed = [name for name in stored if name not in current]
+            if not changed and not removed:
+                return False
+            self.segments.drop(changed + removed)
+            self.segments.load()
+            # 顧客テーブルを全件から作る場合はそのときに判定される
+            if changed and self._meta('position') is not None:
+                print(f"🔄 セグメントを作成します: {', '.join(changed)}")
+                now = datetime.now()
+                for customer in self._iter_customers():
+                    self.segments.evaluate(customer, now, names=changed)
+                if any(self.segments.definitions[name].row_match is not None for name in changed):
+                    rows, _ = self.storage.scan_since(None)
+                    for row in rows:
+                        user_id = row.get('ユーザーID') or ''
+                        if user_id:
+                            self.segments.match_row(user_id, row, names=changed)
+            self._set_meta('segments', current)
+            return True
+
+        with self._lock:
+            self._transaction(prepare)
+
+    def register_segment(self, segment):
+        """起動後にセグメントを追加する（全件から判定してから使えるようにする）"""
+        self.segments.definitions[segment.name] = segment
+        self._prepare_segments()
+
+    def _load(self, user_id):
+        """顧客の行を辞書で読み込む（無ければNone）"""
+        record = self._conn.execute(
+            f'SELECT {", ".join(CUSTOMER_COLUMNS)} FROM customers WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        return dict(zip(CUSTOMER_COLUMNS, record)) if record else None
+
+    def _apply(self, rows):
+        """行を顧客ごとに反映し、変更した顧客とセグメントを書き込む（トランザクション内で呼ぶ）"""
+        customers = {}
+        count = 0
+        totals = self._meta('totals') or dict(EMPTY_TOTALS)
+        for row in rows:
+            # /statsの集計値（記録の件数。フォロー・アンフォローも含める）
+            totals['total_messages'] += 1
+            if row.get('返信ステータス') == '要返信':
+                totals['needs_reply'] += 1
+            if row.get('マネタイズ機会') == '高':
+                totals['high_opportunities'] += 1
+            user_id = row.get('ユーザーID') or ''
+            if not user_id:
+                continue
+            customer = customers.get(user_id)
+            if customer is None:
+                customer = self._load(user_id) or _new_customer(user_id, row.get('タイムスタンプ') or '')
+                customers[user_id] = customer
+            apply_row(customer, row)
+            self.segments.match_row(user_id, row)
+            count += 1
+
+        now = datetime.now()
+        for customer in customers.values():
+            self.segments.evaluate(customer, now)
+        self._conn.executemany(
+            f'INSERT OR REPLACE INTO customers ({", ".join(CUSTOMER_COLUMNS)}) '
+            f'VALUES ({", ".join("?" for _ in CUSTOMER_COLUMNS)})',
+            [tuple(customer[name] for name in CUSTOMER_COLUMNS) for customer in customers.values()]
+        )
+        self._set_meta('totals', totals)
+        return count
+
+    def _up_to_date(self, backend):
+        """書き込みのトランザクションを始めずに、反映済みの位置から記録が増えていないか確かめる（ロック取得済みで呼ぶ）
+
+        他のプロセスが顧客テーブルを更新していた場合は、セグメントを読み込み直すためFalseを返す。
+        """
+        if not self._validated:
+            return False
+        self._conn.execute('BEGIN')
+        try:
+            position = self._meta('position')
+            stored_backend = self._meta('backend')
+            version = self._meta('version') or 0
+        finally:
+            self._conn.execute('COMMIT')
+        if position is None or stored_backend != backend or version != self._version:
+            return False
+        _, next_position = self.storage.scan_since(position)
+        return next_position == position
+
+    def catch_up(self, rebuild=False):
+        """前回の位置以降に追記された記録を反映する（反映した件数を返す）
+
+        ストレージが作り直された・別の種類に切り替わった場合は全件から作り直す。
+        新しい記録が無ければ書き込みのトランザクションを始めないので、参照のたびに呼んでもよい。
+        """
+        backend = type(self.storage).__name__
+        started = time.perf_counter()
+        result = {'applied': 0}
+
+        def apply():
+            position = self._meta('position')
+            if rebuild or self._meta('backend') != backend:
+                position = None
+            elif position is not None and not self._validated:
+                # 起動後の最初の1回だけ、データが作り直されていないか確認する
+                if not self.storage.position_valid(position):
+                    print("⚠️ 記録が作り直されたため、顧客テーブルを作り直します")
+                    position = None
+                elif self._meta('totals') is None:
+                    print("🔄 集計値を作成するため、顧客テーブルを作り直します")
+                    position = None
+            if position is None:
+                self._conn.execute('DELETE FROM customers')
+                self._conn.execute("DELETE FROM meta WHERE key = 'totals'")
+                self.segments.clear()
+
+            rows, next_position = self.storage.scan_since(position)
+            result['applied'] = self._apply(rows)
+            self._set_meta('backend', backend)
+            self._set_meta('position', next_position)
+            return position is None or result['applied'] > 0
+
+        with self._lock:
+            if not rebuild and self._up_to_date(backend):
+                return 0
+            self._transaction(apply)
+            self._validated = True
+            self._applied += result['applied']
+            self._last_catch_up_seconds = time.perf_counter() - started
+        return result['applied']
+
+    def _refresh_segment(self, name):
+        """時間の経過で所属が変わるセグメントを全顧客について判定し直す（ロック取得済みで呼ぶ）"""
+        def refresh():
+            now = datetime.now()
+            for customer in self._iter_customers():
+                self.segments.evaluate(customer, now, names=[name])
+            return True
+
+        self._transaction(refresh)
+        self.segments.refreshed_at[name] = time.monotonic()
+
+    # --- 参照 ---
+
+    def _rows(self, sql, params=()):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            return [dict(zip(CUSTOMER_COLUMNS, record)) for record in cursor]
+
+    def get(self, user_id):
+        """1人分の顧客情報（無ければNone）"""
+        rows = self._rows(f'SELECT {", ".join(CUSTOMER_COLUMNS)} FROM customers WHERE user_id = ?', (user_id,))
+        return rows[0] if rows else None
+
+    def customers(self, order_by='message_count DESC', limit=None):
+        """顧客情報の一覧"""
+        sql = f'SELECT {", ".join(CUSTOMER_COLUMNS)} FROM customers ORDER BY {order_by}, user_id'
+        if limit is not None:
+            return self._rows(f'{sql} LIMIT ?', (int(limit),))
+        return self._rows(sql)
+
+    def page(self, cursor=None, limit=100, start=None, end=None, user_id=None,
+             reply_status=None, monetization=None, followed=None):
+        """顧客を最終メッセージ日時の順にlimit件返す（キーセット方式のページ送り）
+
+        start/endは最終メッセージ日時の範囲、reply_status/monetizationは最新の値で絞り込む。
+        メッセージが届いた顧客は後ろに移るので、最後の位置から読み直すと更新された顧客だけが返る。
+        返り値: (顧客のリスト, 次のページの位置, 続きがあるか)
+        """
+        clauses = []
+        params = []
+        for clause, value in (
+            ('last_seen >= ?', start), ('last_seen <= ?', end), ('user_id = ?', user_id),
+            ('last_reply_status = ?', reply_status), ('last_monetization = ?', monetization),
+        ):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        if followed is not None:
+            clauses.append('followed = ?')
+            params.append(1 if followed else 0)
+        if cursor is not None:
+            if not isinstance(cursor, dict) or not all(isinstance(cursor.get(key), str) for key in ('last_seen', 'user_id')):
+                raise ValueError('cursorが正しくありません')
+            clauses.append('(last_seen, user_id) > (?, ?)')
+            params.extend([cursor['last_seen'], cursor['user_id']])
+        where = f'WHERE {" AND ".join(clauses)} ' if clauses else ''
+        rows = self._rows(
+            f'SELECT {", ".join(CUSTOMER_COLUMNS)} FROM customers {where}ORDER BY last_seen, user_id LIMIT ?',
+            params + [int(limit) + 1]
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if rows:
+            cursor = {'last_seen': rows[-1]['last_seen'], 'user_id': rows[-1]['user_id']}
+        return rows, cursor, has_more
+
+    def segment(self, name):
+        """セグメントに含まれるユーザーID（ブロック・削除したユーザーは除く）"""
+        definition = self.segments.definitions[name]
+        with self._lock:
+            if definition.time_based:
+                refreshed_at = self.segments.refreshed_at.get(name)
+                if refreshed_at is None or time.monotonic() - refreshed_at > SEGMENT_REFRESH_SECONDS:
+                    self._refresh_segment(name)
+            return self.segments.members(name)
+
+    def segment_options(self):
+        """配信ページの選択肢（セグメント名と表示名）"""
+        return [(name, segment.label) for name, segment in self.segments.definitions.items()]
+
+    def count(self, followed=None):
+        """顧客数（followed=Trueで友だちのまま、Falseでブロック・削除済み）"""
+        with self._lock:
+            if followed is None:
+                return self._conn.execute('SELECT COUNT(*) FROM customers').fetchone()[0]
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM customers WHERE followed = ?', (1 if followed else 0,)
+            ).fetchone()[0]
+
+    def summary(self):
+        """/statsの集計値（MessageStats.snapshot()と同じ形。全プロセスの記録を反映した値）"""
+        with self._lock:
+            totals = self._meta('totals') or dict(EMPTY_TOTALS)
+            totals['customers'] = self._conn.execute('SELECT COUNT(*) FROM customers').fetchone()[0]
+            return totals
+
+    def stats(self):
+        """顧客数・セグメントごとの人数と反映状況"""
+        with self._lock:
+            total, following = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(followed), 0) FROM customers'
+            ).fetchone()
+            return {
+                'customers': total,
+                'following': following,
+                'unfollowed': total - following,
+                'segments': self.segments.counts(),
+                'applied_rows': self._applied,
+                'last_catch_up_seconds': round(self._last_catch_up_seconds, 4),
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def read_customers(path=CUSTOMERS_PATH, order_by='message_count DESC'):
+    """作成済みの顧客テーブルを読み取り専用で開き、顧客情報の一覧を返す（まだ作成されていなければNone）
+
+    レポートなどから使う。顧客テーブルの作成・更新はしないため、内容はサーバーが反映した分までになる。
+    """
+    if not path or not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(f'{pathlib.Path(path).resolve().as_uri()}?mode=ro', uri=True, timeout=30)
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'position'").fetchone()
+        if row is None or json.loads(row[0]) is None:
+            return None
+        cursor = conn.execute(f'SELECT {", ".join(CUSTOMER_COLUMNS)} FROM customers ORDER BY {order_by}, user_id')
+        return [dict(zip(CUSTOMER_COLUMNS, record)) for record in cursor]
+    except sqlite3.OperationalError:
+        # テーブルがまだ無い
+        return None
+    finally:
+        conn.close()
+
+
+def open_customers(storage=None, path=CUSTOMERS_PATH):
+    """顧客テーブルを開き、記録の最新分まで反映する"""
+    table = CustomerTable(storage or open_storage(), path or None)
+    table.catch_up()
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description='顧客テーブルの確認・作り直し')
+    parser.add_argument('command', choices=['list', 'segment', 'rebuild', 'stats'])
+    parser.add_argument('--path', default=CUSTOMERS_PATH, help='顧客テーブルのファイル')
+    parser.add_argument('--segment', default='all', choices=list(SEGMENT_DEFINITIONS), help='segment: セグメント名')
+    parser.add_argument('--limit', type=int, default=20, help='list: 表示する件数')
+    args = parser.parse_args()
+
+    table = CustomerTable(open_storage(), args.path)
+    applied = table.catch_up(rebuild=args.command == 'rebuild')
+    if args.command == 'rebuild':
+        print(f"✅ 顧客テーブルを作り直しました: {table.count()}名（{applied}件の記録）")
+    elif args.command == 'list':
+        for customer in table.customers(limit=args.limit):
+            print(json.dumps(customer, ensure_ascii=False))
+    elif args.command == 'segment':
+        for user_id in sorted(table.segment(args.segment)):
+            print(user_id)
+    else:
+        print(json.dumps(table.stats(), ensure_ascii=False, indent=2))
+    table.close()
+
+
+if __name__ == '__main__':
+    main()
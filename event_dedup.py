@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class EventDeduplicator:
+    """webhookEventIdで再送・重複イベントを除外する
+
+    直近のIDはメモリ上の時間窓付きの集合で判定し、SQLiteにも記録して再起動後も重複を検知する。
+    """
+
+    def __init__(self, path, window=86400, maxsize=100000, prune_every=1000):
+        self.path = path
+        self.window = window
+        self.maxsize = max(1, int(maxsize))
+        self.prune_every = prune_every
+
+        # event_id -> 受信時刻
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._claims_since_prune = 0
+
+        self._accepted = 0
+        self._suppressed = 0
+
+        if path:
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            with self._conn:
+                self._conn.execute('''
+                    CREATE TABLE IF NOT EXISTS webhook_events (
+                        event_id TEXT PRIMARY KEY,
+                        received_at REAL NOT NULL
+                    )
+                ''')
+                self._conn.execute(
+                    'CREATE INDEX IF NOT EXISTS idx_webhook_events_received_at ON webhook_events (received_at)'
+                )
+
+    def claim(self, event_id):
+        """初めて受信したイベントならTrue、重複ならFalse"""
+        now = time.time()
+        with self._lock:
+            received_at = self._recent.get(event_id)
+            if received_at is not None and now - received_at < self.window:
+                self._suppressed += 1
+                return False
+
+            if self._conn is not None:
+                with self._conn:
+                    cursor = self._conn.execute(
+                        'INSERT OR IGNORE INTO webhook_events (event_id, received_at) VALUES (?, ?)',
+                        (event_id, now)
+                    )
+                    if cursor.rowcount == 0:
+                        stored_at = self._conn.execute(
+                            'SELECT received_at FROM webhook_events WHERE event_id = ?', (event_id,)
+                        ).fetchone()[0]
+                        if now - stored_at < self.window:
+                            self._remember(event_id, stored_at)
+                            self._suppressed += 1
+                            return False
+                        # 時間窓を過ぎた古い記録は新しいイベントとして扱う
+                        self._conn.execute(
+                            'UPDATE webhook_events SET received_at = ? WHERE event_id = ?', (now, event_id)
+                        )
+
+            self._remember(event_id, now)
+            self._accepted += 1
+
+            self._claims_since_prune += 1
+            if self._claims_since_prune >= self.prune_every:
+                self._claims_since_prune = 0
+                self._prune(now)
+            return True
+
+    def _remember(self, event_id, received_at):
+        """メモリ上の集合に追加（ロック取得済みで呼ぶ）"""
+        self._recent[event_id] = received_at
+        self._recent.move_to_end(event_id)
+        while len(self._recent) > self.maxsize:
+            self._recent.popitem(last=False)
+
+    def _prune(self, now):
+        """時間窓を過ぎた記録を削除（ロック取得済みで呼ぶ）"""
+        cutoff = now - self.window
+        while self._recent:
+            event_id, received_at = next(iter(self._recent.items()))
+            if received_at >= cutoff:
+                break
+            self._recent.popitem(last=False)
+        if self._conn is not None:
+            with self._conn:
+                self._conn.execute('DELETE FROM webhook_events WHERE received_at < ?', (cutoff,))
+
+    def stats(self):
+        """受理・除外した件数を返す"""
+        with self._lock:
+            return {
+                'accepted': self._accepted,
+                'suppressed': self._suppressed,
+                'recent_ids': len(self._recent),
+                'window_seconds': self.window,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+from rate_limit import retry_after_seconds
+
+
+# LINE API接続設定
+LINE_API_BASE_URL = os.environ.get('LINE_API_BASE_URL', 'https://api.line.me')
+LINE_API_POOL_SIZE = int(os.environ.get('LINE_API_POOL_SIZE', '10'))
+LINE_API_CONNECT_TIMEOUT = float(os.environ.get('LINE_API_CONNECT_TIMEOUT', '3.05'))
+LINE_API_READ_TIMEOUT = float(os.environ.get('LINE_API_READ_TIMEOUT', '5'))
+LINE_API_RETRIES = int(os.environ.get('LINE_API_RETRIES', '3'))
+LINE_API_BACKOFF = float(os.environ.get('LINE_API_BACKOFF', '0.3'))
+
+# リトライしてよい（冪等な）メソッド
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+class LineApiClient:
+    """Keep-Alive接続プールを共有するLINE Messaging APIクライアント"""
+
+    def __init__(self, access_token, base_url=LINE_API_BASE_URL, pool_size=LINE_API_POOL_SIZE,
+                 connect_timeout=LINE_API_CONNECT_TIMEOUT, read_timeout=LINE_API_READ_TIMEOUT,
+                 retries=LINE_API_RETRIES, backoff_factor=LINE_API_BACKOFF, rate_limiter=None):
+        self.access_token = access_token
+        self.rate_limiter = rate_limiter
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+
+        # 冪等なメソッドのみ429/5xx・読み取りエラーでバックオフ付きリトライ
+        # （接続エラーはリクエスト未送信のためメソッドに関わらずリトライされる）
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=IDEMPOTENT_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {access_token}',
+        })
+
+    def request(self, method, path, priority='interactive', **kwargs):
+        """LINE APIにリクエストを送信してレスポンスを返す（rate_limiterがあれば送信枠を待つ）"""
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = metrics.line_api_endpoint(path)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(endpoint, priority)
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, f'{self.base_url}{path}', **kwargs)
+        except Exception:
+            metrics.record_line_api(path, 'error', time.perf_counter() - started)
+            raise
+        metrics.record_line_api(path, response.status_code, time.perf_counter() - started)
+        if self.rate_limiter is not None and _saw_429(response):
+            self.rate_limiter.penalize(endpoint, retry_after_seconds(response.headers))
+        return response
+
+    def get_profile(self, user_id):
+        """ユーザープロフィールを取得"""
+        return self.request('GET', f'/v2/bot/profile/{user_id}')
+
+    def push_message(self, to, messages, retry_key=None):
+        """プッシュメッセージを送信"""
+        return self.request('POST', '/v2/bot/message/push', json={
+            'to': to,
+            'messages': messages
+        }, headers=_retry_headers(retry_key))
+
+    def multicast(self, to, messages, retry_key=None):
+        """複数ユーザーに同じメッセージを送信（1回最大500人、一括送信として低い優先度で送る）"""
+        return self.request('POST', '/v2/bot/message/multicast', priority='bulk', json={
+            'to': list(to),
+            'messages': messages
+        }, headers=_retry_headers(retry_key))
+
+    def close(self):
+        """接続プールを閉じる"""
+        self.session.close()
+
+
+def _saw_429(response):
+    """429を受けたか（urllib3が内部でリトライした分も含む）"""
+    if response.status_code == 429:
+        return True
+    retries = getattr(response.raw, 'retries', None)
+    return any(history.status == 429 for history in getattr(retries, 'history', None) or ())
+
+
+def _retry_headers(retry_key):
+    """再送時に重複送信を防ぐX-Line-Retry-Keyヘッダー"""
+    return {'X-Line-Retry-Key': retry_key} if retry_key else None
+
+
+def text_message(text):
+    """テキストメッセージオブジェクトを作成"""
+    return {
+        'type': 'text',
+        'text': text
+    }
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""処理時間・件数の計測（Prometheusのテキスト形式で /metrics に出力）
+
+本番で常時有効にできるよう、計測は区間ごとの加算とロック1回だけにしている。
+"""
+
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# 処理時間のヒストグラムの区切り（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        """withブロックの処理時間を記録"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class _Metric:
+    """ラベルの値ごとに子を持つメトリクス"""
+
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """ラベルの値に対応する子を返す（ホットパスでは事前に取得しておく）"""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f'{self.name}: ラベルの数が一致しません')
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._render_samples())
+        return lines
+
+
+class Counter(_Metric):
+    """増加するだけの件数"""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def _render_samples(self):
+        for key, child in self._items():
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}'
+
+
+class Histogram(_Metric):
+    """処理時間などの分布"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, seconds):
+        self._children[()].observe(seconds)
+
+    def time(self):
+        return self._children[()].time()
+
+    def _render_samples(self):
+        for key, child in self._items():
+            counts, total, count = child.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, key)} {count}'
+
+
+class Gauge(_Metric):
+    """出力時に関数を呼んで値を取得する現在値（キュー長など）
+
+    関数は数値、またはラベルの値のタプルをキーにした辞書を返す。
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, func, labelnames=()):
+        self.func = func
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return None
+
+    def _render_samples(self):
+        try:
+            value = self.func()
+        except Exception:
+            return
+        if isinstance(value, dict):
+            for key, item in sorted(value.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(item)}'
+        elif value is not None:
+            yield f'{self.name} {_format_value(value)}'
+
+
+class MetricsRegistry:
+    """メトリクスを登録し、Prometheusのテキスト形式で出力する"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # 同じ名前の現在値は後から登録したもので置き換える（再起動・再作成時）
+                if isinstance(metric, Gauge):
+                    self._metrics[metric.name] = metric
+                    return metric
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name, help_text, func, labelnames=()):
+        return self._register(Gauge(name, help_text, func, labelnames))
+
+    def render(self):
+        """Prometheusのテキスト形式（version 0.0.4）で出力"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# プロセス全体で共有するレジストリ
+registry = MetricsRegistry()
+
+# Webhook処理の段階ごとの処理時間
+WEBHOOK_STAGE_SECONDS = registry.histogram(
+    'line_webhook_stage_seconds',
+    'Webhook処理の段階ごとの処理時間（秒）',
+    ('stage',)
+)
+STAGE_SIGNATURE = WEBHOOK_STAGE_SECONDS.labels('signature')
+STAGE_DISPATCH = WEBHOOK_STAGE_SECONDS.labels('dispatch')
+STAGE_PROFILE = WEBHOOK_STAGE_SECONDS.labels('profile_fetch')
+STAGE_CLASSIFY = WEBHOOK_STAGE_SECONDS.labels('classification')
+STAGE_WRITE = WEBHOOK_STAGE_SECONDS.labels('write')
+STAGE_STORAGE = WEBHOOK_STAGE_SECONDS.labels('storage_flush')
+STAGE_PUSH = WEBHOOK_STAGE_SECONDS.labels('push')
+
+# イベント1件の処理時間と件数
+WEBHOOK_EVENT_SECONDS = registry.histogram(
+    'line_webhook_event_seconds',
+    'Webhookイベント1件の処理時間（秒）',
+    ('type',)
+)
+WEBHOOK_EVENTS = registry.counter(
+    'line_webhook_events_total',
+    '受信したWebhookイベント数（結果別）',
+    ('type', 'result')
+)
+
+# HTTPリクエスト
+HTTP_REQUEST_SECONDS = registry.histogram(
+    'line_webhook_http_request_seconds',
+    'HTTPリクエストの処理時間（秒）',
+    ('route', 'method')
+)
+HTTP_REQUESTS = registry.counter(
+    'line_webhook_http_requests_total',
+    'HTTPリクエスト数',
+    ('route', 'method', 'status')
+)
+
+# LINE APIの呼び出し
+LINE_API_REQUESTS = registry.counter(
+    'line_api_requests_total',
+    'LINE APIへのリクエスト数（ステータスコード別、errorは通信エラー）',
+    ('endpoint', 'status')
+)
+LINE_API_SECONDS = registry.histogram(
+    'line_api_request_seconds',
+    'LINE APIの応答時間（秒、リトライを含む）',
+    ('endpoint',)
+)
+
+
+def record_event(event_type, result, seconds=None):
+    """Webhookイベントの結果（accepted / duplicate / dropped / processed / failed）を記録"""
+    WEBHOOK_EVENTS.labels(event_type, result).inc()
+    if seconds is not None:
+        WEBHOOK_EVENT_SECONDS.labels(event_type).observe(seconds)
+
+
+def line_api_endpoint(path):
+    """メトリクス用にパスからユーザーIDなどを取り除く"""
+    if path.startswith('/v2/bot/profile/'):
+        return '/v2/bot/profile'
+    return path.split('?', 1)[0]
+
+
+def record_line_api(path, status, seconds):
+    """LINE API呼び出しの結果を記録"""
+    endpoint = line_api_endpoint(path)
+    LINE_API_REQUESTS.labels(endpoint, status).inc()
+    LINE_API_SECONDS.labels(endpoint).observe(seconds)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import sqlite3
+import argparse
+import threading
+
+import metrics
+from rate_limit import retry_after_seconds
+
+
+# 送信メッセージの保存先と再送設定
+OUTBOX_PATH = os.environ.get('OUTBOX_PATH', os.path.join(os.path.dirname(__file__), 'outbox.db'))
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '2'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_BASE_DELAY = float(os.environ.get('OUTBOX_BASE_DELAY', '1'))
+OUTBOX_MAX_DELAY = float(os.environ.get('OUTBOX_MAX_DELAY', '300'))
+OUTBOX_KEEP_SENT = float(os.environ.get('OUTBOX_KEEP_SENT', '86400'))
+# 送信中のまま止まったメッセージを別の送信スレッド・プロセスが送り直すまでの秒数
+OUTBOX_SENDING_LEASE = float(os.environ.get('OUTBOX_SENDING_LEASE', '300'))
+
+# 送信状態（dead: 再送をあきらめたもの）
+STATUSES = ('pending', 'sending', 'sent', 'dead')
+
+# 時間をおいて再送するステータスコード
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# 配信結果の件数
+OUTBOX_DELIVERIES = metrics.registry.counter(
+    'line_outbox_deliveries_total',
+    '送信キューからの送信結果（sent / retry / dead）',
+    ('result',)
+)
+
+
+class Outbox:
+    """プッシュメッセージをSQLiteに保存し、送信スレッドが再送しながら届ける
+
+    同じメッセージの再送には同じX-Line-Retry-Keyを使うため、受付済みのものが重複して届くことはない。
+    同じユーザー宛のメッセージは保存した順に送る。
+    """
+
+    def __init__(self, client, path=None, workers=2, max_attempts=8, base_delay=1.0,
+                 max_delay=300.0, keep_sent=86400, poll_interval=1.0, sending_lease=300.0):
+        self.client = client
+        self.path = path
+        self.workers = max(1, int(workers))
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.keep_sent = keep_sent
+        self.poll_interval = poll_interval
+        self.sending_lease = sending_lease
+
+        self._conn = sqlite3.connect(path or ':memory:', timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._deadline = None
+        self._last_prune = 0.0
+
+        if path:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    messages TEXT NOT NULL,
+                    kind TEXT NOT NULL DEFAULT '',
+                    retry_key TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    last_error TEXT
+                )
+            ''')
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox (status, next_attempt_at)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_user ON outbox (user_id, status)')
+
+    def start(self, recover=True):
+        """送信スレッドを起動（未送信のメッセージがあればすぐに送り始める）
+
+        recover: 送信中のまま止まったメッセージをすぐ未送信に戻す。同じファイルを複数のプロセスで
+        共有する場合は他のプロセスが送信中のものまで戻してしまうのでFalseにする
+        （その場合もsending_leaseを過ぎれば送り直す）。
+        """
+        with self._lock:
+            if self._threads:
+                return
+            if recover:
+                # 送信中に停止したものは未送信に戻す（同じリトライキーで再送するので重複しない）
+                with self._conn:
+                    recovered = self._conn.execute(
+                        "UPDATE outbox SET status = 'pending' WHERE status = 'sending'"
+                    ).rowcount
+                if recovered:
+                    print(f"♻️ 送信中だったメッセージを再送します: {recovered}件")
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'outbox-sender-{i}')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def enqueue(self, user_id, messages, kind=''):
+        """メッセージを保存して送信待ちにする（送信は待たない）"""
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                cursor = self._conn.execute(
+                    'INSERT INTO outbox (user_id, messages, kind, retry_key, next_attempt_at, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (user_id, json.dumps(messages, ensure_ascii=False), kind, str(uuid.uuid4()), now, now, now)
+                )
+        with self._wakeup:
+            self._wakeup.notify()
+        return cursor.lastrowid
+
+    def _claim(self):
+        """送信時刻を過ぎたメッセージを1件取り出して送信中にする（無ければ次の送信時刻）"""
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                # 同じファイルを共有する他のプロセスと同じメッセージを取り出さないよう、先に書き込みロックを取る
+                self._conn.execute('BEGIN IMMEDIATE')
+                row = self._conn.execute('''
+                    SELECT id, user_id, messages, retry_key, attempts FROM outbox AS o
+                    WHERE (
+                        (status = 'pending' AND next_attempt_at <= ?)
+                        OR (status = 'sending' AND updated_at <= ?)
+                    )
+                      AND NOT EXISTS (
+                          SELECT 1 FROM outbox AS p
+                          WHERE p.user_id = o.user_id AND p.id < o.id AND p.status IN ('pending', 'sending')
+                      )
+                    ORDER BY next_attempt_at, id LIMIT 1
+                ''', (now, now - self.sending_lease)).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE outbox SET status = 'sending', updated_at = ? WHERE id = ?", (now, row[0])
+                    )
+                    return row, None
+                # 各ユーザーの先頭のメッセージのうち、次に送信時刻を迎えるもの
+                next_at = self._conn.execute('''
+                    SELECT MIN(next_attempt_at) FROM outbox AS o
+                    WHERE status = 'pending'
+                      AND NOT EXISTS (
+                          SELECT 1 FROM outbox AS p
+                          WHERE p.user_id = o.user_id AND p.id < o.id AND p.status = 'pending'
+                      )
+                ''').fetchone()[0]
+                return None, next_at
+
+    def _finish(self, message_id, status, attempts, next_attempt_at=None, error=None):
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    'UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = COALESCE(?, next_attempt_at), '
+                    'updated_at = ?, last_error = ? WHERE id = ?',
+                    (status, attempts, next_attempt_at, now, error, message_id)
+                )
+                if status == 'sent' and now - self._last_prune > 60:
+                    # 送信済みの記録は一定期間だけ残す
+                    self._last_prune = now
+                    self._conn.execute(
+                        "DELETE FROM outbox WHERE status = 'sent' AND updated_at < ?", (now - self.keep_sent,)
+                    )
+        # 同じユーザー宛の次のメッセージを待っている送信スレッドを起こす
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _backoff(self, attempts):
+        """指数バックオフ（ジッター付き）"""
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _run(self):
+        """送信スレッドのメインループ"""
+        while True:
+            row, next_at = self._claim()
+            if row is None:
+                with self._wakeup:
+                    if self._stopping:
+                        return
+                    timeout = self.poll_interval
+                    if next_at is not None and next_at > time.time():
+                        # 送信中の前のメッセージ待ちの場合は_finishで起こされる
+                        timeout = min(timeout, next_at - time.time())
+                    self._wakeup.wait(timeout)
+                continue
+
+            if self._stopping and self._deadline is not None and time.monotonic() > self._deadline:
+                # 停止の期限を過ぎたら送信せずに戻し、次回起動時に送る
+                self._finish(row[0], 'pending', row[4])
+                return
+            self._deliver(*row)
+
+    def _deliver(self, message_id, user_id, messages, retry_key, attempts):
+        """1件送信し、結果に応じて送信済み・再送待ち・dead-letterにする"""
+        attempts += 1
+        retry_after = None
+        try:
+            with metrics.STAGE_PUSH.time():
+                response = self.client.push_message(user_id, json.loads(messages), retry_key=retry_key)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            retryable = True
+        else:
+            # 409は同じリトライキーのリクエストが受付済み
+            if response.status_code in (200, 409):
+                self._finish(message_id, 'sent', attempts)
+                OUTBOX_DELIVERIES.labels('sent').inc()
+                print(f"✅ メッセージ送信成功: {user_id}")
+                return
+            error = f'{response.status_code}: {response.text[:200]}'
+            retryable = response.status_code in RETRY_STATUSES
+            retry_after = retry_after_seconds(response.headers)
+
+        if not retryable or attempts >= self.max_attempts:
+            self._finish(message_id, 'dead', attempts, error=error)
+            OUTBOX_DELIVERIES.labels('dead').inc()
+            print(f"❌ メッセージ送信失敗（再送を中止）: {user_id}, {error}")
+            return
+
+        delay = self._backoff(attempts)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self._finish(message_id, 'pending', attempts, next_attempt_at=time.time() + delay, error=error)
+        OUTBOX_DELIVERIES.labels('retry').inc()
+        print(f"⚠️ メッセージ送信失敗（{delay:.1f}秒後に再送）: {user_id}, {error}")
+
+    def dead_letters(self, limit=100):
+        """再送をあきらめたメッセージ（新しい順）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, user_id, messages, kind, attempts, created_at, updated_at, last_error FROM outbox "
+                "WHERE status = 'dead' ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [
+            {
+                'id': row[0], 'user_id': row[1], 'messages': json.loads(row[2]), 'kind': row[3],
+                'attempts': row[4], 'created_at': row[5], 'updated_at': row[6], 'last_error': row[7],
+            }
+            for row in rows
+        ]
+
+    def retry_dead(self, ids=None):
+        """dead-letterのメッセージを送信待ちに戻す（idsを省略するとすべて）"""
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                if ids is None:
+                    cursor = self._conn.execute(
+                        "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'dead'",
+                        (now,)
+                    )
+                else:
+                    cursor = self._conn.executemany(
+                        "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ? "
+                        "WHERE status = 'dead' AND id = ?",
+                        [(now, message_id) for message_id in ids]
+                    )
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return cursor.rowcount
+
+    def stats(self):
+        """状態ごとの件数と、最も古い未送信メッセージの経過秒数を返す"""
+        with self._lock:
+            counts = dict(self._conn.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+            oldest = self._conn.execute(
+                "SELECT MIN(created_at) FROM outbox WHERE status IN ('pending', 'sending')"
+            ).fetchone()[0]
+        stats = {status: counts.get(status, 0) for status in STATUSES}
+        stats['oldest_pending_seconds'] = round(time.time() - oldest, 1) if oldest else 0.0
+        stats['workers'] = self.workers
+        return stats
+
+    def close(self, timeout=None):
+        """送信時刻を過ぎたメッセージをtimeout秒まで送ってから停止し、未送信の件数を返す
+
+        残りはファイルに保存されたままになり、次回起動時に送られる。
+        送信中のまま終わらないスレッドがある場合は、そのスレッドが結果を保存できるよう接続を閉じずに残す
+        （プロセスの終了時に閉じられる）。
+        """
+        with self._wakeup:
+            self._stopping = True
+            self._deadline = None if timeout is None else time.monotonic() + timeout
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(None if timeout is None else max(0.0, self._deadline - time.monotonic()) + 5)
+        running = sum(1 for thread in self._threads if thread.is_alive())
+        with self._lock:
+            remaining = self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending')"
+            ).fetchone()[0]
+            if running:
+                print(f"⚠️ 送信中のスレッドが残っているため、送信キューを閉じずに終了します: {running}件")
+            else:
+                self._conn.close()
+        return remaining
+
+
+def main():
+    parser = argparse.ArgumentParser(description='送信キューの確認・dead-letterの再送')
+    parser.add_argument('command', choices=['stats', 'dead', 'retry-dead'])
+    parser.add_argument('--path', default=OUTBOX_PATH, help='送信キューのファイル')
+    parser.add_argument('--limit', type=int, default=20, help='dead: 表示する件数')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        print(f"❌ 送信キューがありません: {args.path}")
+        sys.exit(1)
+
+    outbox = Outbox(None, args.path)
+    if args.command == 'stats':
+        print(json.dumps(outbox.stats(), ensure_ascii=False, indent=2))
+    elif args.command == 'dead':
+        for item in outbox.dead_letters(args.limit):
+            print(json.dumps(item, ensure_ascii=False))
+    else:
+        count = outbox.retry_dead()
+        print(f"✅ {count}件を送信待ちに戻しました（サーバーの次回送信時に送られます）")
+    outbox.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""複数プロセスでWebhookサーバーを動かす（プリフォーク）
+
+親プロセスが待ち受けソケットを作り、WEBHOOK_PROCESSES個の webhook_server.py を子プロセスとして起動する。
+子プロセスは同じソケットで接続を受け付け、状態はファイル（SQLite・flock）で共有する。
+
+    WEBHOOK_PROCESSES=4 python prefork.py
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import shlex
+import argparse
+import subprocess
+
+try:
+    import fcntl
+except ImportError:  # Windowsなど
+    fcntl = None
+
+
+def running_under_gunicorn():
+    """gunicornのワーカー（または--preloadで読み込む親プロセス）として動いているか"""
+    return 'gunicorn' in sys.modules or 'gunicorn' in os.path.basename(sys.argv[0] if sys.argv else '')
+
+
+def gunicorn_workers():
+    """gunicornのワーカー数（コマンドライン・GUNICORN_CMD_ARGS・WEB_CONCURRENCYから読む）
+
+    設定ファイルで指定されている可能性があって読み取れない場合は、安全側に倒して2（複数）とみなす。
+    """
+    args = sys.argv[1:] + shlex.split(os.environ.get('GUNICORN_CMD_ARGS', ''))
+    workers = None
+    config_file = os.path.exists('gunicorn.conf.py')
+    for i, arg in enumerate(args):
+        if arg in ('-w', '--workers') and i + 1 < len(args):
+            workers = args[i + 1]
+        elif arg.startswith('--workers='):
+            workers = arg.split('=', 1)[1]
+        elif arg.startswith('-w') and arg[2:].isdigit():
+            workers = arg[2:]
+        elif arg in ('-c', '--config') or arg.startswith('--config='):
+            config_file = True
+    if workers is None:
+        workers = os.environ.get('WEB_CONCURRENCY')
+    if workers is not None:
+        try:
+            return max(1, int(workers))
+        except ValueError:
+            pass
+    return 2 if config_file else 1
+
+
+def server_processes():
+    """このサーバーを動かすプロセス数（WEBHOOK_PROCESSESが未設定ならgunicornの設定から推定）"""
+    if os.environ.get('WEBHOOK_PROCESSES'):
+        return int(os.environ['WEBHOOK_PROCESSES'])
+    if running_under_gunicorn():
+        return gunicorn_workers()
+    return 1
+
+
+# 同時に動かすワーカープロセス数（gunicornで起動した場合はワーカー数から推定する）
+WEBHOOK_PROCESSES = server_processes()
+# 子プロセスが受け付けに使う待ち受けソケット（親プロセスが設定する）
+WEBHOOK_SERVER_FD = os.environ.get('WEBHOOK_SERVER_FD', '')
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.environ.get('WEBHOOK_SHUTDOWN_TIMEOUT', '25'))
+
+# 設定が安全でないため起動しなかった場合の終了コード（親プロセスは再起動しない）
+EXIT_UNSAFE_CONFIG = 78
+
+# 複数プロセスでは空（メモリのみ）にできない保存先と、その理由
+REQUIRED_SHARED_PATHS = (
+    ('EVENT_DEDUP_PATH', 'LINEが再送したイベントを別のプロセスが重複して処理します'),
+    ('LINE_RATE_LIMIT_PATH', 'プロセスごとにLINE APIの上限まで送信してしまいます'),
+    ('BROADCAST_JOBS_PATH', '配信の進捗ページが別のプロセスでは見つかりません'),
+    ('DATA_VERSION_PATH', '他のプロセスが記録を書き込んでも/statsなどのページが更新されません'),
+)
+
+
+def shared_default(filename):
+    """共有状態の既定の保存先（複数プロセスのときはファイル、単一プロセスでは空＝メモリのみ）"""
+    if WEBHOOK_PROCESSES > 1:
+        return os.path.join(os.path.dirname(__file__), filename)
+    return ''
+
+
+def unsafe_settings(settings):
+    """複数プロセスで動かすと記録が壊れる・重複する設定の一覧（settingsは設定名 -> 値）"""
+    problems = []
+    if settings.get('WEBHOOK_MODE', 'threaded') != 'threaded':
+        problems.append('WEBHOOK_MODE=async は複数プロセスに対応していません（threadedを使用してください）')
+    for name, reason in REQUIRED_SHARED_PATHS:
+        if not settings.get(name):
+            problems.append(f'{name} が空です（{reason}）')
+    if settings.get('STORAGE_BACKEND') in ('csv', 'partitioned') and fcntl is None:
+        problems.append('この環境ではファイルロックが使えないため、CSVへの同時書き込みが混ざります（STORAGE_BACKEND=sqliteを使用してください）')
+    return problems
+
+
+def check_config(settings):
+    """複数プロセス構成で安全でない設定なら起動を中止する"""
+    if WEBHOOK_PROCESSES <= 1:
+        return
+    problems = unsafe_settings(settings)
+    if not problems:
+        print(f"✅ 複数プロセス構成: {WEBHOOK_PROCESSES}プロセス (pid={os.getpid()})")
+        return
+    for problem in problems:
+        print(f"❌ {problem}")
+    print("❌ 複数プロセス構成では安全でない設定のため起動を中止します")
+    sys.exit(EXIT_UNSAFE_CONFIG)
+
+
+def fork_guard_needed():
+    """読み込み済みのサーバーがforkされ得る構成か（複数プロセス・gunicorn）"""
+    return WEBHOOK_PROCESSES > 1 or running_under_gunicorn()
+
+
+def refuse_forked_child():
+    """読み込み済みのサーバーをforkした子プロセスを止める（gunicornの--preloadなど）
+
+    fork後の子プロセスには書き込み・送信スレッドが無く、SQLiteの接続も親と共有してしまう。
+    """
+    print("❌ 初期化済みのサーバーがforkされました。--preloadを使わずに各プロセスで読み込んでください")
+    os._exit(EXIT_UNSAFE_CONFIG)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Webhookサーバーを複数プロセスで起動する')
+    parser.add_argument('--processes', type=int, default=max(2, WEBHOOK_PROCESSES), help='ワーカープロセス数')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    args = parser.parse_args()
+
+    listener = socket.create_server((args.host, args.port), backlog=1024)
+    listener.set_inheritable(True)
+    env = dict(os.environ, WEBHOOK_PROCESSES=str(args.processes), WEBHOOK_SERVER_FD=str(listener.fileno()))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webhook_server.py')
+
+    def spawn():
+        return subprocess.Popen([sys.executable, script], env=env, pass_fds=[listener.fileno()])
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(f"🚀 サーバー起動: ポート {args.port}、{args.processes}プロセス")
+    children = [spawn() for _ in range(args.processes)]
+    exit_code = 0
+    while not stopping:
+        time.sleep(0.5)
+        for i, child in enumerate(children):
+            code = child.poll()
+            if code is None or stopping:
+                continue
+            if code == EXIT_UNSAFE_CONFIG:
+                print("❌ 設定が安全でないため、すべてのプロセスを停止します")
+                stopping.append(None)
+                exit_code = 1
+                break
+            print(f"⚠️ ワーカープロセスが終了しました（pid={child.pid}, 終了コード={code}）。再起動します")
+            children[i] = spawn()
+
+    # 子プロセスは残りのイベント・記録・送信キューを処理してから終了する
+    print("🛑 シャットダウン: ワーカープロセスを停止します")
+    for child in children:
+        if child.poll() is None:
+            child.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + WEBHOOK_SHUTDOWN_TIMEOUT * 2 + 10
+    for child in children:
+        try:
+            child.wait(max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            print(f"⚠️ 停止しないため強制終了します: pid={child.pid}")
+            child.kill()
+    listener.close()
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
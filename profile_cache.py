@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class _Flight:
+    """取得中のキーを待ち合わせるための情報"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+
+class ProfileCache:
+    """サイズ上限・TTL付きのLRUキャッシュ（失敗結果の短期キャッシュと同時取得の集約に対応）
+
+    shared_pathを指定すると、メモリに無いキーは同じホストの他のプロセスと共有するSQLiteから探し、
+    取得した値もそこに書く（複数プロセスでも同じユーザーのプロフィールを何度も取得しない）。
+    """
+
+    def __init__(self, maxsize=10000, ttl=86400, negative_ttl=60, path=None, shared_path=None):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.path = path
+        self.shared_path = shared_path
+
+        # key -> (value, expires_at)。valueがNoneのものは取得失敗のキャッシュ
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+        self._shared_hits = 0
+
+        self._shared = None
+        self._shared_lock = threading.Lock()
+        if shared_path:
+            self._shared = sqlite3.connect(shared_path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._shared.execute('PRAGMA journal_mode=WAL')
+            self._shared.execute('PRAGMA synchronous=OFF')
+            self._shared.execute(
+                'CREATE TABLE IF NOT EXISTS profiles (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+
+    def get(self, key, loader):
+        """キャッシュから値を取得し、無ければloader(key)で取得する（失敗時はNone）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    if value is None:
+                        self._negative_hits += 1
+                    else:
+                        self._hits += 1
+                    return value
+                del self._entries[key]
+
+            flight = self._inflight.get(key)
+            if flight is not None:
+                # 同じキーを取得中のスレッドがあれば結果を待つ
+                self._coalesced += 1
+                leader = False
+            else:
+                flight = _Flight()
+                self._inflight[key] = flight
+                self._misses += 1
+                leader = True
+
+        if not leader:
+            flight.event.wait()
+            return flight.value
+
+        value = None
+        try:
+            value, expires_at = self._shared_get(key)
+            if value is not None:
+                with self._lock:
+                    self._shared_hits += 1
+            else:
+                value = loader(key)
+                self._shared_put(key, value)
+                expires_at = None
+        finally:
+            with self._lock:
+                self._store(key, value, expires_at)
+                del self._inflight[key]
+            flight.value = value
+            flight.event.set()
+
+        return value
+
+    def _shared_get(self, key):
+        """共有キャッシュから(値, 有効期限)を取得（無ければ(None, None)）"""
+        if self._shared is None:
+            return None, None
+        try:
+            with self._shared_lock:
+                row = self._shared.execute(
+                    'SELECT value, expires_at FROM profiles WHERE key = ? AND expires_at > ?', (key, time.time())
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"⚠️ 共有プロフィールキャッシュ読み込み失敗: {e}")
+            return None, None
+        return (row[0], row[1]) if row else (None, None)
+
+    def _shared_put(self, key, value):
+        """取得できた値を共有キャッシュに書く（取得失敗は共有しない）"""
+        if self._shared is None or value is None or self.ttl <= 0:
+            return
+        try:
+            with self._shared_lock:
+                self._shared.execute(
+                    'INSERT OR REPLACE INTO profiles (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, value, time.time() + self.ttl)
+                )
+        except sqlite3.Error as e:
+            print(f"⚠️ 共有プロフィールキャッシュ書き込み失敗: {e}")
+
+    def lookup(self, key):
+        """キャッシュのみを参照して(見つかったか, 値)を返す（非同期処理からの利用向け）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    if value is None:
+                        self._negative_hits += 1
+                    else:
+                        self._hits += 1
+                    return True, value
+                del self._entries[key]
+            return False, None
+
+    def put(self, key, value):
+        """取得結果を保存（Noneは取得失敗として短期間キャッシュ）"""
+        with self._lock:
+            self._store(key, value)
+        self._shared_put(key, value)
+
+    def record_miss(self, coalesced=False):
+        """lookupで見つからなかった取得を統計に加える（coalesced: 他の取得結果を待った）"""
+        with self._lock:
+            if coalesced:
+                self._coalesced += 1
+            else:
+                self._misses += 1
+
+    def _store(self, key, value, expires_at=None):
+        """エントリを保存（ロック取得済みで呼ぶ）"""
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        self._entries[key] = (value, expires_at or time.time() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def invalidate(self, key):
+        """エントリを削除"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        """ヒット・ミス数などの統計を返す"""
+        with self._lock:
+            lookups = self._hits + self._negative_hits + self._misses + self._coalesced
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self._hits,
+                'negative_hits': self._negative_hits,
+                'misses': self._misses,
+                'coalesced': self._coalesced,
+                'evictions': self._evictions,
+                'shared': self._shared is not None,
+                'shared_hits': self._shared_hits,
+                'hit_rate': round((self._hits + self._negative_hits + self._coalesced) / lookups, 3) if lookups else 0.0,
+            }
+
+    def load(self):
+        """ファイルから有効期限内のエントリを読み込む"""
+        if not self.path or not os.path.exists(self.path):
+            return 0
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"⚠️ プロフィールキャッシュ読み込み失敗: {e}")
+            return 0
+
+        now = time.time()
+        loaded = 0
+        with self._lock:
+            for key, (value, expires_at) in data.items():
+                if value is not None and expires_at > now:
+                    self._entries[key] = (value, expires_at)
+                    loaded += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return loaded
+
+    def save(self):
+        """有効期限内のエントリをファイルに保存（取得失敗のキャッシュは保存しない）"""
+        if not self.path:
+            return 0
+
+        now = time.time()
+        with self._lock:
+            data = OrderedDict(
+                (key, [value, expires_at])
+                for key, (value, expires_at) in self._entries.items()
+                if value is not None and expires_at > now
+            )
+
+        # 同じファイルに保存する他のプロセスと一時ファイルが重ならないようにする
+        tmp_path = f'{self.path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"⚠️ プロフィールキャッシュ保存失敗: {e}")
+            return 0
+        return len(data)
+
+    def close(self):
+        with self._shared_lock:
+            if self._shared is not None:
+                self._shared.close()
+                self._shared = None
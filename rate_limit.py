@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import sqlite3
+import threading
+
+import metrics
+from prefork import shared_default
+
+
+# エンドポイントごとの毎秒リクエスト数の上限（バースト量は1秒分）
+LINE_RATE_PUSH = float(os.environ.get('LINE_RATE_PUSH', '100'))
+LINE_RATE_PROFILE = float(os.environ.get('LINE_RATE_PROFILE', '100'))
+LINE_RATE_MULTICAST = float(os.environ.get('LINE_RATE_MULTICAST', os.environ.get('BROADCAST_RATE_LIMIT', '20')))
+# チャネル全体（全エンドポイント合計）の上限
+LINE_RATE_TOTAL = float(os.environ.get('LINE_RATE_TOTAL', '200'))
+# 配信などの一括送信が使わずに残しておく割合（自動返信などの対話的な送信用）
+LINE_RATE_BULK_RESERVE = float(os.environ.get('LINE_RATE_BULK_RESERVE', '0.2'))
+# 同じホストの複数プロセスで上限を共有する場合の状態ファイル（空でプロセス内のみ。WEBHOOK_PROCESSES>1では既定でファイル）
+LINE_RATE_LIMIT_PATH = os.environ.get('LINE_RATE_LIMIT_PATH', shared_default('rate_limit.db'))
+
+# 優先度（interactive: 自動返信・挨拶・プロフィール取得、bulk: 一括配信）
+PRIORITIES = ('interactive', 'bulk')
+
+# チャネル全体のバケットのキー
+TOTAL = '*'
+
+# 429を受けたときの最低停止秒数・速度の下限・元の速度に戻るまでの秒数
+DEFAULT_PENALTY_SECONDS = 1.0
+MIN_RATE_MULTIPLIER = 0.1
+RECOVERY_SECONDS = 30.0
+
+# 送信枠を待った時間
+RATE_WAIT_SECONDS = metrics.registry.histogram(
+    'line_api_rate_limit_wait_seconds',
+    'LINE APIの送信枠を待った時間（秒）',
+    ('endpoint', 'priority')
+)
+
+
+def default_limits():
+    """環境変数から (毎秒の上限, バースト量) をエンドポイントごとに返す"""
+    limits = {}
+    for endpoint, rate in (
+        ('/v2/bot/message/push', LINE_RATE_PUSH),
+        ('/v2/bot/profile', LINE_RATE_PROFILE),
+        ('/v2/bot/message/multicast', LINE_RATE_MULTICAST),
+        (TOTAL, LINE_RATE_TOTAL),
+    ):
+        if rate > 0:
+            limits[endpoint] = (rate, max(1.0, rate))
+    return limits
+
+
+class _BucketState:
+    """トークンバケットの状態"""
+
+    __slots__ = ('tokens', 'updated_at', 'blocked_until', 'multiplier', 'penalized_at')
+
+    def __init__(self, tokens, updated_at, blocked_until=0.0, multiplier=1.0, penalized_at=0.0):
+        self.tokens = tokens
+        self.updated_at = updated_at
+        self.blocked_until = blocked_until
+        self.multiplier = multiplier
+        self.penalized_at = penalized_at
+
+
+class RateLimiter:
+    """LINE APIのエンドポイントごとのトークンバケット（スレッドセーフ）
+
+    - 各リクエストはエンドポイントのバケットと、あればチャネル全体（'*'）のバケットから1つずつ取る。
+    - bulkはバケットの一定割合（bulk_reserve）を残してしか使えず、同じプロセスで
+      interactiveが待っている間は待つ。
+    - 429を受けたらRetry-Afterの間は止め、速度を半分に落としてRECOVERY_SECONDSかけて戻す。
+    - pathを指定すると状態をSQLiteに置き、同じホストの複数プロセスで上限を共有する。
+    """
+
+    def __init__(self, limits=None, bulk_reserve=0.2, path=None):
+        self.limits = dict(default_limits() if limits is None else limits)
+        self.bulk_reserve = min(max(bulk_reserve, 0.0), 0.9)
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._states = {}
+        self._interactive_waiting = {}
+        self._waits = {}
+        self._penalties = {}
+        self._conn = None
+
+        if path:
+            self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=OFF')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_buckets (
+                    endpoint TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    blocked_until REAL NOT NULL DEFAULT 0,
+                    multiplier REAL NOT NULL DEFAULT 1,
+                    penalized_at REAL NOT NULL DEFAULT 0
+                )
+            ''')
+
+    # --- 状態の読み書き（メモリまたはSQLite。ロック取得済みで呼ぶ） ---
+
+    def _load(self, endpoint, now):
+        if self._conn is None:
+            state = self._states.get(endpoint)
+            if state is None:
+                state = self._states[endpoint] = _BucketState(self.limits[endpoint][1], now)
+            return state
+        row = self._conn.execute(
+            'SELECT tokens, updated_at, blocked_until, multiplier, penalized_at FROM rate_buckets WHERE endpoint = ?',
+            (endpoint,)
+        ).fetchone()
+        if row is None:
+            return _BucketState(self.limits[endpoint][1], now)
+        return _BucketState(*row)
+
+    def _save(self, endpoint, state):
+        if self._conn is None:
+            return
+        self._conn.execute(
+            'INSERT OR REPLACE INTO rate_buckets (endpoint, tokens, updated_at, blocked_until, multiplier, penalized_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (endpoint, state.tokens, state.updated_at, state.blocked_until, state.multiplier, state.penalized_at)
+        )
+
+    def _transaction(self, func):
+        """状態の読み書きを1つのトランザクションで行う（プロセス間で排他）"""
+        if self._conn is None:
+            return func()
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = func()
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+        return result
+
+    # --- トークンの計算 ---
+
+    def _multiplier(self, state, now):
+        """429後に落とした速度を時間とともに元に戻す"""
+        if state.multiplier >= 1.0:
+            return 1.0
+        recovered = state.multiplier + (now - state.penalized_at) / RECOVERY_SECONDS
+        return min(1.0, recovered)
+
+    def _refill(self, endpoint, state, now):
+        rate, capacity = self.limits[endpoint]
+        elapsed = max(0.0, now - state.updated_at)
+        state.tokens = min(capacity, state.tokens + elapsed * rate * self._multiplier(state, now))
+        state.updated_at = now
+
+    def _keys(self, endpoint):
+        """リクエストがトークンを取るバケット"""
+        keys = [endpoint] if endpoint in self.limits else []
+        if TOTAL in self.limits and endpoint != TOTAL:
+            keys.append(TOTAL)
+        return keys
+
+    def _take(self, keys, priority, now):
+        """すべてのバケットからトークンを1つずつ取る。取れたら0、取れなければ次に試すまでの秒数"""
+        def take():
+            states = []
+            wait = 0.0
+            for key in keys:
+                state = self._load(key, now)
+                self._refill(key, state, now)
+                states.append((key, state))
+                if state.blocked_until > now:
+                    wait = max(wait, state.blocked_until - now)
+                    continue
+                rate, capacity = self.limits[key]
+                needed = 1.0
+                if priority == 'bulk':
+                    needed = max(1.0, min(capacity, needed + self.bulk_reserve * capacity))
+                if state.tokens < needed:
+                    wait = max(wait, (needed - state.tokens) / (rate * self._multiplier(state, now)))
+            if wait <= 0:
+                for key, state in states:
+                    state.tokens -= 1.0
+            for key, state in states:
+                self._save(key, state)
+            return wait
+        return self._transaction(take)
+
+    # --- 公開API ---
+
+    def try_acquire(self, endpoint, priority='interactive'):
+        """待たずにトークンを取る。取れたら0、取れなければ次に試すまでの秒数（asyncio用）"""
+        keys = self._keys(endpoint)
+        if not keys:
+            return 0.0
+        with self._lock:
+            if priority == 'bulk' and self._interactive_waiting.get(TOTAL, 0) + self._interactive_waiting.get(endpoint, 0):
+                return 0.01
+            return self._take(keys, priority, time.time())
+
+    def acquire(self, endpoint, priority='interactive'):
+        """トークンが取れるまで待つ（待った秒数を返す）"""
+        keys = self._keys(endpoint)
+        if not keys:
+            return 0.0
+        started = time.monotonic()
+        with self._cond:
+            if priority == 'interactive':
+                for key in keys:
+                    self._interactive_waiting[key] = self._interactive_waiting.get(key, 0) + 1
+            try:
+                while True:
+                    if priority == 'bulk' and any(self._interactive_waiting.get(key) for key in keys):
+                        # 対話的な送信が同じバケットを待っている間は譲る
+                        self._cond.wait(0.05)
+                        continue
+                    wait = self._take(keys, priority, time.time())
+                    if wait <= 0:
+                        break
+                    # 他のプロセスがトークンを使う場合もあるので長くは眠らない
+                    self._cond.wait(min(wait, 0.5))
+            finally:
+                if priority == 'interactive':
+                    for key in keys:
+                        self._interactive_waiting[key] -= 1
+                    self._cond.notify_all()
+
+        waited = time.monotonic() - started
+        self.record_wait(endpoint, priority, waited)
+        return waited
+
+    def record_wait(self, endpoint, priority, waited):
+        """待ち時間を統計に加える"""
+        RATE_WAIT_SECONDS.labels(endpoint, priority).observe(waited)
+        if waited > 0.001:
+            with self._lock:
+                key = f'{endpoint} {priority}'
+                self._waits[key] = self._waits.get(key, 0) + 1
+
+    def penalize(self, endpoint, retry_after=None):
+        """429を受けたときにRetry-Afterの間止め、速度を落とす"""
+        if endpoint not in self.limits:
+            return
+        pause = retry_after if retry_after is not None else DEFAULT_PENALTY_SECONDS
+        now = time.time()
+
+        def update():
+            state = self._load(endpoint, now)
+            self._refill(endpoint, state, now)
+            state.multiplier = max(MIN_RATE_MULTIPLIER, self._multiplier(state, now) * 0.5)
+            state.penalized_at = now
+            state.blocked_until = max(state.blocked_until, now + pause)
+            state.tokens = 0.0
+            self._save(endpoint, state)
+
+        with self._cond:
+            self._transaction(update)
+            self._penalties[endpoint] = self._penalties.get(endpoint, 0) + 1
+            self._cond.notify_all()
+        print(f"⏳ LINE APIのレート制限: {endpoint} を{pause:.1f}秒停止し、速度を落とします")
+
+    def stats(self):
+        """エンドポイントごとの残りトークン・実効速度・停止中の秒数など"""
+        now = time.time()
+        with self._lock:
+            buckets = {}
+            for endpoint, (rate, capacity) in self.limits.items():
+                state = self._load(endpoint, now)
+                self._refill(endpoint, state, now)
+                buckets[endpoint] = {
+                    'rate_per_second': rate,
+                    'effective_rate': round(rate * self._multiplier(state, now), 2),
+                    'tokens': round(state.tokens, 2),
+                    'blocked_seconds': round(max(0.0, state.blocked_until - now), 2),
+                    'throttled_429': self._penalties.get(endpoint, 0),
+                }
+            return {
+                'shared': self._conn is not None,
+                'bulk_reserve': self.bulk_reserve,
+                'buckets': buckets,
+                'waits': dict(self._waits),
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def retry_after_seconds(headers):
+    """Retry-Afterヘッダー（秒数）を解釈"""
+    try:
+        return max(0.0, float(headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return None
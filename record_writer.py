@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import threading
+
+import metrics
+
+
+# 停止要求を書き込みスレッドに知らせるセンチネル
+_STOP = object()
+
+# 停止要求後、投入中の書き込みが終わったかを確かめる間隔（秒）
+_STOP_POLL_INTERVAL = 0.05
+
+# fsyncの方針
+FSYNC_POLICIES = ('none', 'batch', 'record')
+
+
+class RecordWriter:
+    """専用スレッドでレコードをまとめてストレージに書き込む（グループコミット）"""
+
+    def __init__(self, storage, batch_size=200, flush_interval=0.2, fsync='batch',
+                 queue_size=10000, retries=3, on_flush=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'不明なfsync方針: {fsync}')
+
+        self.storage = storage
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.retries = retries
+        # 書き込み後に呼ぶ関数（顧客テーブルの更新など。書き込みスレッドで実行）
+        self.on_flush = on_flush
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        # 停止の判定と、キューへ投入中の書き込みの数を守るロック（投入を待つ間は持たない）
+        self._write_lock = threading.Lock()
+        self._writers = 0
+        self._thread = None
+        self._closed = False
+
+        # 統計情報
+        self._written = 0
+        self._batches = 0
+        self._dropped = 0
+        self._last_batch_size = 0
+        self._last_flush_seconds = 0.0
+
+    def _ensure_started(self):
+        """書き込みスレッドを起動（初回書き込み時に遅延起動）"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name='record-writer')
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+
+    def write(self, record):
+        """レコードを書き込みキューに投入（停止後はRuntimeError）
+
+        ディスクへの書き込みは待たないが、キューが満杯の間は空くまで待つ。
+        停止前に受け付けたレコードは、停止中でも書き込みスレッドがすべて書き込む。
+        """
+        with self._write_lock:
+            if self._closed:
+                raise RuntimeError('RecordWriterは停止済みです')
+            self._writers += 1
+            self._ensure_started()
+        try:
+            self._queue.put(record)
+        finally:
+            with self._write_lock:
+                self._writers -= 1
+
+    def _finished(self):
+        """停止要求後に受け付けたレコードをすべて書き込んだか"""
+        with self._write_lock:
+            return self._closed and self._writers == 0 and self._queue.empty()
+
+    def _run(self):
+        """キューからレコードを集め、バッチ単位で書き込む（停止要求後はキューが空になったら終了）"""
+        while True:
+            try:
+                # 停止要求後は、投入中の書き込みが残っていないかを区切って確かめる
+                item = self._queue.get(timeout=_STOP_POLL_INTERVAL if self._closed else None)
+            except queue.Empty:
+                item = _STOP
+            else:
+                if item is _STOP:
+                    self._queue.task_done()
+            if item is _STOP:
+                if self._finished():
+                    break
+                continue
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    continue
+                batch.append(item)
+
+            self._flush(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _flush(self, batch):
+        """バッチを書き込む（失敗時は数回リトライ）"""
+        started = time.monotonic()
+        for attempt in range(self.retries + 1):
+            try:
+                self.storage.append_many(batch, fsync=self.fsync)
+                break
+            except Exception as e:
+                if attempt >= self.retries:
+                    print(f"❌ 記録書き込みエラー: {len(batch)}件を破棄しました: {e}")
+                    import traceback
+                    traceback.print_exc()
+                    with self._lock:
+                        self._dropped += len(batch)
+                    return
+                print(f"⚠️ 記録書き込みリトライ: {e}")
+                time.sleep(0.1 * (2 ** attempt))
+
+        metrics.STAGE_STORAGE.observe(time.monotonic() - started)
+        with self._lock:
+            self._written += len(batch)
+            self._batches += 1
+            self._last_batch_size = len(batch)
+            self._last_flush_seconds = time.monotonic() - started
+
+        if self.on_flush is not None:
+            try:
+                self.on_flush(batch)
+            except Exception as e:
+                print(f"⚠️ 書き込み後の処理でエラー: {e}")
+
+    def flush(self):
+        """キューに入っているレコードがすべて書き込まれるまで待つ"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def stats(self):
+        """書き込み状況を返す"""
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'written': self._written,
+                'batches': self._batches,
+                'dropped': self._dropped,
+                'last_batch_size': self._last_batch_size,
+                'last_flush_seconds': round(self._last_flush_seconds, 4),
+                'fsync': self.fsync,
+            }
+
+    def close(self, timeout=None):
+        """残りのレコードをすべて書き込んでから停止（timeout秒以内に終わらなければFalse）"""
+        with self._write_lock:
+            self._closed = True
+            thread = self._thread
+        if thread is None:
+            return True
+        # 待っている書き込みスレッドを起こす（満杯なら書き込みスレッドは動いているので不要）
+        try:
+            self._queue.put_nowait(_STOP)
+        except queue.Full:
+            pass
+        thread.join(timeout)
+        return not thread.is_alive()
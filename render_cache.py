@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import gzip
+import time
+import uuid
+import hashlib
+import threading
+from datetime import datetime, timezone
+
+from storage import file_lock
+from prefork import shared_default
+
+
+# データの版の保存先（空でプロセス内のみ。WEBHOOK_PROCESSES>1では既定でファイル）
+DATA_VERSION_PATH = os.environ.get('DATA_VERSION_PATH', shared_default('data_version.json'))
+
+
+class DataVersion:
+    """記録を書き込むたびに増やすデータの版（描画結果のキャッシュのキー）
+
+    pathを指定すると版をファイルに置き、同じファイルを使う他のプロセスの書き込みも反映する。
+    版を確かめるときはファイルの更新を調べるだけで、ストレージは読まない。
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._version = 0
+        self._changed_at = time.time()
+        self._signature = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _load(self):
+        """ファイルが更新されていれば読み直す（ロック取得済みで呼ぶ）"""
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._version = data['version']
+        self._changed_at = data['changed_at']
+        self._signature = signature
+
+    def bump(self):
+        """版を1つ進める（記録を書き込んだ後に呼ぶ）"""
+        with self._lock:
+            if self.path is None:
+                self._version += 1
+                self._changed_at = time.time()
+                return self._version
+            with file_lock(f'{self.path}.lock'):
+                self._signature = None
+                self._load()
+                data = {'version': self._version + 1, 'changed_at': time.time()}
+                tmp_path = f'{self.path}.{uuid.uuid4().hex}.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+                self._load()
+            return self._version
+
+    def current(self):
+        """(版, 最後に書き込まれた日時のUNIX秒)"""
+        with self._lock:
+            if self.path is not None:
+                self._load()
+            return self._version, self._changed_at
+
+
+class RenderedPage:
+    """描画済みのページ（gzip圧縮済みの本文・ETag・更新日時を含む）"""
+
+    def __init__(self, body, modified_at):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        # 毎回圧縮しないよう、描画したときに最大の圧縮率で1回だけ圧縮しておく
+        self.gzipped = gzip.compress(self.body, compresslevel=9, mtime=0)
+        self.etag = hashlib.sha1(self.body).hexdigest()[:20]
+        self.modified_at = datetime.fromtimestamp(int(modified_at), timezone.utc)
+
+
+class RenderCache:
+    """ページの描画結果をデータの版ごとに保持する
+
+    データに依存するページは版が変わるまで、静的なページはプロセスが終わるまで描画し直さない。
+    """
+
+    def __init__(self, data_version):
+        self.data_version = data_version
+        self._lock = threading.Lock()
+        self._pages = {}
+        # ページごとの描画ロック（同じページの描画は1回だけにし、他のページは待たせない）
+        self._render_locks = {}
+        self._started_at = time.time()
+        self.hits = 0
+        self.renders = 0
+
+    def get(self, key, render, static=False):
+        """keyのページを返す（renderがNoneを返した場合はキャッシュしてNone）
+
+        同じページを同時に要求された場合も、描画するのは1回だけにする。
+        描画中も他のページはキャッシュから返せるよう、全体のロックは参照・保存のときだけ取る。
+        """
+        if static:
+            version, modified_at = None, self._started_at
+        else:
+            version, modified_at = self.data_version.current()
+        page = self._cached(key, version)
+        if page is not False:
+            return page
+        with self._lock:
+            render_lock = self._render_locks.setdefault(key, threading.Lock())
+        with render_lock:
+            # 待っている間に他のスレッドが描画していればそれを返す
+            page = self._cached(key, version)
+            if page is not False:
+                return page
+            body = render()
+            page = RenderedPage(body, modified_at) if body is not None else None
+            with self._lock:
+                self._pages[key] = (version, page)
+                self.renders += 1
+            return page
+
+    def _cached(self, key, version):
+        """版が一致するキャッシュ（無ければFalse。描画結果がNoneの場合もあるため）"""
+        with self._lock:
+            cached = self._pages.get(key)
+            if cached is not None and cached[0] == version:
+                self.hits += 1
+                return cached[1]
+            return False
+
+    def stats(self):
+        """キャッシュの件数・ヒット数・描画回数とデータの版"""
+        with self._lock:
+            pages = len(self._pages)
+            hits = self.hits
+            renders = self.renders
+        version, changed_at = self.data_version.current()
+        return {
+            'pages': pages,
+            'hits': hits,
+            'renders': renders,
+            'data_version': version,
+            'data_changed_at': datetime.fromtimestamp(changed_at).strftime('%Y-%m-%d %H:%M:%S'),
+        }
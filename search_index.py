@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import math
+import time
+import sqlite3
+import heapq
+import argparse
+import threading
+import unicodedata
+from collections import Counter
+
+from storage import open_storage, COLUMNS, CSV_HEADER
+
+
+# 検索インデックスの保存先
+SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH', os.path.join(os.path.dirname(__file__), 'search_index.db'))
+
+# 検索語の最大数と1ページの最大件数
+SEARCH_MAX_TERMS = 8
+SEARCH_MAX_PER_PAGE = 100
+
+# 1回の検索で読む候補の上限（一致がこれより多い場合は新しい記録からこの件数の中で順位を付ける）
+SEARCH_MAX_CANDIDATES = int(os.environ.get('SEARCH_MAX_CANDIDATES', '1000'))
+
+# BM25のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 1回のトランザクションで索引に加える記録の数
+INDEX_BATCH_SIZE = 5000
+
+# 検索で絞り込める列（start/endはタイムスタンプの範囲、それ以外は完全一致）
+SEARCH_FILTERS = ('user_id', 'message_type', 'reply_status', 'monetization')
+
+
+def normalize(text):
+    """検索用に正規化（全角英数・半角カナの統一と小文字化）"""
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def text_grams(text):
+    """正規化済みの文字列を2文字ずつに区切った語（bigram）と出現回数
+
+    日本語は単語の区切りが無いため、2文字ずつずらして索引に登録する。
+    末尾の1文字も登録し、どの文字もいずれかの語の先頭になるようにする（1文字の検索語用）。
+    """
+    grams = Counter(text[i:i + 2] for i in range(len(text) - 1))
+    if text:
+        grams[text[-1]] += 1
+    return grams
+
+
+def parse_query(query):
+    """検索語を空白で区切って正規化する（重複は除く）"""
+    terms = []
+    for term in normalize(query).split():
+        if term not in terms:
+            terms.append(term)
+    return terms[:SEARCH_MAX_TERMS]
+
+
+class SearchIndex:
+    """メッセージ内容の全文検索インデックス（2文字単位の転置索引、SQLite）
+
+    顧客テーブルと同じく、ストレージの記録を前回の位置から追いかけて索引に加える。
+    検索語ごとに最も出現の少ない語の索引から候補を取り出し、検索語をそのまま含むかを確かめてから
+    BM25で順位を付ける。候補は新しい記録から読み、SEARCH_MAX_CANDIDATES件で打ち切るため、
+    よく現れる語でも検索の手間は一定に収まる。
+    """
+
+    def __init__(self, storage, path=None):
+        self.storage = storage
+        self.path = path
+        self._lock = threading.Lock()
+        self._validated = False
+        self._applied = 0
+        self._last_catch_up_seconds = 0.0
+
+        self._conn = sqlite3.connect(path or ':memory:', timeout=30, isolation_level=None, check_same_thread=False)
+        if path:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS docs (
+                doc_id INTEGER PRIMARY KEY,
+                {", ".join(f"{name} TEXT NOT NULL DEFAULT ''" for name in COLUMNS)},
+                norm TEXT NOT NULL,
+                length INTEGER NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_docs_user_id ON docs (user_id, timestamp)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_docs_timestamp ON docs (timestamp)')
+        # 語 -> 記録ごとの出現回数
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS postings (
+                gram TEXT NOT NULL,
+                doc_id INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (gram, doc_id)
+            ) WITHOUT ROWID
+        ''')
+        # 語 -> 出現する記録の数（順位付け用）
+        self._conn.execute('CREATE TABLE IF NOT EXISTS grams (gram TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID')
+        # 追いかけたストレージの種類と位置、記録数と文字数の合計
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def _meta(self, key):
+        row = self._conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, key, value):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value, ensure_ascii=False))
+        )
+
+    def _add(self, batch, totals):
+        """記録をまとめて索引に加える（トランザクション内で呼ぶ）"""
+        postings = []
+        document_frequency = Counter()
+        for row in batch:
+            norm = normalize(row.get('メッセージ内容'))
+            cursor = self._conn.execute(
+                f'INSERT INTO docs ({", ".join(COLUMNS)}, norm, length) '
+                f'VALUES ({", ".join("?" for _ in COLUMNS)}, ?, ?)',
+                [row.get(label) or '' for label in CSV_HEADER] + [norm, len(norm)]
+            )
+            doc_id = cursor.lastrowid
+            for gram, tf in text_grams(norm).items():
+                postings.append((gram, doc_id, tf))
+                document_frequency[gram] += 1
+            totals['docs'] += 1
+            totals['length'] += len(norm)
+        self._conn.executemany('INSERT INTO postings (gram, doc_id, tf) VALUES (?, ?, ?)', postings)
+        self._conn.executemany(
+            'INSERT INTO grams (gram, df) VALUES (?, ?) ON CONFLICT (gram) DO UPDATE SET df = df + excluded.df',
+            document_frequency.items()
+        )
+
+    def _up_to_date(self, backend):
+        """書き込みのトランザクションを始めずに、索引済みの位置から記録が増えていないか確かめる（ロック取得済みで呼ぶ）"""
+        if not self._validated:
+            return False
+        self._conn.execute('BEGIN')
+        try:
+            position = self._meta('position')
+            stored_backend = self._meta('backend')
+        finally:
+            self._conn.execute('COMMIT')
+        if position is None or stored_backend != backend:
+            return False
+        _, next_position = self.storage.scan_since(position)
+        return next_position == position
+
+    def catch_up(self, rebuild=False):
+        """前回の位置以降に追記された記録を索引に加える（加えた件数を返す）
+
+        ストレージが作り直された・別の種類に切り替わった場合は全件から作り直す。
+        新しい記録が無ければ書き込みのトランザクションを始めないので、検索のたびに呼んでもよい。
+        """
+        backend = type(self.storage).__name__
+        started = time.perf_counter()
+        with self._lock:
+            if not rebuild and self._up_to_date(backend):
+                return 0
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                position = self._meta('position')
+                if rebuild or self._meta('backend') != backend:
+                    position = None
+                elif position is not None and not self._validated:
+                    # 起動後の最初の1回だけ、データが作り直されていないか確認する
+                    if not self.storage.position_valid(position):
+                        print("⚠️ 記録が作り直されたため、検索インデックスを作り直します")
+                        position = None
+                if position is None:
+                    for table in ('docs', 'postings', 'grams'):
+                        self._conn.execute(f'DELETE FROM {table}')
+                    self._conn.execute("DELETE FROM meta WHERE key = 'totals'")
+
+                totals = self._meta('totals') or {'docs': 0, 'length': 0}
+                rows, next_position = self.storage.scan_since(position)
+                applied = 0
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= INDEX_BATCH_SIZE:
+                        self._add(batch, totals)
+                        applied += len(batch)
+                        batch = []
+                if batch:
+                    self._add(batch, totals)
+                    applied += len(batch)
+                self._set_meta('totals', totals)
+                self._set_meta('backend', backend)
+                self._set_meta('position', next_position)
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            self._validated = True
+            self._applied += applied
+            self._last_catch_up_seconds = time.perf_counter() - started
+        return applied
+
+    # --- 検索 ---
+
+    def _plan(self, terms):
+        """検索語ごとに候補を取り出す語と重み（idf）を決める。一致し得なければNone"""
+        totals = self._meta('totals') or {'docs': 0, 'length': 0}
+        docs = totals['docs']
+        plan = []
+        for term in terms:
+            if len(term) == 1:
+                # 1文字の検索語はその文字で始まる語のいずれかを含む記録
+                df = self._conn.execute(
+                    'SELECT COALESCE(SUM(df), 0) FROM grams WHERE gram >= ? AND gram < ?', (term, term + '\U0010ffff')
+                ).fetchone()[0]
+                gram = None
+            else:
+                grams = sorted(set(term[i:i + 2] for i in range(len(term) - 1)))
+                found = dict(self._conn.execute(
+                    f'SELECT gram, df FROM grams WHERE gram IN ({", ".join("?" for _ in grams)})', grams
+                ).fetchall())
+                if len(found) < len(grams):
+                    return None, totals
+                gram = min(grams, key=lambda g: found[g])
+                df = found[gram]
+            if df == 0:
+                return None, totals
+            df = min(df, docs)
+            idf = math.log(1 + (docs - df + 0.5) / (df + 0.5))
+            plan.append({'term': term, 'gram': gram, 'df': df, 'idf': idf})
+        return plan, totals
+
+    def search(self, query, start=None, end=None, page=1, per_page=20, sort='score', **filters):
+        """メッセージ内容の検索（空白区切りの検索語をすべて含む記録）
+
+        sort: 'score'（関連度順）/ 'new'（新しい順）
+        返り値: {'total': 一致した件数, 'total_capped': 一致がtotal件より多いか, 'page', 'per_page',
+                 'results': [記録の辞書（scoreを含む）]}
+        一致がSEARCH_MAX_CANDIDATES件より多い場合は、新しい記録からその件数までの中で順位を付ける。
+        """
+        terms = parse_query(query)
+        if not terms:
+            raise ValueError('検索語を入力してください')
+        if sort not in ('score', 'new'):
+            raise ValueError(f'不明な並び順です: {sort}')
+        page = max(1, int(page))
+        per_page = max(1, min(int(per_page), SEARCH_MAX_PER_PAGE))
+        result = {'query': query, 'terms': terms, 'total': 0, 'total_capped': False,
+                  'page': page, 'per_page': per_page, 'results': []}
+
+        with self._lock:
+            plan, totals = self._plan(terms)
+            if plan is None:
+                return result
+            average_length = max(1.0, totals['length'] / max(1, totals['docs']))
+
+            joins = []
+            join_params = []
+            score_parts = []
+            where = []
+            where_params = []
+            length_norm = f'({BM25_K1!r} * (1 - {BM25_B!r} + {BM25_B!r} * d.length / {average_length!r}))'
+            driving = sorted((item for item in plan if item['gram'] is not None), key=lambda item: item['df'])
+            for i, item in enumerate(driving):
+                joins.append(f'postings AS p{i}')
+                where.append(f'p{i}.gram = ? AND p{i}.doc_id = d.doc_id')
+                join_params.append(item['gram'])
+                score_parts.append(
+                    f'{item["idf"]!r} * p{i}.tf * {BM25_K1 + 1!r} / (p{i}.tf + {length_norm})'
+                )
+            for item in plan:
+                if item['gram'] is None:
+                    score_parts.append(f'{item["idf"]!r} * {BM25_K1 + 1!r} / (1 + {length_norm})')
+            if not driving:
+                # 1文字の検索語だけの場合は、最初の検索語の文字で始まる語の索引から候補を取り出す
+                where.append('d.doc_id IN (SELECT doc_id FROM postings WHERE gram >= ? AND gram < ?)')
+                where_params.extend([plan[0]['term'], plan[0]['term'] + '\U0010ffff'])
+            # 3文字以上の検索語は語が並んで現れるか、1文字の検索語はその文字を含むかを確かめる
+            # （2文字の検索語は索引と完全に一致する）
+            for term in terms:
+                if len(term) != 2:
+                    where.append('instr(d.norm, ?) > 0')
+                    where_params.append(term)
+            if start:
+                where.append('d.timestamp >= ?')
+                where_params.append(start)
+            if end:
+                where.append('d.timestamp <= ?')
+                where_params.append(end)
+            for name in SEARCH_FILTERS:
+                value = filters.get(name)
+                if value is not None:
+                    where.append(f'd.{name} = ?')
+                    where_params.append(value)
+
+            # 最も出現の少ない語の索引から読む（ユーザー指定時はそのユーザーの記録から読む）。
+            # どちらも索引の順に新しい記録から読めるので、上限に達したところで打ち切れる
+            if filters.get('user_id') is not None or not driving:
+                source = ' CROSS JOIN '.join(['docs AS d'] + joins)
+                newest_first = 'd.doc_id DESC'
+            else:
+                source = ' CROSS JOIN '.join(joins[:1] + ['docs AS d'] + joins[1:])
+                newest_first = 'p0.doc_id DESC'
+            sql_from = f'FROM {source} WHERE {" AND ".join(where)}'
+            params = join_params + where_params
+
+            # 上限より1件多く読み、上限を超える一致があるかも確かめる
+            limit = max(1, SEARCH_MAX_CANDIDATES)
+            candidates = self._conn.execute(
+                f'SELECT {" + ".join(score_parts)}, d.timestamp, d.doc_id {sql_from} '
+                f'ORDER BY {newest_first} LIMIT ?', params + [limit + 1]
+            ).fetchall()
+            if len(candidates) > limit:
+                candidates.pop()
+                result['total_capped'] = True
+            result['total'] = len(candidates)
+
+            if sort == 'score':
+                top = heapq.nlargest(page * per_page, candidates)
+            else:
+                top = heapq.nlargest(page * per_page, candidates, key=lambda candidate: candidate[1:])
+            top = top[(page - 1) * per_page:]
+            if not top:
+                return result
+
+            records = {}
+            for record in self._conn.execute(
+                f'SELECT doc_id, {", ".join(COLUMNS)} FROM docs WHERE doc_id IN ({", ".join("?" for _ in top)})',
+                [candidate[2] for candidate in top]
+            ):
+                records[record[0]] = record[1:]
+            for score, _, doc_id in top:
+                item = dict(zip(COLUMNS, records[doc_id]))
+                item['score'] = round(score, 4)
+                result['results'].append(item)
+        return result
+
+    def stats(self):
+        """索引の件数と反映状況"""
+        with self._lock:
+            totals = self._meta('totals') or {'docs': 0, 'length': 0}
+            return {
+                'docs': totals['docs'],
+                'grams': self._conn.execute('SELECT COUNT(*) FROM grams').fetchone()[0],
+                'applied_rows': self._applied,
+                'last_catch_up_seconds': round(self._last_catch_up_seconds, 4),
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='メッセージ内容の全文検索インデックス')
+    parser.add_argument('command', choices=['search', 'rebuild', 'stats'])
+    parser.add_argument('query', nargs='?', default='', help='search: 検索語（空白区切りですべてを含む記録）')
+    parser.add_argument('--path', default=SEARCH_INDEX_PATH, help='検索インデックスのファイル')
+    parser.add_argument('--user-id', help='search: ユーザーIDで絞り込む')
+    parser.add_argument('--reply-status', help='search: 返信ステータスで絞り込む')
+    parser.add_argument('--sort', choices=['score', 'new'], default='score', help='search: 並び順')
+    parser.add_argument('--limit', type=int, default=20, help='search: 表示する件数')
+    args = parser.parse_args()
+
+    index = SearchIndex(open_storage(), args.path)
+    started = time.perf_counter()
+    applied = index.catch_up(rebuild=args.command == 'rebuild')
+    if args.command == 'rebuild':
+        print(f"✅ 検索インデックスを作り直しました: {applied}件（{time.perf_counter() - started:.1f}秒）")
+    elif args.command == 'search':
+        started = time.perf_counter()
+        result = index.search(args.query, user_id=args.user_id, reply_status=args.reply_status,
+                              sort=args.sort, per_page=args.limit)
+        print(f"🔍 {result['total']}件{'以上' if result['total_capped'] else ''}（{(time.perf_counter() - started) * 1000:.1f}ms）")
+        for item in result['results']:
+            print(json.dumps(item, ensure_ascii=False))
+    else:
+        print(json.dumps(index.stats(), ensure_ascii=False, indent=2))
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
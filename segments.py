@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+from datetime import timedelta
+
+
+# 経過時間で所属が変わるセグメント（30日以上連絡なしなど）を判定し直す間隔（秒）
+SEGMENT_REFRESH_SECONDS = float(os.environ.get('SEGMENT_REFRESH_SECONDS', '3600'))
+
+
+class Segment:
+    """配信対象のセグメントの定義
+
+    match(customer, now): 顧客テーブルの行で判定する。顧客の行が変わるたびに判定し直す。
+    row_match(row): 記録1行で判定する。一度一致した顧客はその後も含める（料金について問い合わせた、など）。
+    time_based: 記録が無くても時間の経過で所属が変わる場合にTrue（SEGMENT_REFRESH_SECONDSごとに判定し直す）。
+    version: 判定の内容を変えたら上げる（次回起動時に全件から作り直す）。
+    """
+
+    def __init__(self, name, label, match=None, row_match=None, time_based=False, version=1):
+        if (match is None) == (row_match is None):
+            raise ValueError(f'{name}: matchとrow_matchのどちらか一方を指定してください')
+        self.name = name
+        self.label = label
+        self.match = match
+        self.row_match = row_match
+        self.time_based = time_based
+        self.version = version
+
+
+# 登録済みのセグメント（登録順に配信ページの選択肢になる）
+SEGMENT_DEFINITIONS = {}
+
+
+def register_segment(name, label, match=None, row_match=None, time_based=False, version=1):
+    """セグメントを登録する（顧客テーブルを開く前に呼ぶ）"""
+    segment = Segment(name, label, match, row_match, time_based, version)
+    SEGMENT_DEFINITIONS[name] = segment
+    return segment
+
+
+def inactive_for(days):
+    """最後の記録からdays日以上たった顧客を判定する関数"""
+    def match(customer, now):
+        cutoff = (now - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+        return customer['last_seen'] < cutoff
+    return match
+
+
+def content_contains(keyword):
+    """メッセージ内容にkeywordを含む記録を判定する関数"""
+    def row_match(row):
+        return keyword in (row.get('メッセージ内容') or '')
+    return row_match
+
+
+register_segment('all', '全顧客', match=lambda customer, now: True)
+register_segment('high_priority', '高優先度マネタイズ機会', match=lambda customer, now: customer['high_count'] > 0)
+register_segment('needs_reply', '返信が必要な顧客', match=lambda customer, now: customer['needs_reply_count'] > 0)
+register_segment('new_customers', '新規顧客', match=lambda customer, now: customer['followed_at'] is not None)
+register_segment('inactive_30d', '30日以上連絡のない顧客', match=inactive_for(30), time_based=True)
+register_segment('asked_price', '料金について問い合わせた顧客', row_match=content_contains('料金'))
+
+
+class SegmentIndex:
+    """セグメントごとのユーザーIDの集合
+
+    記録を反映するたびに、変わった顧客だけを判定し直す。所属はsegment_membersテーブル
+    （顧客テーブルと同じファイル）にも同じトランザクションで書くため、起動時は判定し直さずに
+    読み込むだけで済む。ブロック・削除したユーザーは所属を残したまま配信対象から除く。
+
+    書き込みはCustomerTableのトランザクション内で行い、commit()でメモリ上の集合に反映する。
+    """
+
+    def __init__(self, conn, definitions):
+        self._conn = conn
+        self.definitions = dict(definitions)
+        self._members = {name: set() for name in self.definitions}
+        self._unfollowed = set()
+        self._staged = {}
+        self._cleared = False
+        self.refreshed_at = {}
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS segment_members (
+                segment TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                PRIMARY KEY (segment, user_id)
+            ) WITHOUT ROWID
+        ''')
+
+    def versions(self):
+        return {name: segment.version for name, segment in self.definitions.items()}
+
+    def load(self):
+        """保存済みの所属とブロック・削除したユーザーを読み込む"""
+        members = {name: set() for name in self.definitions}
+        for name, user_id in self._conn.execute('SELECT segment, user_id FROM segment_members'):
+            if name in members:
+                members[name].add(user_id)
+        self._members = members
+        self._unfollowed = set(
+            user_id for (user_id,) in self._conn.execute('SELECT user_id FROM customers WHERE followed = 0')
+        )
+        self._staged = {}
+        self._cleared = False
+
+    def drop(self, names):
+        """セグメントの保存済みの所属を削除する（定義の変更・削除時）"""
+        self._conn.executemany('DELETE FROM segment_members WHERE segment = ?', [(name,) for name in names])
+
+    def clear(self):
+        """すべての所属を削除する（顧客テーブルを作り直すとき）"""
+        self._conn.execute('DELETE FROM segment_members')
+        self._staged = {}
+        self._cleared = True
+
+    def _contains(self, name, user_id):
+        staged = self._staged.get((name, user_id))
+        if staged is not None:
+            return staged
+        if self._cleared:
+            return False
+        return user_id in (self._unfollowed if name is None else self._members[name])
+
+    def _set(self, name, user_id, member):
+        """所属を変える（nameがNoneはブロック・削除したユーザーの集合）"""
+        if self._contains(name, user_id) == member:
+            return
+        self._staged[(name, user_id)] = member
+        if name is None:
+            return
+        if member:
+            self._conn.execute('INSERT OR IGNORE INTO segment_members (segment, user_id) VALUES (?, ?)', (name, user_id))
+        else:
+            self._conn.execute('DELETE FROM segment_members WHERE segment = ? AND user_id = ?', (name, user_id))
+
+    def match_row(self, user_id, row, names=None):
+        """記録1行で判定するセグメントに加える"""
+        for name, segment in self.definitions.items():
+            if segment.row_match is None or (names is not None and name not in names):
+                continue
+            if not self._contains(name, user_id) and segment.row_match(row):
+                self._set(name, user_id, True)
+
+    def evaluate(self, customer, now, names=None):
+        """顧客の行で判定するセグメントの所属を判定し直す"""
+        user_id = customer['user_id']
+        if names is None:
+            self._set(None, user_id, not customer['followed'])
+        for name, segment in self.definitions.items():
+            if segment.match is None or (names is not None and name not in names):
+                continue
+            self._set(name, user_id, bool(segment.match(customer, now)))
+
+    def commit(self):
+        """トランザクションのコミット後にメモリ上の集合へ反映する"""
+        if self._cleared:
+            self._members = {name: set() for name in self.definitions}
+            self._unfollowed = set()
+        for (name, user_id), member in self._staged.items():
+            target = self._unfollowed if name is None else self._members[name]
+            if member:
+                target.add(user_id)
+            else:
+                target.discard(user_id)
+        self._staged = {}
+        self._cleared = False
+
+    def rollback(self):
+        self._staged = {}
+        self._cleared = False
+
+    def members(self, name):
+        """セグメントに含まれるユーザーID（ブロック・削除したユーザーは除く）"""
+        return self._members[name] - self._unfollowed
+
+    def counts(self):
+        """セグメントごとの人数"""
+        return {name: len(members - self._unfollowed) for name, members in self._members.items()}
@@ -0,0 +1,888 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import csv
+import sys
+import gzip
+import json
+import uuid
+import shutil
+import hashlib
+import sqlite3
+import argparse
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windowsなど
+    fcntl = None
+
+
+# 列定義（内部名, CSVヘッダー）
+FIELDS = [
+    ('timestamp', 'タイムスタンプ'),
+    ('user_id', 'ユーザーID'),
+    ('user_name', 'ユーザー名'),
+    ('message_type', 'メッセージタイプ'),
+    ('content', 'メッセージ内容'),
+    ('reply_status', '返信ステータス'),
+    ('monetization', 'マネタイズ機会'),
+    ('note', '備考'),
+]
+COLUMNS = [name for name, _ in FIELDS]
+CSV_HEADER = [label for _, label in FIELDS]
+
+# 絞り込み条件（start/endはタイムスタンプの範囲、それ以外は完全一致）
+FILTER_COLUMNS = ('user_id', 'message_type', 'reply_status', 'monetization', 'note')
+
+# ストレージ設定
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+DB_PATH = os.environ.get('DB_PATH', os.path.join(os.path.dirname(__file__), 'customer_data.db'))
+CSV_PATH = os.environ.get('CSV_PATH', os.path.join(os.path.dirname(__file__), 'customer_data.csv'))
+PARTITION_DIR = os.environ.get('PARTITION_DIR', os.path.join(os.path.dirname(__file__), 'partitions'))
+PARTITION_GRANULARITY = os.environ.get('PARTITION_GRANULARITY', 'month')
+
+# パーティション単位ごとのタイムスタンプ先頭の文字数（'2025-12-09 22:55:19' -> '2025-12'）
+PARTITION_KEY_LENGTHS = {'year': 4, 'month': 7, 'day': 10}
+
+
+@contextmanager
+def file_lock(path):
+    """プロセス間の排他ロック（pathのロックファイルにflockする。fcntlが無い環境では何もしない）"""
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def row_to_dict(record):
+    """レコード（リスト）をCSVヘッダーをキーとする辞書に変換"""
+    return dict(zip(CSV_HEADER, record))
+
+
+def write_csv(rows, f, header=True):
+    """辞書の行をCSVとして書き出す"""
+    writer = csv.writer(f)
+    if header:
+        writer.writerow(CSV_HEADER)
+    count = 0
+    for row in rows:
+        writer.writerow([row.get(label, '') for label in CSV_HEADER])
+        count += 1
+    return count
+
+
+def iter_csv_chunks(rows, header=True, chunk_rows=500):
+    """辞書の行をCSVテキストの塊として順に返す（全体をメモリに載せない）"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(CSV_HEADER)
+    count = 0
+    for row in rows:
+        writer.writerow([row.get(label, '') for label in CSV_HEADER])
+        count += 1
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _match(row, start=None, end=None, **filters):
+    """辞書の行が絞り込み条件に一致するか判定"""
+    timestamp = row.get('タイムスタンプ', '')
+    if start and timestamp < start:
+        return False
+    if end and timestamp > end:
+        return False
+    for name, label in FIELDS:
+        value = filters.get(name)
+        if value is not None and row.get(label) != value:
+            return False
+    return True
+
+
+def _check_cursor(cursor, ints=(), optional_ints=(), strings=()):
+    """ページの位置の各値が正しい型か確かめる（不正な値はValueError）"""
+    def valid_int(value):
+        return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+    if not isinstance(cursor, dict):
+        raise ValueError('cursorが正しくありません')
+    for key in ints:
+        if not valid_int(cursor.get(key)):
+            raise ValueError('cursorが正しくありません')
+    for key in optional_ints:
+        if cursor.get(key) is not None and not valid_int(cursor[key]):
+            raise ValueError('cursorが正しくありません')
+    for key in strings:
+        if not isinstance(cursor.get(key), str):
+            raise ValueError('cursorが正しくありません')
+    return cursor
+
+
+def _take_page(items, limit, **filters):
+    """(行, 読み終えた位置) を順に読み、条件に一致する行をlimit件集める
+
+    返り値: (行のリスト, 次のページの位置（何も読まなければNone）, 続きがあるか)
+    """
+    rows = []
+    position = None
+    for row, after in items:
+        if _match(row, **filters):
+            if len(rows) >= limit:
+                return rows, position, True
+            rows.append(row)
+        position = after
+    return rows, position, False
+
+
+class SQLiteStorage:
+    """SQLite（WALモード）にメッセージを保存するストレージ"""
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._init_schema()
+
+    def _connect(self):
+        """スレッドごとの接続を返す"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    user_name TEXT,
+                    message_type TEXT,
+                    content TEXT,
+                    reply_status TEXT,
+                    monetization TEXT,
+                    note TEXT
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_reply_status ON messages (reply_status)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_monetization ON messages (monetization)')
+            # データベースの識別子（作り直されたことを検知するため）
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('store_id', ?)", (uuid.uuid4().hex,))
+
+    def append(self, record):
+        """1件のレコードを追加"""
+        self.append_many([record])
+
+    def append_many(self, records, fsync=None):
+        """複数のレコードを1トランザクションで追加
+
+        fsync: None（既定の同期設定）/ 'none'（同期しない）/ 'batch'（コミットごと）/ 'record'（1件ごとにコミット）
+        """
+        placeholders = ', '.join('?' for _ in COLUMNS)
+        sql = f'INSERT INTO messages ({", ".join(COLUMNS)}) VALUES ({placeholders})'
+        conn = self._connect()
+        with self._write_lock:
+            if fsync is not None:
+                conn.execute(f'PRAGMA synchronous={"OFF" if fsync == "none" else "FULL"}')
+            if fsync == 'record':
+                for record in records:
+                    with conn:
+                        conn.execute(sql, list(record))
+            else:
+                with conn:
+                    conn.executemany(sql, [list(record) for record in records])
+
+    def _where(self, start=None, end=None, **filters):
+        clauses = []
+        params = []
+        if start:
+            clauses.append('timestamp >= ?')
+            params.append(start)
+        if end:
+            clauses.append('timestamp <= ?')
+            params.append(end)
+        for name in FILTER_COLUMNS:
+            value = filters.get(name)
+            if value is not None:
+                clauses.append(f'{name} = ?')
+                params.append(value)
+        where = f' WHERE {" AND ".join(clauses)}' if clauses else ''
+        return where, params
+
+    def iter_rows(self, **filters):
+        """条件に一致する行を記録順に返す（キーはCSVヘッダー）"""
+        where, params = self._where(**filters)
+        cursor = self._connect().execute(
+            f'SELECT {", ".join(COLUMNS)} FROM messages{where} ORDER BY id', params
+        )
+        for record in cursor:
+            yield row_to_dict(record)
+
+    def page(self, cursor=None, limit=100, **filters):
+        """条件に一致する行を記録順にlimit件返す（キーセット方式のページ送り）
+
+        返り値: (行のリスト, 次のページの位置, 続きがあるか)。位置は最後まで読んだ後も返すので、
+        同じ位置から読み直すと、その後に追記された行だけが返る。
+        期間を指定した場合は、最初のページでタイムスタンプの索引から該当するIDの範囲を求めておき、
+        以降のページは主キーの範囲だけを読む。
+        """
+        conn = self._connect()
+        if cursor is not None:
+            _check_cursor(cursor, ints=('id',), optional_ints=('max_id',))
+        else:
+            cursor = {'id': 0, 'max_id': None}
+            if filters.get('start') or filters.get('end'):
+                where, params = self._where(start=filters.get('start'), end=filters.get('end'))
+                low, high = conn.execute(f'SELECT MIN(id), MAX(id) FROM messages{where}', params).fetchone()
+                if low is None:
+                    return [], cursor, False
+                # 終了日時までの範囲は、最初のページの時点の最後の記録までで打ち切る
+                cursor = {'id': low - 1, 'max_id': high if filters.get('end') else None}
+
+        where, params = self._where(**filters)
+        clauses = [where[len(' WHERE '):]] if where else []
+        clauses.append('id > ?')
+        params.append(cursor['id'])
+        if cursor.get('max_id') is not None:
+            clauses.append('id <= ?')
+            params.append(cursor['max_id'])
+        records = conn.execute(
+            f'SELECT id, {", ".join(COLUMNS)} FROM messages WHERE {" AND ".join(clauses)} ORDER BY id LIMIT ?',
+            params + [limit + 1]
+        ).fetchall()
+        has_more = len(records) > limit
+        records = records[:limit]
+        next_cursor = dict(cursor, id=records[-1][0]) if records else cursor
+        return [row_to_dict(record[1:]) for record in records], next_cursor, has_more
+
+    def data_version(self):
+        """データの版（追記のたびに変わる値。空の場合はNone）"""
+        row = self._connect().execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+        return f'sqlite-{row[0]}' if row and row[0] else None
+
+    def count(self, **filters):
+        """条件に一致する行数"""
+        where, params = self._where(**filters)
+        return self._connect().execute(f'SELECT COUNT(*) FROM messages{where}', params).fetchone()[0]
+
+    def distinct_user_ids(self, **filters):
+        """条件に一致する行のユーザーID一覧"""
+        where, params = self._where(**filters)
+        cursor = self._connect().execute(f'SELECT DISTINCT user_id FROM messages{where}', params)
+        return set(user_id for (user_id,) in cursor)
+
+    def _store_id(self):
+        return self._connect().execute("SELECT value FROM meta WHERE key = 'store_id'").fetchone()[0]
+
+    def scan_since(self, position=None):
+        """positionより後に追記された行と、次回の開始位置を返す（positionがNoneなら全件）"""
+        conn = self._connect()
+        start_id = position['id'] if position else 0
+        start_rows = position['rows'] if position else 0
+        end_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+        new_rows = conn.execute(
+            'SELECT COUNT(*) FROM messages WHERE id > ? AND id <= ?', (start_id, end_id)
+        ).fetchone()[0]
+
+        def rows():
+            cursor = conn.execute(
+                f'SELECT {", ".join(COLUMNS)} FROM messages WHERE id > ? AND id <= ? ORDER BY id',
+                (start_id, end_id)
+            )
+            for record in cursor:
+                yield row_to_dict(record)
+
+        next_position = {'store_id': self._store_id(), 'id': end_id, 'rows': start_rows + new_rows}
+        return rows(), next_position
+
+    def position_valid(self, position):
+        """positionが現在のデータに対して有効か（作り直し・削除されていないか）"""
+        if not position or position.get('store_id') != self._store_id():
+            return False
+        rows = self._connect().execute(
+            'SELECT COUNT(*) FROM messages WHERE id <= ?', (position['id'],)
+        ).fetchone()[0]
+        return rows == position.get('rows')
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class CsvStorage:
+    """従来の追記型CSVファイルに保存するストレージ（BOM付きUTF-8）"""
+
+    def __init__(self, path=CSV_PATH):
+        self.path = path
+        self._write_lock = threading.Lock()
+
+    def append(self, record):
+        """1件のレコードを追加"""
+        self.append_many([record])
+
+    def append_many(self, records, fsync=None):
+        """複数のレコードを1回の書き込みで追記
+
+        ファイルにflockしてから書き込むため、複数のプロセスから同じファイルに追記しても行が混ざらない。
+        fsync: None / 'none'（同期しない）/ 'batch'（書き込みごと）/ 'record'（1件ごと）
+        """
+        with self._write_lock:
+            with open(self.path, 'ab') as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    # BOM付きUTF-8で書き込み（Excelで正しく開けるようにする）
+                    # ヘッダーの要否はロックを取ってからファイルサイズで判定する
+                    if os.fstat(f.fileno()).st_size == 0:
+                        buffer = io.StringIO()
+                        csv.writer(buffer).writerow(CSV_HEADER)
+                        f.write(('\ufeff' + buffer.getvalue()).encode('utf-8'))
+                    if fsync == 'record':
+                        for record in records:
+                            buffer = io.StringIO()
+                            csv.writer(buffer).writerow(record)
+                            f.write(buffer.getvalue().encode('utf-8'))
+                            f.flush()
+                            os.fsync(f.fileno())
+                    else:
+                        buffer = io.StringIO()
+                        csv.writer(buffer).writerows(records)
+                        f.write(buffer.getvalue().encode('utf-8'))
+                        f.flush()
+                        if fsync == 'batch':
+                            os.fsync(f.fileno())
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def iter_rows(self, **filters):
+        """条件に一致する行を記録順に返す（キーはCSVヘッダー）"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', newline='', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                if _match(row, **filters):
+                    yield row
+
+    def data_version(self):
+        """データの版（追記のたびに変わる値。ファイルが無い場合はNone）"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return f'csv-{stat.st_size}-{stat.st_mtime_ns}'
+
+    def count(self, **filters):
+        """条件に一致する行数"""
+        return sum(1 for _ in self.iter_rows(**filters))
+
+    def distinct_user_ids(self, **filters):
+        """条件に一致する行のユーザーID一覧"""
+        return set(row.get('ユーザーID', '') for row in self.iter_rows(**filters))
+
+    def _open_bytes(self):
+        """行を読むためにファイルをバイナリで開く"""
+        return open(self.path, 'rb')
+
+    def _tail_hash(self, f, offset):
+        """offset直前のバイト列のハッシュ（ファイルが書き換えられたことを検知するため）"""
+        f.seek(max(0, offset - 256))
+        return hashlib.sha1(f.read(min(offset, 256))).hexdigest()
+
+    def scan_since(self, position=None):
+        """positionより後に追記された行と、次回の開始位置を返す（positionがNoneなら全件）
+
+        ファイルがまだ無い場合は、ファイルの先頭を指す決まった位置を返す（同じ位置なら新しい行は無い）。
+        """
+        if not os.path.exists(self.path):
+            return iter(()), {'inode': None, 'offset': 0, 'tail': None}
+
+        start = position['offset'] if position else 0
+        with open(self.path, 'rb') as f:
+            end = self._complete_end(f, start)
+            inode = os.fstat(f.fileno()).st_ino
+            tail_hash = self._tail_hash(f, end)
+
+        def rows():
+            for row, _ in self._read_from(start, end):
+                yield row
+
+        return rows(), {'inode': inode, 'offset': end, 'tail': tail_hash}
+
+    def _complete_end(self, f, start):
+        """書き込み途中の行を読まないよう、最後の行末（\r\n）の直後の位置を返す"""
+        end = os.fstat(f.fileno()).st_size
+        f.seek(max(start, end - 65536))
+        tail = f.read(end - f.tell())
+        last = tail.rfind(b'\r\n')
+        end = end - len(tail) + last + 2 if last >= 0 else start
+        return max(start, end)
+
+    def _check_row_start(self, f, offset):
+        """offsetが行の先頭（ファイルの先頭か行末の直後）でなければValueError"""
+        if offset == 0:
+            return
+        f.seek(offset - 2)
+        if f.read(2) != b'\r\n':
+            raise ValueError('cursorが正しくありません')
+
+    def _read_from(self, start, end):
+        """startからendまでの行を (行, その行を読み終えた位置) で順に返す（endがNoneなら最後まで）"""
+        consumed = [start]
+
+        def lines():
+            with self._open_bytes() as f:
+                f.seek(start)
+                offset = start
+                while end is None or offset < end:
+                    line = f.readline()
+                    if not line:
+                        break
+                    offset += len(line)
+                    text = line.decode('utf-8')
+                    if offset == len(line):
+                        text = text.lstrip('\ufeff')
+                    consumed[0] = offset
+                    yield text
+
+        # 先頭から読む場合は1行目がヘッダー
+        fieldnames = None if start == 0 else CSV_HEADER
+        for row in csv.DictReader(lines(), fieldnames=fieldnames):
+            yield row, consumed[0]
+
+    def page(self, cursor=None, limit=100, **filters):
+        """条件に一致する行を記録順にlimit件返す（ファイル上の位置から読み始める）
+
+        返り値: (行のリスト, 次のページの位置, 続きがあるか)。
+        索引が無いため、絞り込み条件がある場合は一致する行が集まるまで読み進める。
+        """
+        cursor = _check_cursor(cursor or {'offset': 0}, ints=('offset',))
+        if not os.path.exists(self.path):
+            return [], cursor, False
+        with open(self.path, 'rb') as f:
+            self._check_row_start(f, cursor['offset'])
+            end = self._complete_end(f, cursor['offset'])
+        items = ((row, {'offset': offset}) for row, offset in self._read_from(cursor['offset'], end))
+        rows, next_cursor, has_more = _take_page(items, limit, **filters)
+        return rows, next_cursor or cursor, has_more
+
+    def position_valid(self, position):
+        """positionが現在のファイルに対して有効か（ローテーション・切り詰めされていないか）"""
+        if not position:
+            return False
+        if position.get('inode') is None:
+            # ファイルが無かったときの位置（その後に作られたファイルも先頭から読めばよい）
+            return position.get('offset') == 0
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != position.get('inode') or stat.st_size < position.get('offset', 0):
+                return False
+            return self._tail_hash(f, position['offset']) == position.get('tail')
+
+    def close(self):
+        pass
+
+
+class _PartitionFile(CsvStorage):
+    """パーティションのCSVファイル（読む直前にアーカイブ・展開されていれば、もう一方の形式から読む）
+
+    アーカイブは圧縮したファイルを作ってから、展開は展開したファイルを作ってから古い方を消すため、
+    どちらかは必ず残っている。gzipを展開したバイト列はCSVと同じなので、ファイル上の位置もそのまま使える。
+    """
+
+    def __init__(self, path, archived=False):
+        super().__init__(path)
+        self.archived = archived
+
+    def _open_bytes(self):
+        paths = (f'{self.path}.gz', self.path) if self.archived else (self.path, f'{self.path}.gz')
+        for _ in range(3):
+            for path in paths:
+                try:
+                    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+                except FileNotFoundError:
+                    continue
+        raise FileNotFoundError(f'パーティションが見つかりません: {self.path}')
+
+    def _end_from(self, offset):
+        """offsetが行の先頭か確かめ、読み終える位置を返す（アーカイブ済みで変更されない場合はNone＝最後まで）"""
+        with self._open_bytes() as f:
+            self._check_row_start(f, offset)
+            if isinstance(f, gzip.GzipFile):
+                return None
+            return self._complete_end(f, offset)
+
+
+class PartitionedStorage:
+    """期間（既定は月）ごとのCSVファイルに分けて保存するストレージ
+
+    manifest.json に各パーティションの件数と最小・最大タイムスタンプを持ち、
+    期間を指定した読み込みでは範囲外のパーティションを読まずに済ませる。
+    """
+
+    def __init__(self, directory=PARTITION_DIR, granularity=PARTITION_GRANULARITY):
+        if granularity not in PARTITION_KEY_LENGTHS:
+            raise ValueError(f'不明なパーティション単位: {granularity}')
+        self.directory = directory
+        self.granularity = granularity
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        # マニフェストの読み込みから保存までを複数のプロセスで排他するロックファイル
+        self.lock_path = os.path.join(directory, 'manifest.lock')
+        self._write_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._manifest_signature = None
+        self._manifest = self._load_manifest()
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _load_manifest(self):
+        signature = self._signature()
+        self._manifest_signature = signature
+        if signature is None:
+            return {'granularity': self.granularity, 'partitions': {}}
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('granularity') != self.granularity:
+            raise ValueError(
+                f"パーティション単位が既存データ（{manifest.get('granularity')}）と異なります: {self.granularity}"
+            )
+        return manifest
+
+    def _refresh(self):
+        """他のインスタンスがマニフェストを更新していれば読み直す"""
+        if self._signature() != self._manifest_signature:
+            self._manifest = self._load_manifest()
+
+    def _save_manifest(self):
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+        self._manifest_signature = self._signature()
+
+    def partition_key(self, timestamp):
+        """タイムスタンプからパーティション名を求める（例: 2025-12）"""
+        key = (timestamp or '')[:PARTITION_KEY_LENGTHS[self.granularity]]
+        return key if len(key) == PARTITION_KEY_LENGTHS[self.granularity] else 'unknown'
+
+    def _path(self, key, archived=False):
+        return os.path.join(self.directory, f'customer_data_{key}.csv' + ('.gz' if archived else ''))
+
+    def partitions(self, start=None, end=None):
+        """期間に重なるパーティションの一覧（名前順）"""
+        self._refresh()
+        selected = []
+        for key, info in sorted(self._manifest['partitions'].items()):
+            if start and info['max_ts'] < start:
+                continue
+            if end and info['min_ts'] > end:
+                continue
+            selected.append((key, info))
+        return selected
+
+    def append(self, record):
+        """1件のレコードを追加"""
+        self.append_many([record])
+
+    def append_many(self, records, fsync=None):
+        """レコードをパーティションごとにまとめて追記し、マニフェストを更新"""
+        groups = defaultdict(list)
+        for record in records:
+            groups[self.partition_key(record[0])].append(record)
+
+        with self._write_lock, file_lock(self.lock_path):
+            self._refresh()
+            partitions = self._manifest['partitions']
+            for key, group in groups.items():
+                info = partitions.get(key)
+                if info and info.get('archived'):
+                    # アーカイブ済みの期間に遅れて届いた記録は、展開してから追記する
+                    self._unarchive(key)
+                CsvStorage(self._path(key)).append_many(group, fsync=fsync)
+
+                timestamps = [record[0] for record in group]
+                if info is None:
+                    info = partitions[key] = {'rows': 0, 'min_ts': min(timestamps), 'max_ts': max(timestamps)}
+                info['rows'] += len(group)
+                info['min_ts'] = min(info['min_ts'], min(timestamps))
+                info['max_ts'] = max(info['max_ts'], max(timestamps))
+                info['archived'] = False
+            self._save_manifest()
+
+    def _read_partition(self, key, info):
+        """パーティションの行を順に返す（アーカイブ済みはgzipのまま読む）"""
+        with _PartitionFile(self._path(key), info.get('archived'))._open_bytes() as f:
+            yield from csv.DictReader(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''))
+
+    def iter_rows(self, start=None, end=None, **filters):
+        """条件に一致する行をパーティション順に返す（期間外のパーティションは読まない）"""
+        for key, info in self.partitions(start, end):
+            for row in self._read_partition(key, info):
+                if _match(row, start=start, end=end, **filters):
+                    yield row
+
+    def page(self, cursor=None, limit=100, **filters):
+        """条件に一致する行をパーティション順にlimit件返す（期間外のパーティションは読まない）
+
+        返り値: (行のリスト, 次のページの位置, 続きがあるか)。
+        位置はパーティション名とその中で読んだ行数（アーカイブされていなければファイル上の位置も）。
+        読み終えたパーティション（位置より前の期間）に遅れて追記された行は返らない。
+        """
+        cursor = _check_cursor(
+            cursor or {'partition': '', 'rows': 0, 'offset': 0},
+            ints=('rows',), optional_ints=('offset',), strings=('partition',)
+        )
+
+        def items():
+            for key, info in self.partitions(filters.get('start'), filters.get('end')):
+                if key < cursor['partition']:
+                    continue
+                skip = cursor['rows'] if key == cursor['partition'] else 0
+                if info.get('archived') or (skip and not cursor.get('offset')):
+                    # アーカイブ済みは先頭から読み、読んだ行数だけ読み飛ばす
+                    for count, row in enumerate(self._read_partition(key, info), 1):
+                        if count > skip:
+                            yield row, {'partition': key, 'rows': count, 'offset': None}
+                    continue
+                partition = _PartitionFile(self._path(key))
+                offset = cursor['offset'] if skip else 0
+                end = partition._end_from(offset)
+                for count, (row, after) in enumerate(partition._read_from(offset, end), skip + 1):
+                    yield row, {'partition': key, 'rows': count, 'offset': after}
+
+        rows, next_cursor, has_more = _take_page(items(), limit, **filters)
+        return rows, next_cursor or cursor, has_more
+
+    def data_version(self):
+        """データの版（追記のたびに変わる値。空の場合はNone）"""
+        self._refresh()
+        total = sum(info['rows'] for info in self._manifest['partitions'].values())
+        if not total:
+            return None
+        return f'partitioned-{total}-{os.stat(self.manifest_path).st_mtime_ns}'
+
+    def count(self, **filters):
+        """条件に一致する行数（条件なしならマニフェストの件数を合計するだけ）"""
+        if not any(value is not None for value in filters.values()):
+            self._refresh()
+            return sum(info['rows'] for info in self._manifest['partitions'].values())
+        return sum(1 for _ in self.iter_rows(**filters))
+
+    def distinct_user_ids(self, **filters):
+        """条件に一致する行のユーザーID一覧"""
+        return set(row.get('ユーザーID', '') for row in self.iter_rows(**filters))
+
+    def scan_since(self, position=None):
+        """positionより後に追記された行と、次回の開始位置を返す（positionがNoneなら全件）"""
+        previous = (position or {}).get('partitions', {})
+        scans = []
+        next_partitions = {}
+        for key, info in self.partitions():
+            before = previous.get(key)
+            if not info.get('archived'):
+                partition = _PartitionFile(self._path(key))
+                try:
+                    rows, csv_position = partition.scan_since(before['csv'] if before else None)
+                except FileNotFoundError:
+                    csv_position = None
+                if csv_position is not None and csv_position['inode'] is not None:
+                    scans.append(rows)
+                    next_partitions[key] = {'rows': info['rows'], 'csv': csv_position}
+                    continue
+                # マニフェストを読んだ後にアーカイブされた
+                self._refresh()
+                info = self._manifest['partitions'][key]
+            # アーカイブ済みのパーティションは変更されない
+            if before is None:
+                scans.append(self._read_partition(key, info))
+            elif before['csv'] is not None:
+                # 前回はCSVだった: 前回の位置より後に追記されてからアーカイブされた行をgzipから読む
+                archived = _PartitionFile(self._path(key), archived=True)
+                scans.append(row for row, _ in archived._read_from(before['csv']['offset'], None))
+            next_partitions[key] = {'rows': info['rows'], 'csv': None}
+
+        def rows():
+            for scan in scans:
+                yield from scan
+
+        return rows(), {'granularity': self.granularity, 'partitions': next_partitions}
+
+    def position_valid(self, position):
+        """positionが現在のパーティションに対して有効か"""
+        if not position or position.get('granularity') != self.granularity:
+            return False
+        self._refresh()
+        for key, before in position.get('partitions', {}).items():
+            info = self._manifest['partitions'].get(key)
+            if info is None or info['rows'] < before['rows']:
+                return False
+            if info.get('archived'):
+                # アーカイブ済みのパーティションは変更されない（前回の位置より後の行はscan_sinceがgzipから読む）
+                continue
+            try:
+                if before['csv'] is not None and _PartitionFile(self._path(key)).position_valid(before['csv']):
+                    continue
+            except FileNotFoundError:
+                pass
+            # 確かめる間にアーカイブされていれば有効
+            self._refresh()
+            info = self._manifest['partitions'].get(key)
+            if info is None or not info.get('archived'):
+                return False
+        return True
+
+    def archive(self, before):
+        """beforeより前のパーティションをgzip圧縮してアーカイブする"""
+        archived = []
+        with self._write_lock, file_lock(self.lock_path):
+            self._refresh()
+            for key, info in sorted(self._manifest['partitions'].items()):
+                if key >= before or info.get('archived'):
+                    continue
+                path = self._path(key)
+                with open(path, 'rb') as src, gzip.open(f'{path}.gz.tmp', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.replace(f'{path}.gz.tmp', self._path(key, archived=True))
+                info['archived'] = True
+                self._save_manifest()
+                os.remove(path)
+                archived.append(key)
+        return archived
+
+    def _unarchive(self, key):
+        """アーカイブ済みのパーティションを展開する（書き込みロック取得済みで呼ぶ）"""
+        path = self._path(key)
+        with gzip.open(self._path(key, archived=True), 'rb') as src, open(f'{path}.tmp', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(f'{path}.tmp', path)
+        self._manifest['partitions'][key]['archived'] = False
+        self._save_manifest()
+        os.remove(self._path(key, archived=True))
+
+    def close(self):
+        pass
+
+
+def open_storage(backend=None):
+    """設定に応じたストレージを開く"""
+    backend = backend or STORAGE_BACKEND
+    if backend == 'sqlite':
+        return SQLiteStorage(DB_PATH)
+    if backend == 'csv':
+        return CsvStorage(CSV_PATH)
+    if backend == 'partitioned':
+        return PartitionedStorage(PARTITION_DIR, PARTITION_GRANULARITY)
+    raise ValueError(f'不明なストレージ: {backend}')
+
+
+def migrate_csv(csv_path, storage, batch_size=5000):
+    """既存のCSVファイルをストレージに取り込む"""
+    batch = []
+    total = 0
+    for row in CsvStorage(csv_path).iter_rows():
+        batch.append([row.get(label) or '' for label in CSV_HEADER])
+        if len(batch) >= batch_size:
+            storage.append_many(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        storage.append_many(batch)
+        total += len(batch)
+    return total
+
+
+def export_csv(storage, path, **filters):
+    """ストレージの内容をCSVファイル（BOM付きUTF-8）に書き出す"""
+    # 同じファイルを同時に書き出すスレッド・プロセスがあっても一時ファイルが重ならないようにする
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w', newline='', encoding='utf-8-sig') as f:
+        count = write_csv(storage.iter_rows(**filters), f)
+    os.replace(tmp_path, path)
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='顧客データストレージの管理')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='CSVファイルをストレージに取り込む')
+    migrate_parser.add_argument('csv_path', nargs='?', default=CSV_PATH)
+    migrate_parser.add_argument('--backend', default=None)
+    migrate_parser.add_argument('--force', action='store_true', help='既存データがあっても取り込む')
+
+    export_parser = subparsers.add_parser('export', help='ストレージの内容をCSVファイルに書き出す')
+    export_parser.add_argument('csv_path', nargs='?', default=CSV_PATH)
+    export_parser.add_argument('--backend', default=None)
+
+    archive_parser = subparsers.add_parser('archive', help='古いパーティションをgzip圧縮する（partitionedのみ）')
+    archive_parser.add_argument('--before', required=True, help='このパーティションより前を圧縮（例: 2025-06）')
+
+    partitions_parser = subparsers.add_parser('partitions', help='パーティションの一覧を表示（partitionedのみ）')
+
+    args = parser.parse_args(argv)
+    storage = open_storage('partitioned' if args.command in ('archive', 'partitions') else args.backend)
+
+    if args.command == 'migrate':
+        if not os.path.exists(args.csv_path):
+            print(f"CSVファイルが見つかりません: {args.csv_path}")
+            return 1
+        if isinstance(storage, CsvStorage):
+            print("CSVストレージへの取り込みは不要です")
+            return 1
+        existing = storage.count()
+        if existing and not args.force:
+            print(f"ストレージに既に{existing}件のデータがあります（--forceで追加取り込み）")
+            return 1
+        total = migrate_csv(args.csv_path, storage)
+        print(f"✅ {total}件を取り込みました: {args.csv_path}")
+
+    elif args.command == 'export':
+        total = export_csv(storage, args.csv_path)
+        print(f"✅ {total}件を書き出しました: {args.csv_path}")
+
+    elif args.command == 'archive':
+        archived = storage.archive(args.before)
+        print(f"✅ {len(archived)}個のパーティションを圧縮しました: {', '.join(archived)}")
+
+    elif args.command == 'partitions':
+        for key, info in storage.partitions():
+            state = '圧縮済み' if info.get('archived') else ''
+            print(f"{key}: {info['rows']}件 ({info['min_ts']} 〜 {info['max_ts']}) {state}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""ローカル検証用のLINE Messaging APIスタブサーバー
+
+LINE_API_BASE_URL をこのサーバーに向けると、実際のLINE APIを呼ばずに動作確認できます。
+
+    python stub_line_api.py --port 8081
+    LINE_API_BASE_URL=http://127.0.0.1:8081 python webhook_server.py
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # 負荷試験で同時接続が集中しても接続を取りこぼさないようにする
+    request_queue_size = 256
+
+
+class StubLineApi:
+    """スタブサーバー本体（受信したリクエストを記録する）
+
+    latency秒（±jitter）の応答遅延と、error_rateの割合でerror_statusを返すエラーを注入できる。
+    負荷試験ではrecord=Falseにすると、リクエスト内容を保持せず件数だけを数える。
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, error_status=500, record=True, seed=None):
+        self.requests = []
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.record = record
+        # (メソッド, パス種別, ステータス) -> 件数
+        self.counts = Counter()
+        self._random = random.Random(seed)
+        self.server = _Server((host, port), self._make_handler())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub._handle(self, 'GET')
+
+            def do_POST(self):
+                stub._handle(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _handle(self, handler, method):
+        length = int(handler.headers.get('Content-Length') or 0)
+        raw = handler.rfile.read(length) if length else b''
+        body = json.loads(raw) if raw else None
+
+        with self.lock:
+            if self.record:
+                self.requests.append({
+                    'method': method,
+                    'path': handler.path,
+                    'headers': dict(handler.headers),
+                    'body': body,
+                })
+            delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+            inject_error = self.error_rate > 0 and self._random.random() < self.error_rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if inject_error:
+            status, payload = self.error_status, {'message': 'Injected error'}
+        else:
+            status, payload = self.respond(method, handler.path, body)
+
+        with self.lock:
+            self.counts[(method, _endpoint(handler.path), status)] += 1
+
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def respond(self, method, path, body):
+        """リクエストに対するステータスとJSONを返す"""
+        if method == 'GET' and path.startswith('/v2/bot/profile/'):
+            user_id = path.rsplit('/', 1)[-1]
+            return 200, {'userId': user_id, 'displayName': f'テスト{user_id[-4:]}'}
+        if method == 'POST' and path in ('/v2/bot/message/push', '/v2/bot/message/multicast'):
+            return 200, {}
+        return 404, {'message': 'Not found'}
+
+    def stats(self):
+        """エンドポイント・ステータスごとのリクエスト数を返す"""
+        with self.lock:
+            return {f'{method} {endpoint} {status}': count
+                    for (method, endpoint, status), count in sorted(self.counts.items())}
+
+    def start(self):
+        """バックグラウンドスレッドで起動"""
+        self.thread = threading.Thread(target=self.server.serve_forever, name='stub-line-api')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """停止"""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _endpoint(path):
+    """集計用にパスからユーザーIDなどを取り除く"""
+    if path.startswith('/v2/bot/profile/'):
+        return '/v2/bot/profile'
+    return path.split('?', 1)[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LINE Messaging APIスタブサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='応答遅延の秒数')
+    parser.add_argument('--jitter', type=float, default=0.0, help='応答遅延のゆらぎ（±秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='エラーを返す割合（0〜1）')
+    parser.add_argument('--error-status', type=int, default=500, help='注入するエラーのステータスコード')
+    args = parser.parse_args()
+
+    stub = StubLineApi(args.host, args.port, latency=args.latency, jitter=args.jitter,
+                       error_rate=args.error_rate, error_status=args.error_status, record=False)
+    print(f"🚀 スタブサーバー起動: {stub.base_url}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""複数のワーカープロセス（prefork.py）に同時に送っても、記録が欠けたり重複したりしないことを確かめる"""
+
+import os
+
+import pytest
+
+from bench_webhook import (
+    PayloadFactory, BENCH_CHANNEL_SECRET, bench_multiprocess, check_unsafe_config_refused,
+)
+from stub_line_api import StubLineApi
+
+
+@pytest.fixture
+def stub():
+    stub = StubLineApi(record=False).start()
+    yield stub
+    stub.stop()
+
+
+@pytest.mark.parametrize('storage_backend', ['sqlite', 'csv', 'partitioned'])
+def test_concurrent_workers_keep_every_record_once(stub, tmp_path, storage_backend):
+    factory = PayloadFactory(BENCH_CHANNEL_SECRET, users=50)
+    with open(tmp_path / 'server.log', 'w', encoding='utf-8') as log:
+        result = bench_multiprocess(
+            stub, str(tmp_path), factory, processes=3, storage_backend=storage_backend,
+            requests_total=150, concurrency=16, events_per_request=2, duplicate_ratio=0.2, log=log
+        )
+
+    assert 'error' not in result, result
+    # 再送（同じwebhookEventId）を含めて送ったリクエストがすべて受け付けられた
+    assert result['statuses'] == {'200': result['requests']}
+    assert result['duplicate_deliveries'] > 0
+    # 保存された行数がイベント数と一致し、欠落・重複・壊れた行が無い
+    assert result['stored_rows'] == result['events'] == 300
+    assert result['missing_rows'] == 0
+    assert result['duplicated_rows'] == 0
+    assert result['malformed_rows'] == 0
+    # 全プロセスの記録が顧客テーブルの集計にも1回ずつ反映された
+    assert result['customer_table_rows'] == result['events']
+
+
+def test_unsafe_shared_config_is_refused(stub, tmp_path):
+    with open(tmp_path / 'server.log', 'w', encoding='utf-8') as log:
+        result = check_unsafe_config_refused(stub, str(tmp_path), log)
+    assert result['refused'], result
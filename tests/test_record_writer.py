@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""RecordWriterの停止処理（キューが満杯でも時間内に戻ること・受け付けた記録を失わないこと）を確かめる"""
+
+import threading
+import time
+
+import pytest
+
+from record_writer import RecordWriter
+
+
+class SlowStorage:
+    """書き込みに時間がかかるストレージ"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def append_many(self, records, fsync=None):
+        time.sleep(self.delay)
+        with self._lock:
+            self.rows.extend(records)
+
+
+def start_writers(writer, threads, records):
+    """複数のスレッドから書き込み、受け付けられた件数を数える"""
+    accepted = []
+    lock = threading.Lock()
+
+    def produce():
+        for i in range(records):
+            try:
+                writer.write([i])
+            except RuntimeError:
+                return
+            with lock:
+                accepted.append(i)
+
+    workers = [threading.Thread(target=produce, daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    return workers, accepted
+
+
+def test_close_returns_within_timeout_when_queue_is_full():
+    storage = SlowStorage(delay=0.5)
+    writer = RecordWriter(storage, batch_size=2, flush_interval=0.01, queue_size=2)
+    workers, _ = start_writers(writer, threads=8, records=100)
+    # キューが満杯になり、書き込み側が空くのを待っている状態にする
+    time.sleep(0.3)
+
+    started = time.monotonic()
+    finished = writer.close(timeout=0.5)
+    elapsed = time.monotonic() - started
+
+    assert not finished
+    assert elapsed < 1.0
+    # 停止後の書き込みは受け付けない
+    with pytest.raises(RuntimeError):
+        writer.write(['late'])
+
+    storage.delay = 0
+    for worker in workers:
+        worker.join(5)
+    assert writer.close(timeout=5)
+
+
+def test_records_accepted_before_close_are_all_written():
+    for _ in range(20):
+        storage = SlowStorage(delay=0)
+        writer = RecordWriter(storage, batch_size=10, flush_interval=0.001, queue_size=20)
+        workers, accepted = start_writers(writer, threads=4, records=200)
+        time.sleep(0.01)
+
+        assert writer.close(timeout=10)
+        for worker in workers:
+            worker.join(5)
+        assert len(storage.rows) == len(accepted)
@@ -2,40 +2,251 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import json
+import shutil
+import argparse
+import itertools
 import subprocess
-import csv
 from datetime import datetime
 
+from storage import open_storage, export_csv, write_csv, CsvStorage, STORAGE_BACKEND
+
+# rcloneの設定ファイル
+RCLONE_CONFIG = os.environ.get('SHEETS_RCLONE_CONFIG', '/home/ubuntu/.gdrive-rclone.ini')
+
+# 差分同期の設定（アップロード先はrcloneのリモート、またはローカルのディレクトリ）
+SHEETS_SYNC_TARGET = os.environ.get('SHEETS_SYNC_TARGET', 'manus_google_drive:')
+SHEETS_SYNC_CHUNK_ROWS = int(os.environ.get('SHEETS_SYNC_CHUNK_ROWS', '5000'))
+SHEETS_SYNC_CHECKPOINT = os.environ.get('SHEETS_SYNC_CHECKPOINT', os.path.join(os.path.dirname(__file__), 'sheets_sync_checkpoint.json'))
+SHEETS_SYNC_STAGING_DIR = os.environ.get('SHEETS_SYNC_STAGING_DIR', os.path.join(os.path.dirname(__file__), 'sheets_sync_staging'))
+
+CHECKPOINT_VERSION = 1
+
+
+class LocalDirectoryTarget:
+    """ローカルのディレクトリにコピーするアップロード先（動作確認用）"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def upload(self, path, name):
+        os.makedirs(self.directory, exist_ok=True)
+        destination = os.path.join(self.directory, name)
+        shutil.copyfile(path, f'{destination}.tmp')
+        os.replace(f'{destination}.tmp', destination)
+
+    def link(self):
+        return os.path.abspath(self.directory)
+
+
+class RcloneTarget:
+    """rcloneのリモート（Google Driveなど）にアップロードするアップロード先"""
+
+    def __init__(self, remote, config=RCLONE_CONFIG):
+        self.remote = remote
+        self.config = config
+
+    def _remote_path(self, name=''):
+        if not name or self.remote.endswith((':', '/')):
+            return f'{self.remote}{name}'
+        return f'{self.remote}/{name}'
+
+    def _run(self, *args):
+        return subprocess.run(['rclone', *args, '--config', self.config], capture_output=True, text=True)
+
+    def upload(self, path, name):
+        result = self._run('copyto', path, self._remote_path(name))
+        if result.returncode != 0:
+            raise RuntimeError(f'rcloneのアップロードに失敗しました: {result.stderr.strip()}')
+
+    def link(self):
+        result = self._run('link', self._remote_path())
+        return result.stdout.strip() if result.returncode == 0 else None
+
+
+def open_target(target):
+    """アップロード先を開く（「リモート名:パス」はrclone、それ以外はローカルのディレクトリ）"""
+    if os.path.isabs(target) or ':' not in target:
+        return LocalDirectoryTarget(target)
+    return RcloneTarget(target)
+
+
+def load_checkpoint(path=SHEETS_SYNC_CHECKPOINT):
+    """同期のチェックポイントを読み込む（無い・壊れている場合はNone）"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except Exception as e:
+        print(f"⚠️ チェックポイント読み込み失敗: {e}")
+        return None
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        return None
+    return checkpoint
+
+
+def save_checkpoint(checkpoint, path=SHEETS_SYNC_CHECKPOINT):
+    """チェックポイントを保存（書き込み途中で止まっても壊れないよう置き換える）"""
+    checkpoint['updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _stage_parts(rows, checkpoint, staging_dir, chunk_rows):
+    """新しい行をchunk_rows行ずつのCSVファイルに書き出す（BOM付きUTF-8・各ファイルにヘッダー付き）"""
+    os.makedirs(staging_dir, exist_ok=True)
+    parts = []
+    sequence = checkpoint['sequence']
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_rows))
+        if not chunk:
+            break
+        sequence += 1
+        name = f"customer_data_{checkpoint['generation']}_{sequence:06d}.csv"
+        with open(os.path.join(staging_dir, name), 'w', newline='', encoding='utf-8-sig') as f:
+            write_csv(chunk, f)
+        parts.append({'name': name, 'rows': len(chunk), 'uploaded': False})
+    return parts
+
+
+def _clean_staging(staging_dir):
+    """アップロード待ちでなくなったファイルを削除"""
+    if not os.path.isdir(staging_dir):
+        return
+    for name in os.listdir(staging_dir):
+        os.remove(os.path.join(staging_dir, name))
+
+
+def sync_delta(storage=None, target=SHEETS_SYNC_TARGET, checkpoint_path=SHEETS_SYNC_CHECKPOINT,
+               staging_dir=SHEETS_SYNC_STAGING_DIR, chunk_rows=SHEETS_SYNC_CHUNK_ROWS, rebuild=False, backend=None):
+    """前回の同期以降に追記された行だけを分割したCSVファイルとしてアップロードする
+
+    書き出した分割ファイルと同期後の位置をチェックポイントに記録してから1ファイルずつアップロードし、
+    途中で止まった場合は次回、残りのファイルからアップロードを再開する。
+    ストレージが作り直された場合は新しい世代として全件をアップロードし直す。
+    """
+    backend = backend or STORAGE_BACKEND
+    storage = storage or open_storage(backend)
+    uploader = open_target(target)
+    checkpoint = None if rebuild else load_checkpoint(checkpoint_path)
+    if checkpoint is not None and checkpoint.get('target') != target:
+        print("⚠️ アップロード先が変わったため、全件を同期し直します")
+        checkpoint = None
+
+    pending = (checkpoint or {}).get('pending')
+    if pending and not all(
+        part['uploaded'] or os.path.exists(os.path.join(staging_dir, part['name'])) for part in pending['parts']
+    ):
+        print("⚠️ アップロード待ちのファイルが見つからないため、前回の位置から書き出し直します")
+        checkpoint['pending'] = pending = None
+
+    resumed = bool(pending)
+    if not pending:
+        if (checkpoint is not None and checkpoint.get('backend') == backend
+                and storage.position_valid(checkpoint.get('position'))):
+            position = checkpoint['position']
+        else:
+            if checkpoint is not None:
+                print("⚠️ データが作り直されたため、新しい世代として全件を同期します")
+            checkpoint = {
+                'version': CHECKPOINT_VERSION,
+                'backend': backend,
+                'target': target,
+                'generation': datetime.now().strftime('%Y%m%d%H%M%S'),
+                'position': None,
+                'sequence': 0,
+                'synced_rows': 0,
+                'link': None,
+            }
+            position = None
+
+        _clean_staging(staging_dir)
+        rows, next_position = storage.scan_since(position)
+        parts = _stage_parts(rows, checkpoint, staging_dir, max(1, int(chunk_rows)))
+        if not parts:
+            if next_position is not None:
+                checkpoint['position'] = next_position
+            save_checkpoint(checkpoint, checkpoint_path)
+            print("✅ 新しい行はありません")
+            return {'rows': 0, 'parts': [], 'resumed': False, 'synced_rows': checkpoint['synced_rows']}
+        pending = checkpoint['pending'] = {'position': next_position, 'parts': parts}
+        save_checkpoint(checkpoint, checkpoint_path)
+    else:
+        print(f"♻️ 前回の同期を再開します: 残り{sum(1 for part in pending['parts'] if not part['uploaded'])}ファイル")
+
+    for part in pending['parts']:
+        if part['uploaded']:
+            continue
+        uploader.upload(os.path.join(staging_dir, part['name']), part['name'])
+        part['uploaded'] = True
+        save_checkpoint(checkpoint, checkpoint_path)
+        print(f"📤 アップロード: {part['name']}（{part['rows']}行）")
+
+    # すべてアップロードできたら位置を進める
+    new_rows = sum(part['rows'] for part in pending['parts'])
+    checkpoint['position'] = pending['position']
+    checkpoint['sequence'] += len(pending['parts'])
+    checkpoint['synced_rows'] += new_rows
+    checkpoint['pending'] = None
+    if checkpoint.get('link') is None:
+        # 共有リンクはアップロード先ごとに1回だけ取得する
+        checkpoint['link'] = uploader.link()
+    save_checkpoint(checkpoint, checkpoint_path)
+    _clean_staging(staging_dir)
+
+    print(f"✅ 差分同期完了: {new_rows}行（{len(pending['parts'])}ファイル）")
+    if checkpoint['link']:
+        print(f"共有リンク: {checkpoint['link']}")
+    return {
+        'rows': new_rows,
+        'parts': [part['name'] for part in pending['parts']],
+        'resumed': resumed,
+        'synced_rows': checkpoint['synced_rows'],
+    }
+
+
 def upload_csv_to_google_drive():
-    """ＣＳＶファイルをGoogle Driveにアップロード"""
+    """ＣＳＶファイルをGoogle Driveにアップロード（全件）"""
     csv_file = os.path.join(os.path.dirname(__file__), 'customer_data.csv')
-    
-    if not os.path.exists(csv_file):
-        print("CSVファイルが見つかりません")
+    storage = open_storage()
+
+    if storage.count() == 0:
+        print("顧客データが見つかりません")
         return False
-    
+
+    # ストレージからCSVを書き出す（CSVストレージの場合はそのまま使う）
+    if isinstance(storage, CsvStorage):
+        csv_file = storage.path
+    else:
+        export_csv(storage, csv_file)
+
     # Google DriveにアップロードするファイルパスとGoogle Sheets形式に変換
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     remote_path = f'manus_google_drive:LINE顧客管理システム_{timestamp}.csv'
-    
+
     try:
         # rcloneを使用してアップロード
         result = subprocess.run(
-            ['rclone', 'copy', csv_file, 'manus_google_drive:', '--config', '/home/ubuntu/.gdrive-rclone.ini'],
+            ['rclone', 'copy', csv_file, 'manus_google_drive:', '--config', RCLONE_CONFIG],
             capture_output=True,
             text=True
         )
-        
+
         if result.returncode == 0:
             print(f"Google Driveにアップロード成功: {remote_path}")
-            
+
             # 共有リンクを取得
             link_result = subprocess.run(
-                ['rclone', 'link', f'manus_google_drive:customer_data.csv', '--config', '/home/ubuntu/.gdrive-rclone.ini'],
+                ['rclone', 'link', f'manus_google_drive:customer_data.csv', '--config', RCLONE_CONFIG],
                 capture_output=True,
                 text=True
             )
-            
+
             if link_result.returncode == 0:
                 print(f"共有リンク: {link_result.stdout.strip()}")
                 return link_result.stdout.strip()
@@ -45,30 +256,46 @@ def upload_csv_to_google_drive():
         else:
             print(f"アップロードエラー: {result.stderr}")
             return False
-    
+
     except Exception as e:
         print(f"エラー: {e}")
         return False
 
-def generate_summary_report():
-    """サマリーレポートを生成"""
-    csv_file = os.path.join(os.path.dirname(__file__), 'customer_data.csv')
-    
-    if not os.path.exists(csv_file):
-        print("CSVファイルが見つかりません")
-        return
-    
+def generate_summary_report(checkpoint=None):
+    """サマリーレポートを生成（同期済みの場合はチェックポイントの件数を使い、全件を読まない）"""
     try:
-        with open(csv_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-        
+        if checkpoint is not None and not checkpoint.get('pending'):
+            total = checkpoint['synced_rows']
+        else:
+            total = open_storage().count()
+        if total == 0:
+            print("顧客データが見つかりません")
+            return
+
         print("\n=== LINE顧客管理システム サマリー ===")
-        print(f"総メッセージ数: {len(rows)}")
-        
+        print(f"総メッセージ数: {total}")
+
     except Exception as e:
         print(f"レポート生成エラー: {e}")
 
 if __name__ == '__main__':
-    generate_summary_report()
-    upload_csv_to_google_drive()
+    parser = argparse.ArgumentParser(description='顧客データをGoogle Driveにアップロード')
+    parser.add_argument('--delta', action='store_true',
+                        help='全件のCSVではなく、前回の同期以降の行だけを分割したCSVでアップロードする（差分同期）')
+    parser.add_argument('--target', default=SHEETS_SYNC_TARGET, help='--delta: アップロード先（rcloneのリモート「名前:パス」またはローカルのディレクトリ）')
+    parser.add_argument('--chunk-rows', type=int, default=SHEETS_SYNC_CHUNK_ROWS, help='--delta: 1ファイルあたりの行数')
+    parser.add_argument('--checkpoint', default=SHEETS_SYNC_CHECKPOINT, help='--delta: チェックポイントファイルのパス')
+    parser.add_argument('--rebuild', action='store_true', help='--delta: チェックポイントを使わず全件を新しい世代として同期し直す')
+    args = parser.parse_args()
+
+    if not args.delta:
+        generate_summary_report()
+        upload_csv_to_google_drive()
+    else:
+        try:
+            sync_delta(target=args.target, checkpoint_path=args.checkpoint,
+                       chunk_rows=args.chunk_rows, rebuild=args.rebuild)
+        except Exception as e:
+            print(f"❌ 同期エラー（次回は続きから再開します）: {e}")
+            sys.exit(1)
+        generate_summary_report(load_checkpoint(args.checkpoint))
@@ -6,10 +6,35 @@ import json
 import hmac
 import hashlib
 import base64
+import zlib
+import atexit
+import signal
+import sys
+import time
 from datetime import datetime
-from flask import Flask, request, abort
-import requests
-from threading import Thread
+from flask import Flask, request, abort, jsonify, Response, redirect, send_file, g
+
+from worker_pool import WorkerPool
+from line_api import LineApiClient, text_message
+from rate_limit import RateLimiter, default_limits, LINE_RATE_BULK_RESERVE, LINE_RATE_LIMIT_PATH
+from storage import open_storage, iter_csv_chunks, export_csv, FIELDS, STORAGE_BACKEND
+from aggregates import MessageStats
+from customers import CustomerTable, CUSTOMERS_PATH, CUSTOMER_COLUMNS
+from search_index import SearchIndex, SEARCH_INDEX_PATH
+from render_cache import DataVersion, RenderCache, DATA_VERSION_PATH
+from broadcast import BroadcastManager, BroadcastJobStore, BROADCAST_JOBS_PATH
+from classifier import classify_message
+from record_writer import RecordWriter
+from event_dedup import EventDeduplicator
+from outbox import (
+    Outbox, OUTBOX_PATH, OUTBOX_WORKERS, OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_BASE_DELAY, OUTBOX_MAX_DELAY, OUTBOX_KEEP_SENT, OUTBOX_SENDING_LEASE, STATUSES as OUTBOX_STATUSES,
+)
+from profile_cache import ProfileCache
+from prefork import (
+    check_config, fork_guard_needed, refuse_forked_child, shared_default, WEBHOOK_PROCESSES, WEBHOOK_SERVER_FD,
+)
+import metrics
 
 
 app = Flask(__name__)
@@ -18,204 +43,311 @@ app = Flask(__name__)
 CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', '')
 CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '')
 
+# 受信処理の方式（threaded: ワーカープール / async: asyncio、async_server.pyを参照）
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'threaded')
+
+# 重複イベント除外設定
+EVENT_DEDUP_PATH = os.environ.get('EVENT_DEDUP_PATH', os.path.join(os.path.dirname(__file__), 'webhook_events.db'))
+EVENT_DEDUP_WINDOW = float(os.environ.get('EVENT_DEDUP_WINDOW', '86400'))
+EVENT_DEDUP_MEMORY_SIZE = int(os.environ.get('EVENT_DEDUP_MEMORY_SIZE', '100000'))
+
+# 複数プロセス（WEBHOOK_PROCESSES>1）で記録が壊れる・重複する設定なら、何も開かずに起動を中止する
+check_config({
+    'WEBHOOK_MODE': WEBHOOK_MODE,
+    'STORAGE_BACKEND': STORAGE_BACKEND,
+    'EVENT_DEDUP_PATH': EVENT_DEDUP_PATH,
+    'LINE_RATE_LIMIT_PATH': LINE_RATE_LIMIT_PATH,
+    'BROADCAST_JOBS_PATH': BROADCAST_JOBS_PATH,
+    'DATA_VERSION_PATH': DATA_VERSION_PATH,
+})
+
+# LINE APIクライアント（全API呼び出しで接続プールを共有）
+# LINE APIのエンドポイントごとの共有レート制限（自動返信などを配信より優先）
+rate_limiter = RateLimiter(
+    default_limits(),
+    bulk_reserve=LINE_RATE_BULK_RESERVE,
+    path=LINE_RATE_LIMIT_PATH or None
+)
+line_api = LineApiClient(CHANNEL_ACCESS_TOKEN, rate_limiter=rate_limiter)
+
+# 自動返信・挨拶メッセージの送信キュー（SQLiteに保存し、失敗時はバックオフして再送）
+outbox = Outbox(
+    line_api,
+    OUTBOX_PATH or None,
+    workers=OUTBOX_WORKERS,
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    base_delay=OUTBOX_BASE_DELAY,
+    max_delay=OUTBOX_MAX_DELAY,
+    keep_sent=OUTBOX_KEEP_SENT,
+    sending_lease=OUTBOX_SENDING_LEASE
+)
+# 前回の停止時に未送信だったメッセージもここから送る
+# （複数プロセスでは他のプロセスが送信中のものを戻さず、OUTBOX_SENDING_LEASEを過ぎたものだけ送り直す）
+outbox.start(recover=WEBHOOK_PROCESSES <= 1)
+
+# メッセージ記録のストレージ（STORAGE_BACKENDで切り替え、デフォルトはSQLite）
+storage = open_storage()
+
+# 記録書き込み設定
+WRITER_BATCH_SIZE = int(os.environ.get('WRITER_BATCH_SIZE', '200'))
+WRITER_FLUSH_INTERVAL = float(os.environ.get('WRITER_FLUSH_INTERVAL', '0.2'))
+WRITER_FSYNC = os.environ.get('WRITER_FSYNC', 'batch')
+
+# ユーザーIDごとの顧客テーブルと配信対象のセグメント
+# （起動時に前回以降の記録を反映し、以降は書き込みのたびに更新。セグメントはsegments.pyで登録）
+customers = CustomerTable(storage, CUSTOMERS_PATH or None)
+customers.catch_up()
+
+# メッセージ内容の全文検索インデックス（顧客テーブルと同じく書き込みのたびに追記分を反映）
+search_index = SearchIndex(storage, SEARCH_INDEX_PATH or None)
+search_index.catch_up()
+
+# /stats用の集計値（起動時にストレージから作り直し、以降は書き込んだ記録を反映）
+message_stats = MessageStats()
+message_stats.rebuild(storage)
+
+# 書き込みのたびに増やすデータの版と、版ごとのページの描画結果（/statsなど）
+data_version = DataVersion(DATA_VERSION_PATH or None)
+render_cache = RenderCache(data_version)
+
+def apply_written_records(batch):
+    """書き込んだ記録を集計値・顧客テーブル・検索インデックスに反映し、データの版を進める"""
+    try:
+        for data in batch:
+            message_stats.record(data)
+        customers.catch_up()
+        search_index.catch_up()
+    finally:
+        data_version.bump()
+
+# 記録を専用スレッドでまとめて書き込むライター
+record_writer = RecordWriter(
+    storage,
+    batch_size=WRITER_BATCH_SIZE,
+    flush_interval=WRITER_FLUSH_INTERVAL,
+    fsync=WRITER_FSYNC,
+    on_flush=apply_written_records
+)
+
+# ダウンロード設定（Range要求用に書き出したCSVの保存先と保持数）
+EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'export_cache'))
+EXPORT_CACHE_KEEP = int(os.environ.get('EXPORT_CACHE_KEEP', '5'))
+
+# JSON API（/api/messages・/api/customers）の1ページの既定件数と最大件数
+API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', '100'))
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', '1000'))
+
+# プッシュ配信設定
+BROADCAST_JOB_WORKERS = int(os.environ.get('BROADCAST_JOB_WORKERS', '1'))
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '4'))
+
+# 配信ジョブの実行（マルチキャストをバッチ単位で並行送信）
+broadcast_pool = WorkerPool(workers=BROADCAST_JOB_WORKERS, queue_size=100, name='broadcast-worker')
+broadcast_manager = BroadcastManager(
+    line_api,
+    broadcast_pool,
+    concurrency=BROADCAST_CONCURRENCY,
+    store=BroadcastJobStore(BROADCAST_JOBS_PATH) if BROADCAST_JOBS_PATH else None
+)
+
 # Google Sheets設定
 SPREADSHEET_NAME = "LINE顧客管理システム"
 
-def save_to_local_csv(data):
-    """ローカルCSVファイルに保存（BOM付きUTF-8）"""
-    import csv
-    # 相対パスを使用（Render.com環境対応）
-    csv_file = os.path.join(os.path.dirname(__file__), 'customer_data.csv')
-    
-    # ファイルが存在しない場合はヘッダーを書き込む
-    file_exists = os.path.isfile(csv_file)
-    
+# イベント処理ワーカー設定
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.environ.get('WEBHOOK_SHUTDOWN_TIMEOUT', '25'))
+
+# Webhookイベントを処理するワーカープール（スレッド数とキュー長に上限あり）
+event_pool = WorkerPool(workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE, name='webhook-worker')
+
+# /statusに追加する状態（名前 -> 統計を返す関数）
+extra_status = {}
+
+# 再送されたWebhookイベントをwebhookEventIdで除外
+event_deduplicator = EventDeduplicator(
+    EVENT_DEDUP_PATH or None,
+    window=EVENT_DEDUP_WINDOW,
+    maxsize=EVENT_DEDUP_MEMORY_SIZE
+)
+
+# プロフィールキャッシュ設定
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', '10000'))
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', '86400'))
+PROFILE_CACHE_NEGATIVE_TTL = float(os.environ.get('PROFILE_CACHE_NEGATIVE_TTL', '60'))
+PROFILE_CACHE_PATH = os.environ.get('PROFILE_CACHE_PATH', os.path.join(os.path.dirname(__file__), 'profile_cache.json'))
+# 複数プロセスで共有するキャッシュ（空でプロセス内のみ。WEBHOOK_PROCESSES>1では既定でファイル）
+PROFILE_CACHE_SHARED_PATH = os.environ.get('PROFILE_CACHE_SHARED_PATH', shared_default('profile_cache.db'))
+
+# ユーザーID -> 表示名のキャッシュ（再起動時はファイルから復元）
+profile_cache = ProfileCache(
+    maxsize=PROFILE_CACHE_SIZE,
+    ttl=PROFILE_CACHE_TTL,
+    negative_ttl=PROFILE_CACHE_NEGATIVE_TTL,
+    path=PROFILE_CACHE_PATH or None,
+    shared_path=PROFILE_CACHE_SHARED_PATH or None
+)
+profile_cache.load()
+
+# 複数プロセス・gunicornでは、初期化済みのサーバーをforkした子プロセスは動かさない
+# （スレッド・接続が引き継がれないため。単一プロセスでのfork（multiprocessingなど）は妨げない）
+if fork_guard_needed():
+    os.register_at_fork(after_in_child=refuse_forked_child)
+
+def save_record(data):
+    """メッセージ記録を書き込みキューに投入（専用スレッドがまとめて保存）"""
     try:
-        # BOM付きUTF-8で書き込み（Excelで正しく開けるようにする）
-        with open(csv_file, 'a', newline='', encoding='utf-8-sig') as f:
-            writer = csv.writer(f)
-            
-            if not file_exists:
-                # ヘッダー
-                writer.writerow([
-                    'タイムスタンプ',
-                    'ユーザーID',
-                    'ユーザー名',
-                    'メッセージタイプ',
-                    'メッセージ内容',
-                    '返信ステータス',
-                    'マネタイズ機会',
-                    '備考'
-                ])
-            
-            # データを書き込む
-            writer.writerow(data)
-            print(f"✅ CSVに保存しました: {data[2]} - {data[4]}")
+        with metrics.STAGE_WRITE.time():
+            record_writer.write(data)
+        print(f"✅ 記録を保存しました: {data[2]} - {data[4]}")
     except Exception as e:
-        print(f"❌ CSV保存エラー: {e}")
+        print(f"❌ 記録保存エラー: {e}")
         import traceback
         traceback.print_exc()
 
-def send_reply_message(user_id, message_text):
-    """LINEユーザーに返信メッセージを送信"""
-    url = 'https://api.line.me/v2/bot/message/push'
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {CHANNEL_ACCESS_TOKEN}'
-    }
-    
-    data = {
-        'to': user_id,
-        'messages': [
-            {
-                'type': 'text',
-                'text': message_text
-            }
-        ]
-    }
-    
+def send_reply_message(user_id, message_text, kind='reply'):
+    """LINEユーザーへの返信メッセージを送信キューに保存（送信は送信スレッドが再送しながら行う）"""
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=5)
-        if response.status_code == 200:
-            print(f"✅ メッセージ送信成功: {user_id}")
-            return True
-        else:
-            print(f"⚠️ メッセージ送信失敗: {response.status_code} - {response.text}")
-            return False
+        outbox.enqueue(user_id, [text_message(message_text)], kind)
+        print(f"📮 送信キューに追加: {user_id}")
+        return True
     except Exception as e:
-        print(f"❌ メッセージ送信エラー: {e}")
+        print(f"❌ 送信キュー追加エラー: {e}")
         return False
 
-def get_user_profile(user_id):
-    """LINEユーザーのプロフィールを取得"""
-    url = f'https://api.line.me/v2/bot/profile/{user_id}'
-    headers = {
-        'Authorization': f'Bearer {CHANNEL_ACCESS_TOKEN}'
-    }
-    
+def fetch_user_profile(user_id):
+    """LINE APIからユーザーの表示名を取得（失敗時はNone）"""
     try:
-        response = requests.get(url, headers=headers, timeout=5)
+        response = line_api.get_profile(user_id)
         if response.status_code == 200:
             profile = response.json()
             return profile.get('displayName', 'Unknown')
         else:
             print(f"⚠️ プロフィール取得失敗: {response.status_code}")
-            return 'Unknown'
+            return None
     except Exception as e:
         print(f"❌ プロフィール取得エラー: {e}")
-        return 'Unknown'
+        return None
+
+def get_user_profile(user_id):
+    """LINEユーザーのプロフィールを取得（キャッシュ経由）"""
+    with metrics.STAGE_PROFILE.time():
+        user_name = profile_cache.get(user_id, fetch_user_profile)
+    return user_name if user_name is not None else 'Unknown'
 
 def get_auto_reply(message_text):
     """キーワードベースの自動返信メッセージを取得"""
-    # 長いキーワードを優先するため、順序を指定
-    auto_replies = [
-        ('詳しい実績', '非公開実績をご覧いただけます！\n\n🔒 非公開実績\nhttps://www.notion.so/moxmovie/a4b31ca6873c48d7bc3caea433e83ae2\n\nパスワードは個別にお伝えいたします。\n担当者からのメッセージをお待ちください！\n\nご不明な点があれば、お気軽にお問い合わせください！'),
-        ('ポートフォリオ', '制作実績はこちらからご覧いただけます！\n\n🎬 公開実績\nhttps://www.mox-motage.com/works\n\nより詳しい実績（非公開含む）をご希望の場合は、\n「詳しい実績を見たい」とメッセージをお送りください。\nパスワードをお伝えいたします！\n\nご不明な点があれば、お気軽にお問い合わせください！'),
-        ('実績', '制作実績はこちらからご覧いただけます！\n\n🎬 公開実績\nhttps://www.mox-motage.com/works\n\nより詳しい実績（非公開含む）をご希望の場合は、\n「詳しい実績を見たい」とメッセージをお送りください。\nパスワードをお伝えいたします！\n\nご不明な点があれば、お気軽にお問い合わせください！'),
-        ('営業時間', '営業時間は以下の通りです。\n\n平日: 9:00 - 21:00\n土日祝: 9:00 - 17:00\n不定休\n\nお気軽にお問い合わせください！'),
-        ('料金', '料金については、プロジェクトの内容や規模によって異なります。\n\n詳しいお見積もりをご希望の場合は、以下の情報をお知らせください。\n\n1. 映像の種類（企業紹介、イベント、商品PRなど）\n2. 映像の長さ\n3. 納期\n4. 使用目的\n\n担当者から詳しいお見積もりをお送りいたします！'),
-        ('価格', '料金については、プロジェクトの内容や規模によって異なります。\n\n詳しいお見積もりをご希望の場合は、以下の情報をお知らせください。\n\n1. 映像の種類（企業紹介、イベント、商品PRなど）\n2. 映像の長さ\n3. 納期\n4. 使用目的\n\n担当者から詳しいお見積もりをお送りいたします！'),
-        ('場所', '事務所の住所は以下の通りです。\n\n〔住所〕\n〒670-0012\n兵庫県姫路市本町127番地\n大手前ダイネンBLD.II 3F\n\n〔電話番号〕\n080-1755-4598\n\n〔メール〕\nfukusuke.mox@gmail.com\n\nお越しの際は、事前にご連絡いただけると助かります！'),
-        ('住所', '事務所の住所は以下の通りです。\n\n〔住所〕\n〒670-0012\n兵庫県姫路市本町127番地\n大手前ダイネンBLD.II 3F\n\n〔電話番号〕\n080-1755-4598\n\n〔メール〕\nfukusuke.mox@gmail.com\n\nお越しの際は、事前にご連絡いただけると助かります！'),
-        ('メニュー', '主なサービス内容は以下の通りです。\n\n■ 企業紹介映像\n■ 商品・SNS用動画\n■ イベント撮影\n■ ドローン空撮\n■ 動画編集\n\n詳しい内容やお見積もりは、お気軽にお問い合わせください！'),
-        ('サービス', '主なサービス内容は以下の通りです。\n\n■ 企業紹介映像\n■ 商品・SNS用動画\n■ イベント撮影\n■ ドローン空撮\n■ 動画編集\n\n詳しい内容やお見積もりは、お気軽にお問い合わせください！'),
-    ]
-    
-    # 長いキーワードから優先的にチェック
-    for keyword, reply in auto_replies:
-        if keyword in message_text:
-            return reply
-    
-    return None
+    return classify_message(message_text).auto_reply
 
 def analyze_monetization_opportunity(message_text):
     """メッセージからマネタイズ機会を分析"""
-    keywords = {
-        '高': ['見積', '予算', '料金', '価格', '費用', '依頼', '発注', '契約', '購入'],
-        '中': ['興味', '詳しく', '教えて', '知りたい', '相談', '検討'],
-        '低': ['ありがとう', 'よろしく', 'わかりました', 'OK']
-    }
-    
-    message_lower = message_text.lower()
-    
-    for level, words in keywords.items():
-        for word in words:
-            if word in message_text:
-                return level
-    
-    return '要確認'
+    return classify_message(message_text).monetization
 
 def check_reply_needed(message_text):
     """返信が必要かどうかを判定"""
-    question_keywords = ['?', '？', 'どう', 'いつ', 'どこ', 'なに', '教えて', '知りたい', 'できます', 'お願い']
+    return classify_message(message_text).reply_status
+
+# メッセージタイプごとの記録内容（テキスト以外）
+MESSAGE_PLACEHOLDERS = {
+    'image': '[画像]',
+    'video': '[動画]',
+    'audio': '[音声]',
+    'file': '[ファイル]',
+    'location': '[位置情報]',
+    'sticker': '[スタンプ]',
+}
+
+def _event_timestamp(event):
+    """イベントのタイムスタンプ（ミリ秒）を記録用の文字列に変換"""
+    return datetime.fromtimestamp(event['timestamp'] / 1000).strftime('%Y-%m-%d %H:%M:%S')
+
+def build_message_record(event, user_name):
+    """メッセージイベントから記録と自動返信メッセージを作る"""
+    user_id = event['source']['userId']
+    message_type = event['message']['type']
     
-    for keyword in question_keywords:
-        if keyword in message_text:
-            return '要返信'
+    # メッセージ内容
+    if message_type == 'text':
+        message_content = event['message']['text']
+    else:
+        message_content = MESSAGE_PLACEHOLDERS.get(message_type, f'[{message_type}]')
+    
+    # 返信ステータス・マネタイズ機会・自動返信を1回の走査で判定
+    auto_reply = None
+    if message_type == 'text':
+        with metrics.STAGE_CLASSIFY.time():
+            classification = classify_message(message_content)
+        reply_status = classification.reply_status
+        monetization = classification.monetization
+        auto_reply = classification.auto_reply
+    else:
+        reply_status = '確認済み'
+        monetization = '-'
     
-    return '確認済み'
+    data = [
+        _event_timestamp(event),
+        user_id,
+        user_name,
+        message_type,
+        message_content,
+        reply_status,
+        monetization,
+        ''
+    ]
+    return data, auto_reply
+
+def build_follow_record(event, user_name):
+    """フォローイベントの記録を作る"""
+    return [
+        _event_timestamp(event),
+        event['source']['userId'],
+        user_name,
+        'follow',
+        '[新規フォロー]',
+        '要返信',
+        '高',
+        '新規顧客'
+    ]
+
+def build_unfollow_record(event):
+    """アンフォローイベントの記録を作る"""
+    return [
+        _event_timestamp(event),
+        event['source']['userId'],
+        'Unknown',
+        'unfollow',
+        '[ブロック/削除]',
+        '-',
+        '-',
+        '離脱顧客'
+    ]
+
+def welcome_message(user_name):
+    """友だち追加時の挨拶メッセージ"""
+    return f"{user_name}様\n\nこんにちは！映像制作 moX（もっくす）です🎬\n\n友だち追加ありがとうございます！\n\nご質問やお見積もりなど、お気軽にメッセージをお送りください。\n担当者が確認次第、ご返信させていただきます。\n\nよろしくお願いいたします！"
 
 def process_webhook_event(event):
     """Webhookイベントを処理（バックグラウンド実行用）"""
+    started = time.perf_counter()
+    result = 'processed'
     try:
         if event['type'] == 'message':
             # メッセージイベント
             user_id = event['source']['userId']
-            message_type = event['message']['type']
-            
-            print(f"📨 メッセージ受信: user_id={user_id}, type={message_type}")
+            print(f"📨 メッセージ受信: user_id={user_id}, type={event['message']['type']}")
             
             # ユーザープロフィール取得
             user_name = get_user_profile(user_id)
+            data, auto_reply = build_message_record(event, user_name)
             
-            # メッセージ内容
-            message_content = ''
-            if message_type == 'text':
-                message_content = event['message']['text']
-            elif message_type == 'image':
-                message_content = '[画像]'
-            elif message_type == 'video':
-                message_content = '[動画]'
-            elif message_type == 'audio':
-                message_content = '[音声]'
-            elif message_type == 'file':
-                message_content = '[ファイル]'
-            elif message_type == 'location':
-                message_content = '[位置情報]'
-            elif message_type == 'sticker':
-                message_content = '[スタンプ]'
-            else:
-                message_content = f'[{message_type}]'
-            
-            # 返信ステータスとマネタイズ機会を分析
-            reply_status = check_reply_needed(message_content) if message_type == 'text' else '確認済み'
-            monetization = analyze_monetization_opportunity(message_content) if message_type == 'text' else '-'
-            
-            # キーワードベースの自動返信をチェック
-            if message_type == 'text':
-                auto_reply = get_auto_reply(message_content)
-                if auto_reply:
-                    send_reply_message(user_id, auto_reply)
-                    print(f"🤖 自動返信送信: {user_name}")
+            # キーワードベースの自動返信
+            if auto_reply:
+                send_reply_message(user_id, auto_reply)
+                print(f"🤖 自動返信送信: {user_name}")
             
-            # タイムスタンプ
-            timestamp = datetime.fromtimestamp(event['timestamp'] / 1000).strftime('%Y-%m-%d %H:%M:%S')
+            save_record(data)
             
-            # データを保存
-            data = [
-                timestamp,
-                user_id,
-                user_name,
-                message_type,
-                message_content,
-                reply_status,
-                monetization,
-                ''
-            ]
-            
-            save_to_local_csv(data)
-            
-            print(f"✅ メッセージ記録完了: {user_name} - {message_content}")
+            print(f"✅ メッセージ記録完了: {user_name} - {data[4]}")
         
         elif event['type'] == 'follow':
             # フォローイベント
@@ -223,24 +355,10 @@ def process_webhook_event(event):
             print(f"👤 新規フォロー: user_id={user_id}")
             
             user_name = get_user_profile(user_id)
-            timestamp = datetime.fromtimestamp(event['timestamp'] / 1000).strftime('%Y-%m-%d %H:%M:%S')
-            
-            data = [
-                timestamp,
-                user_id,
-                user_name,
-                'follow',
-                '[新規フォロー]',
-                '要返信',
-                '高',
-                '新規顧客'
-            ]
-            
-            save_to_local_csv(data)
+            save_record(build_follow_record(event, user_name))
             
             # 自動挨拶メッセージを送信
-            welcome_message = f"{user_name}様\n\nこんにちは！映像制作 moX（もっくす）です🎬\n\n友だち追加ありがとうございます！\n\nご質問やお見積もりなど、お気軽にメッセージをお送りください。\n担当者が確認次第、ご返信させていただきます。\n\nよろしくお願いいたします！"
-            send_reply_message(user_id, welcome_message)
+            send_reply_message(user_id, welcome_message(user_name), kind='welcome')
             
             print(f"✅ 新規フォロー記録: {user_name}")
         
@@ -249,27 +367,56 @@ def process_webhook_event(event):
             user_id = event['source']['userId']
             print(f"👋 アンフォロー: user_id={user_id}")
             
-            timestamp = datetime.fromtimestamp(event['timestamp'] / 1000).strftime('%Y-%m-%d %H:%M:%S')
-            
-            data = [
-                timestamp,
-                user_id,
-                'Unknown',
-                'unfollow',
-                '[ブロック/削除]',
-                '-',
-                '-',
-                '離脱顧客'
-            ]
-            
-            save_to_local_csv(data)
+            save_record(build_unfollow_record(event))
             
             print(f"✅ アンフォロー記録: {user_id}")
     
     except Exception as e:
+        result = 'failed'
         print(f"❌ イベント処理エラー: {e}")
         import traceback
         traceback.print_exc()
+    
+    metrics.record_event(event.get('type'), result, time.perf_counter() - started)
+
+def verify_signature(body, signature):
+    """X-Line-Signatureを検証（チャネルシークレット未設定時は検証しない）"""
+    if not CHANNEL_SECRET:
+        return True
+    
+    hash_value = hmac.new(
+        CHANNEL_SECRET.encode('utf-8'),
+        body.encode('utf-8'),
+        hashlib.sha256
+    ).digest()
+    expected_signature = base64.b64encode(hash_value).decode('utf-8')
+    return hmac.compare_digest(signature, expected_signature)
+
+def dispatch_events(body, submit):
+    """Webhookのイベントを重複除外した上でsubmit(event)に渡す"""
+    try:
+        events = json.loads(body)['events']
+        print(f"📊 イベント数: {len(events)}")
+        
+        for event in events:
+            # 再送・重複イベントはプロフィール取得や保存の前に除外
+            event_id = event.get('webhookEventId')
+            if event_id and not event_deduplicator.claim(event_id):
+                print(f"♻️ 重複イベントを除外: {event_id}")
+                metrics.record_event(event.get('type'), 'duplicate')
+                continue
+            
+            if submit(event):
+                print(f"🚀 バックグラウンド処理開始: {event['type']}")
+                metrics.record_event(event.get('type'), 'accepted')
+            else:
+                print(f"⚠️ イベントキューが満杯のため破棄: {event['type']}")
+                metrics.record_event(event.get('type'), 'dropped')
+    
+    except Exception as e:
+        print(f"❌ エラー: {e}")
+        import traceback
+        traceback.print_exc()
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
@@ -283,138 +430,505 @@ def webhook():
     
     print(f"📝 Body length: {len(body)}")
     
-    if CHANNEL_SECRET:
-        hash_value = hmac.new(
-            CHANNEL_SECRET.encode('utf-8'),
-            body.encode('utf-8'),
-            hashlib.sha256
-        ).digest()
-        expected_signature = base64.b64encode(hash_value).decode('utf-8')
-        
-        if signature != expected_signature:
-            print(f"❌ 署名検証失敗")
-            abort(400)
-        else:
-            print(f"✅ 署名検証成功")
+    with metrics.STAGE_SIGNATURE.time():
+        valid = verify_signature(body, signature)
+    if not valid:
+        print(f"❌ 署名検証失敗")
+        abort(400)
+    elif CHANNEL_SECRET:
+        print(f"✅ 署名検証成功")
     
-    # イベント処理（バックグラウンドで実行）
-    try:
-        events = json.loads(body)['events']
-        print(f"📊 イベント数: {len(events)}")
-        
-        # 各イベントをバックグラウンドで処理
-        for event in events:
-            thread = Thread(target=process_webhook_event, args=(event,))
-            thread.daemon = True
-            thread.start()
-            print(f"🚀 バックグラウンド処理開始: {event['type']}")
-    
-    except Exception as e:
-        print(f"❌ エラー: {e}")
-        import traceback
-        traceback.print_exc()
+    # イベント処理（ワーカープールのキューに投入してバックグラウンドで実行）
+    with metrics.STAGE_DISPATCH.time():
+        dispatch_events(body, lambda event: event_pool.submit(process_webhook_event, event))
     
     # 即座に200を返す（LINEのタイムアウトを回避）
     print(f"✅ 200 OK返信")
     return 'OK', 200
 
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request_metrics(response):
+    """ルートごとの処理時間と件数を記録（ストリーミングはレスポンス開始まで）"""
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.HTTP_REQUEST_SECONDS.labels(route, request.method).observe(time.perf_counter() - started)
+        metrics.HTTP_REQUESTS.labels(route, request.method, response.status_code).inc()
+    return response
+
+# キュー長・処理中の件数などは /metrics の出力時に取得する
+metrics.registry.gauge(
+    'line_webhook_queue_depth', '処理待ちのWebhookイベント数',
+    lambda: event_pool.stats()['queue_depth']
+)
+metrics.registry.gauge(
+    'line_webhook_in_flight', '処理中のWebhookイベント数',
+    lambda: event_pool.stats()['busy_workers']
+)
+metrics.registry.gauge(
+    'line_webhook_record_queue_depth', '書き込み待ちの記録数',
+    lambda: record_writer.stats()['queue_depth']
+)
+metrics.registry.gauge(
+    'line_webhook_profile_cache_entries', 'プロフィールキャッシュの件数',
+    lambda: profile_cache.stats()['size']
+)
+metrics.registry.gauge(
+    'line_outbox_messages', '送信キューのメッセージ数（状態別）',
+    lambda: {status: count for status, count in outbox.stats().items() if status in OUTBOX_STATUSES},
+    ('status',)
+)
+
+def _count_jobs_by_status():
+    counts = {}
+    for job in broadcast_manager.jobs():
+        counts[job.status] = counts.get(job.status, 0) + 1
+    return counts
+
+metrics.registry.gauge(
+    'line_webhook_broadcast_jobs', '配信ジョブ数（状態別）',
+    _count_jobs_by_status,
+    ('status',)
+)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """処理時間・件数のメトリクス（Prometheusのテキスト形式）"""
+    return Response(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/health', methods=['GET'])
 def health():
     """ヘルスチェック"""
     return 'OK', 200
 
+@app.route('/status', methods=['GET'])
+def status():
+    """バックグラウンド処理の状態（JSON）"""
+    return jsonify({
+        'worker_pool': event_pool.stats(),
+        'event_dedup': event_deduplicator.stats(),
+        'profile_cache': profile_cache.stats(),
+        'record_writer': record_writer.stats(),
+        'customers': customers.stats(),
+        'search_index': search_index.stats(),
+        'render_cache': render_cache.stats(),
+        'outbox': outbox.stats(),
+        'rate_limiter': rate_limiter.stats(),
+        'webhook_mode': WEBHOOK_MODE,
+        'process': {'pid': os.getpid(), 'processes': WEBHOOK_PROCESSES},
+        **{name: stats() for name, stats in extra_status.items()},
+    })
+
 @app.route('/', methods=['GET'])
 def index():
     """ルートパス"""
     return 'LINE Webhook Server is running!', 200
 
+def _parse_time_param(value, end=False):
+    """日付（YYYY-MM-DD）または日時のクエリパラメータをタイムスタンプ文字列に変換"""
+    value = value.strip().replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if fmt == '%Y-%m-%d' and end:
+            return parsed.strftime('%Y-%m-%d 23:59:59')
+        if fmt == '%Y-%m-%d %H:%M' and end:
+            return parsed.strftime('%Y-%m-%d %H:%M:59')
+        return parsed.strftime('%Y-%m-%d %H:%M:%S')
+    raise ValueError(f'日付の形式が正しくありません: {value}')
+
+def _parse_filters(args):
+    """クエリパラメータからストレージの絞り込み条件を作る"""
+    filters = {}
+    if args.get('from'):
+        filters['start'] = _parse_time_param(args['from'])
+    if args.get('to'):
+        filters['end'] = _parse_time_param(args['to'], end=True)
+    for name in ('user_id', 'reply_status', 'monetization'):
+        if args.get(name):
+            filters[name] = args[name]
+    return filters
+
+def _export_etag(version, filters):
+    """データの版と絞り込み条件からETagを作る"""
+    key = json.dumps([version, sorted(filters.items())], ensure_ascii=False)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+def _spool_export(etag, filters):
+    """Range要求用にCSVをファイルへ書き出す（同じETagなら再利用）"""
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_CACHE_DIR, f'{etag}.csv')
+    if not os.path.exists(path):
+        export_csv(storage, path, **filters)
+        # 古いエクスポートを削除
+        exports = sorted(
+            (os.path.join(EXPORT_CACHE_DIR, name) for name in os.listdir(EXPORT_CACHE_DIR) if name.endswith('.csv')),
+            key=os.path.getmtime,
+            reverse=True
+        )
+        for old_path in exports[EXPORT_CACHE_KEEP:]:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+    return path
+
 @app.route('/download', methods=['GET'])
 def download_csv():
-    """ＣＳＶファイルをダウンロード"""
-    from flask import send_file
-    csv_file = os.path.join(os.path.dirname(__file__), 'customer_data.csv')
+    """ＣＳＶファイルをダウンロード（ストレージから生成）"""
+    try:
+        filters = _parse_filters(request.args)
+    except ValueError as e:
+        return str(e), 400
+    
+    version = storage.data_version()
+    if not version:
+        return 'データがまだありません。LINEでメッセージを送信してください。', 404
+    
+    etag = _export_etag(version, filters)
+    filename = f'LINE顧客管理_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
     
-    if os.path.exists(csv_file):
-        return send_file(
-            csv_file,
+    # Range要求（途中からの再開など）はファイルに書き出して部分返信する
+    if request.range is not None:
+        response = send_file(
+            _spool_export(etag, filters),
             mimetype='text/csv',
             as_attachment=True,
-            download_name=f'LINE顧客管理_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+            download_name=filename,
+            etag=etag,
+            conditional=True
         )
-    else:
-        return 'データがまだありません。LINEでメッセージを送信してください。', 404
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    use_gzip = request.accept_encodings['gzip'] > 0
+    if use_gzip:
+        etag = f'{etag}-gzip'
+    
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    
+    def generate():
+        # 行を読みながら順に返す（全体をメモリに載せない）
+        yield '\ufeff'.encode('utf-8')
+        for chunk in iter_csv_chunks(storage.iter_rows(**filters)):
+            yield chunk.encode('utf-8')
+    
+    def generate_gzip():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for data in generate():
+            compressed = compressor.compress(data)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+    
+    response = Response(
+        generate_gzip() if use_gzip else generate(),
+        mimetype='text/csv',
+        headers={
+            'Content-Disposition': _content_disposition(filename),
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding',
+        }
+    )
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    return response
 
-@app.route('/stats', methods=['GET'])
-def stats():
-    """統計情報を表示"""
-    csv_file = os.path.join(os.path.dirname(__file__), 'customer_data.csv')
+def _content_disposition(filename):
+    """日本語ファイル名に対応したContent-Dispositionヘッダー"""
+    from urllib.parse import quote
+    return f"attachment; filename*=UTF-8''{quote(filename)}"
+
+def stats_summary():
+    """/statsの集計値（複数プロセスでは全プロセスの記録を反映した顧客テーブルの値）"""
+    if WEBHOOK_PROCESSES > 1:
+        customers.catch_up()
+        return customers.summary()
+    return message_stats.snapshot()
+
+def _cached_page(key, render, content_type='text/html; charset=utf-8', static=False):
+    """描画結果のキャッシュから返す（圧縮済みの本文・ETag・Last-Modified付き、一致すれば304）
+
+    データの版が変わっていなければ描画し直さず、ストレージも読まない。renderがNoneを返した場合はNone。
+    """
+    page = render_cache.get(key, render, static=static)
+    if page is None:
+        return None
+    use_gzip = request.accept_encodings['gzip'] > 0
+    response = Response(page.gzipped if use_gzip else page.body, content_type=content_type)
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(f'{page.etag}-gzip' if use_gzip else page.etag)
+    response.last_modified = page.modified_at
+    return response.make_conditional(request)
+
+def render_stats_page():
+    """統計ページのHTML（データがまだ無ければNone）"""
+    summary = stats_summary()
+    if summary['total_messages'] == 0:
+        return None
     
-    if not os.path.exists(csv_file):
-        return 'データがまだありません', 404
+    total_messages = summary['total_messages']
+    needs_reply = summary['needs_reply']
+    high_opportunities = summary['high_opportunities']
+    customers = summary['customers']
     
+    html = f'''
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <title>LINE顧客管理システム - 統計</title>
+        <style>
+            body {{ font-family: Arial, sans-serif; margin: 40px; }}
+            h1 {{ color: #00B900; }}
+            .stat {{ background: #f0f0f0; padding: 20px; margin: 10px 0; border-radius: 5px; }}
+            .stat h2 {{ margin: 0 0 10px 0; color: #333; }}
+            .stat p {{ margin: 5px 0; font-size: 24px; font-weight: bold; color: #00B900; }}
+            .download-btn {{ 
+                display: inline-block;
+                background: #00B900;
+                color: white;
+                padding: 15px 30px;
+                text-decoration: none;
+                border-radius: 5px;
+                margin-top: 20px;
+            }}
+            .download-btn:hover {{ background: #009900; }}
+        </style>
+    </head>
+    <body>
+        <h1>📊 LINE顧客管理システム</h1>
+        <div class="stat">
+            <h2>総メッセージ数</h2>
+            <p>{total_messages}件</p>
+        </div>
+        <div class="stat">
+            <h2>返信が必要なメッセージ</h2>
+            <p>{needs_reply}件</p>
+        </div>
+        <div class="stat">
+            <h2>高優先度マネタイズ機会</h2>
+            <p>{high_opportunities}件</p>
+        </div>
+        <div class="stat">
+            <h2>総顧客数</h2>
+            <p>{customers}名</p>
+        </div>
+        <a href="/download" class="download-btn">💾 CSVファイルをダウンロード</a>
+        <a href="/broadcast" class="download-btn" style="background: #FF6B6B; margin-left: 10px;">📢 プッシュ配信</a>
+        <a href="/search" class="download-btn" style="background: #4A90D9; margin-left: 10px;">🔍 メッセージ検索</a>
+    </body>
+    </html>
+    '''
+    return html
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """統計情報を表示（データの版が変わるまでは描画済みのページを返す）"""
     try:
-        import csv
-        with open(csv_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
-        
-        total_messages = len(rows)
-        needs_reply = sum(1 for row in rows if row.get('返信ステータス') == '要返信')
-        high_opportunities = sum(1 for row in rows if row.get('マネタイズ機会') == '高')
-        
-        users = set(row.get('ユーザー名', 'Unknown') for row in rows)
-        
-        html = f'''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <title>LINE顧客管理システム - 統計</title>
-            <style>
-                body {{ font-family: Arial, sans-serif; margin: 40px; }}
-                h1 {{ color: #00B900; }}
-                .stat {{ background: #f0f0f0; padding: 20px; margin: 10px 0; border-radius: 5px; }}
-                .stat h2 {{ margin: 0 0 10px 0; color: #333; }}
-                .stat p {{ margin: 5px 0; font-size: 24px; font-weight: bold; color: #00B900; }}
-                .download-btn {{ 
-                    display: inline-block;
-                    background: #00B900;
-                    color: white;
-                    padding: 15px 30px;
-                    text-decoration: none;
-                    border-radius: 5px;
-                    margin-top: 20px;
-                }}
-                .download-btn:hover {{ background: #009900; }}
-            </style>
-        </head>
-        <body>
-            <h1>📊 LINE顧客管理システム</h1>
-            <div class="stat">
-                <h2>総メッセージ数</h2>
-                <p>{total_messages}件</p>
-            </div>
-            <div class="stat">
-                <h2>返信が必要なメッセージ</h2>
-                <p>{needs_reply}件</p>
-            </div>
-            <div class="stat">
-                <h2>高優先度マネタイズ機会</h2>
-                <p>{high_opportunities}件</p>
-            </div>
-            <div class="stat">
-                <h2>総顧客数</h2>
-                <p>{len(users)}名</p>
-            </div>
-            <a href="/download" class="download-btn">💾 CSVファイルをダウンロード</a>
-            <a href="/broadcast" class="download-btn" style="background: #FF6B6B; margin-left: 10px;">📢 プッシュ配信</a>
-        </body>
-        </html>
-        '''
-        return html
+        response = _cached_page('stats', render_stats_page)
+        if response is None:
+            return 'データがまだありません', 404
+        return response
     except Exception as e:
         return f'エラー: {e}', 500
 
+@app.route('/stats.json', methods=['GET'])
+def stats_json():
+    """統計情報（JSON、監視用）"""
+    return _cached_page('stats.json', lambda: json.dumps(stats_summary()), content_type='application/json')
+
+def _search_params(args):
+    """検索のクエリパラメータを解釈する（不正な値はValueError）"""
+    params = _parse_filters(args)
+    if args.get('message_type'):
+        params['message_type'] = args['message_type']
+    try:
+        params['page'] = int(args.get('page', 1))
+        params['per_page'] = int(args.get('per_page', 20))
+    except ValueError:
+        raise ValueError('page・per_pageは整数で指定してください')
+    params['sort'] = args.get('sort', 'score')
+    return params
+
+@app.route('/search.json', methods=['GET'])
+def search_json():
+    """メッセージ内容の全文検索（JSON）"""
+    try:
+        params = _search_params(request.args)
+        # 他のプロセスが書き込んだ記録も反映してから検索する
+        search_index.catch_up()
+        return jsonify(search_index.search(request.args.get('q', ''), **params))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/search', methods=['GET'])
+def search():
+    """メッセージ内容の検索ページ"""
+    from flask import render_template_string
+    
+    query = request.args.get('q', '')
+    result = None
+    error = None
+    if query.strip():
+        try:
+            params = _search_params(request.args)
+            search_index.catch_up()
+            result = search_index.search(query, **params)
+        except ValueError as e:
+            error = str(e)
+    
+    html = '''
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1">
+        <title>メッセージ検索</title>
+        <style>
+            body { font-family: Arial, sans-serif; margin: 20px; max-width: 800px; }
+            h1 { color: #00B900; }
+            input, select { padding: 8px; margin: 4px 0; font-size: 16px; }
+            input[name=q] { width: 100%; box-sizing: border-box; }
+            button { background: #00B900; color: white; padding: 10px 20px; border: none; border-radius: 5px; font-size: 16px; }
+            .result { border-bottom: 1px solid #ddd; padding: 10px 0; }
+            .meta { color: #666; font-size: 13px; }
+            .content { margin: 4px 0; white-space: pre-wrap; }
+            .error { color: #c00; }
+            .pages a { margin-right: 10px; }
+        </style>
+    </head>
+    <body>
+        <h1>🔍 メッセージ検索</h1>
+        <form method="GET">
+            <input type="search" name="q" value="{{ query }}" placeholder="検索語（空白区切りですべてを含むメッセージ）" required>
+            <input type="text" name="user_id" value="{{ args.get('user_id', '') }}" placeholder="ユーザーID">
+            <input type="date" name="from" value="{{ args.get('from', '') }}">〜<input type="date" name="to" value="{{ args.get('to', '') }}">
+            <select name="reply_status">
+                <option value="">返信ステータス</option>
+                {% for value in ['要返信', '確認済み', '返信不要'] %}
+                <option value="{{ value }}" {% if args.get('reply_status') == value %}selected{% endif %}>{{ value }}</option>
+                {% endfor %}
+            </select>
+            <select name="sort">
+                <option value="score">関連度順</option>
+                <option value="new" {% if args.get('sort') == 'new' %}selected{% endif %}>新しい順</option>
+            </select>
+            <button type="submit">検索</button>
+        </form>
+        {% if error %}<p class="error">{{ error }}</p>{% endif %}
+        {% if result %}
+        <p>{{ result.total }}件{% if result.total_capped %}以上（新しい{{ result.total }}件から表示しています。条件を加えると絞り込めます）{% endif %}</p>
+        {% for item in result.results %}
+        <div class="result">
+            <div class="meta">{{ item.timestamp }} ・ {{ item.user_name }}（{{ item.user_id }}）・ {{ item.reply_status }} ・ マネタイズ: {{ item.monetization }}</div>
+            <div class="content">{{ item.content }}</div>
+        </div>
+        {% endfor %}
+        <div class="pages">
+            {% if result.page > 1 %}<a href="?{{ page_query(result.page - 1) }}">← 前へ</a>{% endif %}
+            {% if result.page * result.per_page < result.total %}<a href="?{{ page_query(result.page + 1) }}">次へ →</a>{% endif %}
+        </div>
+        {% endif %}
+        <a href="/stats">統計ページに戻る</a>
+    </body>
+    </html>
+    '''
+    
+    def page_query(page):
+        from urllib.parse import urlencode
+        return urlencode(dict(request.args.items(), page=page))
+    
+    return render_template_string(html, query=query, args=request.args, result=result, error=error,
+                                  page_query=page_query), 400 if error else 200
+
+def _encode_cursor(kind, position):
+    """ページの位置をクエリパラメータに使える文字列にする"""
+    if position is None:
+        return None
+    data = json.dumps({'kind': kind, 'position': position}, ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode_cursor(kind, value):
+    """cursorパラメータをページの位置に戻す（無ければNone、不正ならValueError）"""
+    if not value:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+    except Exception:
+        raise ValueError('cursorが正しくありません')
+    if not isinstance(data, dict) or data.get('kind') != kind or not isinstance(data.get('position'), dict):
+        raise ValueError('cursorが正しくありません')
+    return data['position']
+
+def _api_params(args, kind, columns):
+    """JSON APIのクエリパラメータを解釈する（不正な値はValueError）"""
+    filters = _parse_filters(args)
+    try:
+        limit = int(args.get('limit', API_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('limitは整数で指定してください')
+    if not 1 <= limit <= API_MAX_PAGE_SIZE:
+        raise ValueError(f'limitは1〜{API_MAX_PAGE_SIZE}で指定してください')
+    fields = list(columns)
+    if args.get('fields'):
+        fields = [name.strip() for name in args['fields'].split(',') if name.strip()]
+        unknown = [name for name in fields if name not in columns]
+        if unknown:
+            raise ValueError(f'不明な項目です: {", ".join(unknown)}（指定できる項目: {", ".join(columns)}）')
+    return filters, _decode_cursor(kind, args.get('cursor')), limit, fields
+
+@app.route('/api/messages', methods=['GET'])
+def api_messages():
+    """メッセージの記録（JSON、カーソルでページ送り）"""
+    try:
+        filters, cursor, limit, fields = _api_params(request.args, type(storage).__name__, [name for name, _ in FIELDS])
+        if request.args.get('message_type'):
+            filters['message_type'] = request.args['message_type']
+        rows, next_cursor, has_more = storage.page(cursor, limit, **filters)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    labels = dict(FIELDS)
+    return jsonify({
+        'items': [{name: row.get(labels[name]) or '' for name in fields} for row in rows],
+        'next_cursor': _encode_cursor(type(storage).__name__, next_cursor),
+        'has_more': has_more,
+        'limit': limit,
+    })
+
+@app.route('/api/customers', methods=['GET'])
+def api_customers():
+    """顧客テーブル（JSON、最終メッセージ日時の順にカーソルでページ送り）"""
+    try:
+        filters, cursor, limit, fields = _api_params(request.args, 'customers', CUSTOMER_COLUMNS)
+        if request.args.get('followed') in ('0', '1'):
+            filters['followed'] = request.args['followed'] == '1'
+        # 他のプロセスが書き込んだ記録も反映してから読む
+        customers.catch_up()
+        rows, next_cursor, has_more = customers.page(cursor, limit, **filters)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'items': [{name: row[name] for name in fields} for row in rows],
+        'next_cursor': _encode_cursor('customers', next_cursor),
+        'has_more': has_more,
+        'limit': limit,
+    })
+
 @app.route('/broadcast', methods=['GET', 'POST'])
 def broadcast():
     """プッシュ配信ページ"""
@@ -427,66 +941,22 @@ def broadcast():
         if not message_text:
             return 'メッセージを入力してください', 400
         
-        # CSVファイルから顧客リストを取得
-        csv_file = os.path.join(os.path.dirname(__file__), 'customer_data.csv')
-        
-        if not os.path.exists(csv_file):
+        # 顧客テーブルから顧客リストを取得（書き込み済みの記録まで反映してから）
+        customers.catch_up()
+        if customers.count() == 0:
             return '顧客データがありません', 404
         
         try:
-            import csv
-            with open(csv_file, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                rows = list(reader)
-            
-            # ターゲットをフィルタリング
+            # ターゲットをフィルタリング（ブロック・削除したユーザーは含めない）
             target_users = set()
-            for row in rows:
-                user_id = row.get('ユーザーID', '')
-                if not user_id or user_id == 'Unknown':
-                    continue
-                
-                if target_type == 'all':
-                    target_users.add(user_id)
-                elif target_type == 'high_priority':
-                    if row.get('マネタイズ機会') == '高':
-                        target_users.add(user_id)
-                elif target_type == 'needs_reply':
-                    if row.get('返信ステータス') == '要返信':
-                        target_users.add(user_id)
-                elif target_type == 'new_customers':
-                    if row.get('備考') == '新規顧客':
-                        target_users.add(user_id)
-            
-            # メッセージを送信
-            success_count = 0
-            for user_id in target_users:
-                if send_reply_message(user_id, message_text):
-                    success_count += 1
+            if target_type in customers.segments.definitions:
+                target_users = customers.segment(target_type)
+            target_users.discard('')
+            target_users.discard('Unknown')
             
-            return f'''
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="UTF-8">
-                <title>配信完了</title>
-                <style>
-                    body {{ font-family: Arial, sans-serif; margin: 40px; }}
-                    h1 {{ color: #00B900; }}
-                    .success {{ background: #d4edda; padding: 20px; border-radius: 5px; color: #155724; }}
-                    a {{ display: inline-block; margin-top: 20px; padding: 10px 20px; background: #00B900; color: white; text-decoration: none; border-radius: 5px; }}
-                </style>
-            </head>
-            <body>
-                <h1>✅ 配信完了</h1>
-                <div class="success">
-                    <p>対象: {len(target_users)}人</p>
-                    <p>成功: {success_count}人</p>
-                </div>
-                <a href="/stats">統計ページに戻る</a>
-            </body>
-            </html>
-            '''
+            # バックグラウンドの配信ジョブとして登録し、進捗ページへ移動
+            job = broadcast_manager.start(message_text, target_users, target_type)
+            return redirect(f'/broadcast/jobs/{job.id}', code=303)
         except Exception as e:
             return f'エラー: {e}', 500
     
@@ -514,10 +984,9 @@ def broadcast():
         <form method="POST">
             <label for="target_type">配信対象:</label>
             <select name="target_type" id="target_type">
-                <option value="all">全顧客</option>
-                <option value="high_priority">高優先度マネタイズ機会</option>
-                <option value="needs_reply">返信が必要な顧客</option>
-                <option value="new_customers">新規顧客</option>
+                {% for name, label in segments %}
+                <option value="{{ name }}">{{ label }}</option>
+                {% endfor %}
             </select>
             
             <label for="message">メッセージ:</label>
@@ -529,9 +998,115 @@ def broadcast():
     </body>
     </html>
     '''
-    return html
+    # 配信対象の選択肢が変わらない限り同じページなので、描画・圧縮は1回だけにする
+    segments = customers.segment_options()
+    return _cached_page(
+        ('broadcast', tuple(segments)), lambda: render_template_string(html, segments=segments), static=True
+    )
+
+@app.route('/broadcast/jobs/<job_id>/status', methods=['GET'])
+def broadcast_job_status(job_id):
+    """配信ジョブの進捗（JSON）"""
+    job = broadcast_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    return jsonify(job.progress(details=request.args.get('details') == '1'))
+
+@app.route('/broadcast/jobs/<job_id>', methods=['GET'])
+def broadcast_job(job_id):
+    """配信ジョブの進捗ページ"""
+    job = broadcast_manager.get(job_id)
+    if job is None:
+        return '配信ジョブが見つかりません', 404
+    
+    progress = job.progress()
+    return f'''
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <title>配信状況</title>
+        <style>
+            body {{ font-family: Arial, sans-serif; margin: 40px; }}
+            h1 {{ color: #00B900; }}
+            .success {{ background: #d4edda; padding: 20px; border-radius: 5px; color: #155724; }}
+            a {{ display: inline-block; margin-top: 20px; padding: 10px 20px; background: #00B900; color: white; text-decoration: none; border-radius: 5px; }}
+        </style>
+    </head>
+    <body>
+        <h1 id="title">📤 配信中...</h1>
+        <div class="success">
+            <p>対象: <span id="total">{progress['total']}</span>人</p>
+            <p>成功: <span id="sent">{progress['sent']}</span>人</p>
+            <p>失敗: <span id="failed">{progress['failed']}</span>人</p>
+            <p>残り: <span id="remaining">{progress['remaining']}</span>人</p>
+            <p id="error"></p>
+        </div>
+        <a href="/stats">統計ページに戻る</a>
+        <script>
+            function poll() {{
+                fetch('/broadcast/jobs/{job.id}/status')
+                    .then(function (response) {{ return response.json(); }})
+                    .then(function (job) {{
+                        ['total', 'sent', 'failed', 'remaining'].forEach(function (key) {{
+                            document.getElementById(key).textContent = job[key];
+                        }});
+                        if (job.status === 'completed') {{
+                            document.getElementById('title').textContent = '✅ 配信完了';
+                        }} else if (job.status === 'failed') {{
+                            document.getElementById('title').textContent = '❌ 配信失敗';
+                            document.getElementById('error').textContent = job.error || '';
+                        }} else {{
+                            setTimeout(poll, 1000);
+                        }}
+                    }})
+                    .catch(function () {{ setTimeout(poll, 3000); }});
+            }}
+            poll();
+        </script>
+    </body>
+    </html>
+    '''
+
+def graceful_shutdown():
+    """キューに残ったイベントを処理し終えてから停止"""
+    stats = event_pool.stats()
+    print(f"🛑 シャットダウン: 残りイベント {stats['queue_depth']}件を処理します")
+    if event_pool.shutdown(timeout=WEBHOOK_SHUTDOWN_TIMEOUT):
+        print("✅ イベント処理完了")
+    else:
+        print("⚠️ タイムアウトのため未処理のイベントがあります")
+    
+    if not broadcast_pool.shutdown(timeout=WEBHOOK_SHUTDOWN_TIMEOUT):
+        print("⚠️ タイムアウトのため完了していない配信ジョブがあります")
+    
+    if record_writer.close(timeout=WEBHOOK_SHUTDOWN_TIMEOUT):
+        print(f"✅ 記録書き込み完了: {record_writer.stats()['written']}件")
+    else:
+        print("⚠️ タイムアウトのため書き込まれていない記録があります")
+    customers.close()
+    search_index.close()
+    
+    # 送信時刻を迎えたメッセージを送る（残りは保存され、次回起動時に送られる）
+    remaining = outbox.close(timeout=WEBHOOK_SHUTDOWN_TIMEOUT)
+    print(f"📮 未送信メッセージ: {remaining}件")
+    
+    saved = profile_cache.save()
+    print(f"💾 プロフィールキャッシュ保存: {saved}件")
+    profile_cache.close()
+    if broadcast_manager.store is not None:
+        broadcast_manager.store.close()
+    
+    event_deduplicator.close()
+    line_api.close()
+    rate_limiter.close()
+
+atexit.register(graceful_shutdown)
 
 if __name__ == '__main__':
+    # SIGTERM（Render.comの停止シグナル）でも終了処理を実行する
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
     # 環境変数の確認
     if not CHANNEL_ACCESS_TOKEN:
         print("⚠️ 警告: LINE_CHANNEL_ACCESS_TOKENが設定されていません")
@@ -545,5 +1120,16 @@ if __name__ == '__main__':
     
     # サーバー起動
     port = int(os.environ.get('PORT', 5000))
-    print(f"🚀 サーバー起動: ポート {port}")
-    app.run(host='0.0.0.0', port=port, debug=False)
+    if WEBHOOK_MODE == 'async':
+        # async_serverから同じモジュールを参照させる（二重に初期化しない）
+        sys.modules.setdefault('webhook_server', sys.modules[__name__])
+        import async_server
+        async_server.run(port)
+    elif WEBHOOK_SERVER_FD:
+        # prefork.pyが作った待ち受けソケットで受け付ける（他のワーカープロセスと共有）
+        from werkzeug.serving import make_server
+        print(f"🚀 ワーカープロセス起動: pid={os.getpid()}")
+        make_server('0.0.0.0', port, app, threaded=True, fd=int(WEBHOOK_SERVER_FD)).serve_forever()
+    else:
+        print(f"🚀 サーバー起動: ポート {port}")
+        app.run(host='0.0.0.0', port=port, debug=False)
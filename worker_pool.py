@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import threading
+
+
+# キュー終端を示すセンチネル
+_STOP = object()
+
+
+class WorkerPool:
+    """固定数のワーカースレッドと上限付きキューでタスクを処理するプール"""
+
+    def __init__(self, workers=8, queue_size=1000, name='worker'):
+        self.workers = max(1, int(workers))
+        self.queue_size = max(1, int(queue_size))
+        self.name = name
+
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started = False
+        self._closed = False
+
+        # 統計情報
+        self._busy = 0
+        self._busy_seconds = 0.0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._started_at = None
+
+    def _ensure_started(self):
+        """ワーカースレッドを起動（初回投入時に遅延起動）"""
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'{self.name}-{i}')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._started_at = time.monotonic()
+            self._started = True
+
+    def submit(self, func, *args):
+        """タスクをキューに投入（キューが満杯・停止中の場合はFalse）"""
+        if self._closed:
+            with self._lock:
+                self._rejected += 1
+            return False
+
+        self._ensure_started()
+
+        try:
+            self._queue.put_nowait((func, args))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            return False
+
+        with self._lock:
+            self._submitted += 1
+        return True
+
+    def _run(self):
+        """ワーカースレッドのメインループ"""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+
+                func, args = item
+                with self._lock:
+                    self._busy += 1
+                started = time.monotonic()
+                try:
+                    func(*args)
+                    failed = False
+                except Exception as e:
+                    print(f"❌ ワーカー処理エラー: {e}")
+                    import traceback
+                    traceback.print_exc()
+                    failed = True
+                finally:
+                    elapsed = time.monotonic() - started
+                    with self._lock:
+                        self._busy -= 1
+                        self._busy_seconds += elapsed
+                        if failed:
+                            self._failed += 1
+                        else:
+                            self._completed += 1
+            finally:
+                self._queue.task_done()
+
+    def stats(self):
+        """キュー深さとワーカー稼働率を返す"""
+        with self._lock:
+            uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+            capacity = uptime * self.workers
+            return {
+                'workers': self.workers,
+                'busy_workers': self._busy,
+                'utilization': round(self._busy / self.workers, 3),
+                'average_utilization': round(self._busy_seconds / capacity, 3) if capacity else 0.0,
+                'queue_depth': self._queue.qsize(),
+                'queue_size': self.queue_size,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+            }
+
+    def shutdown(self, timeout=None):
+        """新規投入を止め、キューに残ったタスクを処理し終えてから停止"""
+        with self._lock:
+            self._closed = True
+            started = self._started
+        if not started:
+            return True
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            if deadline is None:
+                return None
+            return max(0.0, deadline - time.monotonic())
+
+        # 残タスクの後ろにセンチネルを積む（キューが空くまで待つ）
+        for _ in self._threads:
+            try:
+                self._queue.put(_STOP, timeout=remaining())
+            except queue.Full:
+                break
+
+        for thread in self._threads:
+            thread.join(remaining())
+
+        return not any(thread.is_alive() for thread in self._threads)